@@ -32,13 +32,21 @@ import uuid
 import Queue
 import base64
 import datetime
-from time import sleep
+from time import sleep, time
 from StringIO import StringIO
-import io
 from urlparse import urlparse, urlunparse
 import random
 import re
 import json
+import tempfile
+import multiprocessing
+import hashlib
+import shutil
+import shlex
+import subprocess
+from collections import OrderedDict
+from array import array
+from bisect import bisect_right
 
 from OpenSSL import crypto
 from socketIO_client import SocketIO, LoggingNamespace, TimeoutError, ConnectionError
@@ -54,7 +62,8 @@ import octoprint_client
 from octoprint.util import get_exception_string
 from octoprint.events import Events
 from octoprint.filemanager import FileDestinations
-from octoprint.filemanager.util import StreamWrapper
+from octoprint.filemanager.util import DiskFileWrapper
+from octoprint.slicing.exceptions import UnknownSlicer, SlicerNotConfigured
 
 # logging.getLogger('socketIO-client').setLevel(logging.DEBUG)
 # logging.basicConfig()
@@ -79,6 +88,16 @@ def normalize_url(url):
 		host = get_ip()
 	return urlunparse((scheme, host, urlp.path, urlp.params, urlp.query, urlp.fragment))
 
+# guess the mjpeg stream url for the camera we take snapshots from, prefer
+# mjpg-streamer's sibling action on the snapshot url since the configured
+# stream url is often relative to the browser (e.g. through haproxy)
+def stream_url_for_snapshot(snapshot_url, stream_url):
+	if snapshot_url and "action=snapshot" in snapshot_url:
+		return snapshot_url.replace("action=snapshot", "action=stream")
+	if stream_url and urlparse(stream_url).netloc:
+		return stream_url
+	return None
+
 # do a dictionary lookup and return an empty string for any missing key
 # rather than throw MissingKey
 def str_safe_get(dictionary, *keys):
@@ -94,6 +113,131 @@ def has_all(dictionary, *keys):
 			return False
 	return True
 
+# shrink and/or rotate a webcam snapshot, module level so that it can be run
+# in a worker process
+def transcode_snapshot(image_bytes, max_size=None, flipH=False, flipV=False, rotate90=False):
+	image = Image.open(StringIO(image_bytes))
+	# thumbnail() has the jpeg decoder do most of the scaling (1/2, 1/4 or
+	# 1/8) so we never decode the full resolution frame, as long as nothing
+	# calls draft() before it with a size of its own (only the first counts)
+	image.thumbnail((640, 480))
+	if flipH:
+		image = image.transpose(Image.FLIP_LEFT_RIGHT)
+	if flipV:
+		image = image.transpose(Image.FLIP_TOP_BOTTOM)
+	if rotate90:
+		image = image.transpose(Image.ROTATE_90)
+	return encode_jpeg(image, max_size)
+
+# encode as jpeg at the highest quality that fits in max_size, interpolating
+# the quality from the sizes seen so far so that it usually takes two or three
+# encodes, if even min_quality doesn't fit, returns the smallest we made
+def encode_jpeg(image, max_size=None, quality=85, min_quality=20, max_passes=5):
+	def _encode(q):
+		buf = StringIO()
+		image.save(buf, format="jpeg", quality=q)
+		return buf.getvalue()
+
+	data = _encode(quality)
+	if not max_size or len(data) <= max_size:
+		return data
+
+	best = None
+	lo, lo_size = min_quality, None
+	hi, hi_size = quality, len(data)
+	for i in range(max_passes - 1):
+		if lo_size is not None:
+			q = lo + (hi - lo) * float(max_size - lo_size) / (hi_size - lo_size)
+		else:
+			q = hi * float(max_size) / hi_size
+		q = max(lo, min(hi - 1, int(q)))
+		if q < lo or (lo_size is not None and q == lo):
+			break
+		data = _encode(q)
+		if len(data) <= max_size:
+			best = data
+			lo, lo_size = q, len(data)
+		else:
+			hi, hi_size = q, len(data)
+			if q == lo:
+				break
+	return best if best is not None else data
+
+# 64 bit difference hash of a snapshot, compare two with hash_distance, frames
+# that only differ by sensor noise come out within a few bits of each other
+def snapshot_hash(image_bytes, noise=2):
+	image = Image.open(StringIO(image_bytes))
+	image.draft('L', (160, 120))
+	pixels = list(image.convert('L').resize((9, 8), Image.ANTIALIAS).getdata())
+	frame_hash = 0
+	for row in range(8):
+		for col in range(8):
+			left = pixels[row * 9 + col]
+			right = pixels[row * 9 + col + 1]
+			frame_hash = (frame_hash << 1) | (1 if left > right + noise else 0)
+	return frame_hash
+
+def hash_distance(a, b):
+	return bin(a ^ b).count('1')
+
+# the start gcode we send to the slicer has (@ignore ...) lines to keep it from
+# adding its own heat up commands, overwrite those in place with same length
+# comment lines (which OctoPrint won't send) so the file is never copied; being
+# start gcode they all come before the first ;LAYER: line, so that's as far as
+# it reads (or max_bytes, for a slicer that doesn't mark its layers)
+def blank_ignore_lines(path, max_bytes=64 * 1024):
+	count = 0
+	offset = 0
+	with open(path, 'r+b') as f:
+		for line in iter(f.readline, b''):
+			if line.startswith(b";LAYER:") or offset >= max_bytes:
+				break
+			if line.lstrip().startswith(b"(@ignore"):
+				end = f.tell()
+				f.seek(offset)
+				f.write(b";" + b" " * (len(line.rstrip(b"\r\n")) - 1))
+				f.seek(end)
+				count += 1
+			offset += len(line)
+	return count
+
+def remove_quietly(path):
+	try:
+		os.remove(path)
+	except OSError:
+		pass
+
+# hard link if we can (same filesystem), otherwise copy
+def link_or_copy(source, dest):
+	if os.path.exists(dest):
+		os.remove(dest)
+	try:
+		os.link(source, dest)
+	except (OSError, AttributeError):
+		shutil.copyfile(source, dest)
+
+# first heat up targets set in a chunk of gcode (a start code or the head of
+# a file), {'tool0': 210.0, 'bed': 60.0}, only lines that set an actual
+# number count, so templated ({print_temperature}) and cool down lines don't
+GCODE_TEMPERATURE = re.compile(r'^\s*M(104|109|140|190)\b([^;(\n]*)', re.IGNORECASE | re.MULTILINE)
+GCODE_PARAM_S = re.compile(r'S\s*(\d+(?:\.\d*)?)', re.IGNORECASE)
+GCODE_PARAM_T = re.compile(r'T\s*(\d+)', re.IGNORECASE)
+
+def target_temperatures_from_gcode(text):
+	targets = {}
+	for match in GCODE_TEMPERATURE.finditer(text or ""):
+		s = GCODE_PARAM_S.search(match.group(2))
+		if not s or not float(s.group(1)):
+			continue
+		if match.group(1) in ("140", "190"):
+			key = "bed"
+		else:
+			t = GCODE_PARAM_T.search(match.group(2))
+			key = "tool" + (t.group(1) if t else "0")
+		if not key in targets:
+			targets[key] = float(s.group(1))
+	return targets
+
 # compute total filament length from all tools
 def filament_length_from_job_data(data):
 	filament_length = 0
@@ -104,6 +248,198 @@ def filament_length_from_job_data(data):
 	return filament_length
 
 
+#~~ Cura engine config (as sent by Polar Cloud)
+
+ENGINE_CONFIG_OPTION = re.compile(r'([^:=\s][^:=]*?)\s*[:=]\s*(.*)$')
+ENGINE_CONFIG_INT = re.compile(r'[-+]?\d+$')
+ENGINE_CONFIG_FLOAT = re.compile(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?$')
+
+def engine_config_value(value):
+	if ENGINE_CONFIG_INT.match(value):
+		return int(value)
+	if ENGINE_CONFIG_FLOAT.match(value):
+		return float(value)
+	return value
+
+# parse a Cura engine config file (key = value lines without a section header,
+# multi-line values in triple quotes) in one pass, returns an OrderedDict of
+# lower cased option names to int, float or str values, multi-line values keep
+# their quotes and lose their blank lines and indentation (like ConfigParser)
+def parse_engine_config(config_file_bytes):
+	options = OrderedDict()
+	option = None
+	lines = iter(config_file_bytes.splitlines())
+	for number, line in enumerate(lines, 1):
+		stripped = line.strip()
+		if not stripped or line[0] in '#;':
+			continue
+		if line[0].isspace():
+			# continuation of the previous value
+			if option is None:
+				raise ValueError("Line {} continues nothing: {}".format(number, repr(line)))
+			options[option] = "{}\n{}".format(options[option], stripped)
+			continue
+
+		match = ENGINE_CONFIG_OPTION.match(line)
+		if not match:
+			raise ValueError("Line {} is not an option: {}".format(number, repr(line)))
+		option = match.group(1).strip().lower()
+		value = match.group(2)
+		pos = value.find(';')
+		if pos != -1 and value[pos - 1].isspace():
+			value = value[:pos]
+		value = value.strip()
+		if value == '""':
+			value = ''
+
+		if '"""' in line and not (len(value) >= 6 and value.startswith('"""') and value.endswith('"""')):
+			parts = [value]
+			for line in lines:
+				stripped = line.strip()
+				if stripped:
+					parts.append(stripped)
+				if '"""' in line:
+					break
+			options[option] = "\n".join(parts)
+		else:
+			options[option] = engine_config_value(value)
+	return options
+
+def _mm_from_um(x, context):
+	return x / 1000.0
+
+def _no_translation(x, context):
+	return x
+
+def _bool_from_int(x, context):
+	return not not x
+
+def _width_from_line_count(x, context):
+	return x * context["extrusion_width"]
+
+def _height_from_layer_count(x, context):
+	return x * context["layer_height"]
+
+def _fill_from_line_distance(x, context):
+	return 100.0 * context["extrusion_width"] / _mm_from_um(x, context)
+
+# engine config option -> (octoprint cura profile key, translate(value, context))
+ENGINE_CONFIG_TRANSLATIONS = {
+	"layerthickness":       ("layer_height",       _mm_from_um),
+	"printspeed":           ("print_speed",        _no_translation),
+	"supporttype":          ("support_type",       lambda x, c: "lines" if x == 0 else "grid"),
+	"infillspeed":          ("infill_speed",       _no_translation),
+	"infilloverlap":        ("fill_overlap",       _no_translation),
+	"filamentdiameter":     ("filament_diameter",  lambda x, c: [_mm_from_um(x, c) for i in range(4)]),
+	"filamentflow":         ("filament_flow",      _no_translation),
+	"retractionamountextruderswitch": ("retraction_dual_amount", _mm_from_um),
+	"retractionamount":     ("retraction_amount",  _mm_from_um),
+	"retractionspeed":      ("retraction_speed",   _no_translation),
+	"initiallayerthickness":("bottom_thickness",   _mm_from_um),
+	"extrusionwidth":       ("edge_width",         _mm_from_um),
+	"insetcount":           ("wall_thickness",     _width_from_line_count),
+	"downskincount":        ("solid_layer_thickness", _height_from_layer_count),
+	"upskincount":          ("solid_layer_thickness", _height_from_layer_count),
+	"initialspeeduplayers": (None, None),          # octoprint always uses 4
+	"initiallayerspeed":    ("bottom_layer_speed", _no_translation),
+	"inset0speed":          ("outer_shell_speed",  _no_translation),
+	"insetxspeed":          ("inner_shell_speed",  _no_translation),
+	"movespeed":            ("travel_speed",       _no_translation),
+	"minimallayertime":     ("cool_min_layer_time",_no_translation),
+	"infillpattern":        (None, None),          # octoprint doesn't set
+	"layer0extrusionwidth": ("first_layer_width_factor", lambda x, c: _mm_from_um(x, c) * 100.0 / c["extrusion_width"]),
+	"spiralizemode":        ("spiralize",          _bool_from_int),
+	"sparseinfilllinedistance": ("fill_density",   _fill_from_line_distance),
+	"multivolumeoverlap":   ("overlap_dual",       _mm_from_um),
+	"enableoozeshield":     ("ooze_shield",        _bool_from_int),
+	"fanfullonlayernr":     ("fan_full_height",    lambda x, c: (x - 1) * c["layer_height"] + c["init_layer_height"]),
+	"gcodeflavor":          ("gcode_flavor",       lambda x, c: "reprap"), # TODO: GPX -> RepRap
+	"autocenter":           (None, None),          # octoprint doesn't set
+	"objectsink":           ("object_sink",        _mm_from_um),
+	"extruderoffset[0].x":  (None, None),          # octoprint always overrides with printer profile
+	"extruderoffset[0].y":  (None, None),          # octoprint always overrides with printer profile
+	"retractionminimaldistance": ("retraction_min_travel", _mm_from_um),
+	"retractionzhop":       ("retraction_hop",     _mm_from_um),
+	"minimalextrusionbeforeretraction": ("retraction_minimal_extrusion", _mm_from_um),
+	"enablecombing":        ("retraction_combing", lambda x, c: "all" if x == 1 else ("no skin" if x == 2 else "off")),
+	"minimalfeedrate":      ("cool_min_feedrate",  _no_translation),
+	"coolheadlift":         ("cool_head_lift",     _bool_from_int),
+	"fanspeedmin":          ("fan_speed",          _no_translation),
+	"fanspeedmax":          ("fan_speed_max",      _no_translation),
+	"skirtdistance":        ("skirt_gap",          _mm_from_um),
+	"skirtminlength":       ("skirt_minimal_length", _mm_from_um),
+	"skirtlinecount":       ("skirt_line_count",   _no_translation),
+	"supportangle":         ("support_angle",      _no_translation),
+	"supportxydistance":    ("support_xy_distance", _mm_from_um),
+	"supportzdistance":     ("support_z_distance", _mm_from_um),
+	"supportlinedistance":  ("support_fill_rate",  _fill_from_line_distance),
+	"startcode":            ("start_gcode",        lambda x, c: ["(@ignore {print_temperature})\n(@ignore {print_bed_temperature})\n" + x[3:-3]]),
+	"endcode":              ("end_gcode",          lambda x, c: [x[3:-3]]),
+	"raftmargin":           ("raft_margin",        _mm_from_um),
+	"raftlinespacing":      ("raft_line_spacing",  _mm_from_um),
+	"raftbasethickness":    ("raft_base_thickness",_mm_from_um),
+	"raftbaselinewidth":    ("raft_base_linewidth",_mm_from_um),
+	"raftinterfacethickness": ("raft_thickness",   _mm_from_um),
+	"raftinterfacelinewidth": ("raft_margin",      _mm_from_um),
+	"raftinterfacelinespacing": (None, None),      # octoprint computes from linewidth
+	"raftbasespeed":        (None, None),          # octoprint always uses bottom_layer_speed
+	"raftfanspeed":         (None, None),          # octoprint forces this to 0
+	"raftsurfacethickness": ("raft_surface_thickness", _mm_from_um),
+	"raftsurfacelinewidth": ("raft_surface_linewidth", _mm_from_um),
+	"raftsurfacelinespacing": (None, None),        # octoprint computes from linewidth
+	"raftsurfacelayers":    ("raft_surface_layers",_no_translation),
+	"raftsurfacespeed":     (None, None),          # octoprint always uses bottom_layer_speed
+	"raftairgap":           ("raft_airgap_all",    _mm_from_um),
+	"raftairgaplayer0":     (None, None)           # octoprint doesn't support a different airgap for layer0)
+}
+
+# turn parsed engine config options into an octoprint cura slicing profile
+# dict, returns (profile, (posx, posy))
+def translate_engine_config(config, nozzle_diameter, logger):
+	context = dict(extrusion_width=nozzle_diameter, layer_height=0.2)
+	if isinstance(config.get("extrusionwidth"), (int, float)):
+		context["extrusion_width"] = _mm_from_um(config["extrusionwidth"], context)
+	if isinstance(config.get("layerthickness"), (int, float)):
+		context["layer_height"] = _mm_from_um(config["layerthickness"], context)
+	context["init_layer_height"] = context["layer_height"]
+	if isinstance(config.get("initiallayerthickness"), (int, float)):
+		context["init_layer_height"] = _mm_from_um(config["initiallayerthickness"], context)
+
+	profile = dict()
+	profile["support"] = "none"
+	posx = 0
+	posy = 0
+	for option, value in config.items():
+		if option in ENGINE_CONFIG_TRANSLATIONS:
+			key, translate = ENGINE_CONFIG_TRANSLATIONS[option]
+			if key:
+				profile[key] = translate(value, context)
+				if "raft" in key:
+					profile["platform_adhesion"] = "raft"
+				elif "support" in key:
+					if profile["support"] != "everywhere":
+						profile["support"] = "buildplate"
+			else:
+				logger.debug("Eating PolarCloud setting {}={}".format(option, value))
+		elif option == "supporteverywhere":
+			if value:
+				profile["support"] = "everywhere"
+		elif option == "fixhorrible":
+			profile["fix_horrible_union_all_type_a"] = not not (value & 0x01)
+			profile["fix_horrible_union_all_type_b"] = not not (value & 0x02)
+			profile["fix_horrible_extensive_stitching"] = not not (value & 0x04)
+			profile["fix_horrible_use_open_bits"] = not not (value & 0x10)
+		elif option == "posx":
+			posx = _mm_from_um(value, context)
+		elif option == "posy":
+			posy = _mm_from_um(value, context)
+		else:
+			logger.warn("PolarCloud slicing profile contains unrecognized setting {}={}".format(option, value))
+
+	profile["fan_enabled"] = "fan_speed_max" in profile and profile["fan_speed_max"] > 0
+	return profile, (posx, posy)
+
+
 class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
                        octoprint.plugin.AssetPlugin,
                        octoprint.plugin.TemplatePlugin,
@@ -125,15 +461,35 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 	PSTATE_ERROR = "12"
 	PSTATE_OFFLINE = "13"
 
+	# stages of getting a cloud print going, reported while PSTATE_PREPARING
+	PREP_FETCHING = "fetching"
+	PREP_SLICING = "slicing"
+	PREP_SELECTING = "selecting"
+	PREP_PRINTING = "printing"
+
+	# slicing the next job while one prints happens at this lower priority
+	PREFETCH_NICENESS = 10
+
+	# seconds between pings while the reader is in wait() on a polling
+	# transport, socket.io's default ping interval (websocket transports ping
+	# at the interval the server asks for regardless)
+	SOCKET_PING_INTERVAL = 25
+
 	def __init__(self):
 		self._serial = None
 		self._socket = None
 		self._connected = False
+		self._wakeup = threading.Event()
 		self._status_now = False
 		self._challenge = None
 		self._task_queue = Queue.Queue()
+		# socket callbacks run on the reader thread while the heartbeat builds
+		# and emits status, this covers the state both sides change: the
+		# challenge, the status baseline and the job a print command sets up
+		self._state_lock = threading.Lock()
 		self._polar_status_worker = None
-		self._upload_location = {}
+		self._polar_socket_reader = None
+		self._upload_locations = None
 		self._update_interval = 60
 		self._cloud_print = False
 		self._cloud_print_info = {}
@@ -143,6 +499,15 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		self._pstate_counter = 0
 		self._max_image_size = 150000
 		self._image_transpose = False
+		self._snapshot_pipeline = None
+		self._mjpeg_reader = None
+		self._file_cache = None
+		self._slice_cache = None
+		self._profile_store = None
+		self._layer_tracker = PolarLayerTracker()
+		self._track_layers = False
+		self._layer_snapshot_count = 0
+		self._layer_snapshot_time = 0
 		self._printer_type = None
 		self._disconnect_on_register = False
 		self._hello_sent = False
@@ -150,12 +515,34 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		self._octoprint_client = None
 		self._capabilities = None
 		self._next_pending = False
+		self._prefetch = None
 		self._print_preparer = None
+		self._abandoned_preparers = []
+		self._job_queue = Queue.Queue()
+		self._job_executor = None
+		self._prep_stage = None
+		self._prep_progress = None
+		self._prep_cancel = threading.Event()
+		self._prep_cancelled = False
+		self._preheat_targets = None
+		self._preheat_timer = None
+		self._gcode_streamer = None
+		self._gcode_index = None
+		self._timelapse_recorder = None
+		self._own_timelapse = False
+		self._held_movie_event = None
+		self._timelapse_lock = threading.Lock()
+		self._timelapse_upload_progress = None
 		self._status = None
 
-		# consider temp reads higher than this as having a target set for more
-		# frequent reports
-		self._set_temp_threshold = 50
+		# with the statusDelta capability only changed fields are emitted,
+		# with a full keyframe every so often and whenever the last emit
+		# wasn't acknowledged
+		self._status_keyframe_interval = 10
+		self._status_baseline = None
+		self._status_acked = False
+		self._status_since_keyframe = 0
+		self._status_scheduler = PolarStatusScheduler(10, 60)
 
 	##~~ SettingsPlugin mixin
 
@@ -170,7 +557,26 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			verbose=False,
 			upload_timelapse=True,
 			enable_system_commands=True,
-			next_print=True
+			next_print=True,
+			status_interval_min=10,
+			status_interval_max=60,
+			snapshot_hash_threshold=4,
+			snapshot_refresh_interval=600,
+			snapshot_from_stream=False,
+			layer_snapshots=True,
+			layer_snapshot_min_interval=10,
+			layer_snapshot_max_count=300,
+			file_cache_mb=256,
+			slice_cache_mb=256,
+			prefetch_next_print=False,
+			prefetch_rate_limit_kb=256,
+			preheat=True,
+			preheat_timeout=30 * 60,
+			stream_gcode=False,
+			stream_gcode_prefix_kb=1024,
+			stream_gcode_margin_kb=256,
+			timelapse_from_snapshots=True,
+			timelapse_framerate=12
 		)
 
 	def _update_local_settings(self):
@@ -182,8 +588,16 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 				self._settings.global_get(["webcam", "flipV"]) or
 				self._settings.global_get(["webcam", "rotate90"]))
 		self._snapshot_url = self._settings.global_get(["webcam", "snapshot"])
+		self._update_mjpeg_reader()
+		if self._file_cache:
+			self._file_cache.set_max_bytes(self._settings.get_int(['file_cache_mb']) * 1024 * 1024)
+		if self._slice_cache:
+			self._slice_cache.set_max_bytes(self._settings.get_int(['slice_cache_mb']) * 1024 * 1024)
+		self._status_scheduler.set_limits(self._settings.get_int(['status_interval_min']),
+				self._settings.get_int(['status_interval_max']))
 		if self._socket and self._hello_sent:
-			self._task_queue.put(self._custom_command_list)
+			self._queue_task(self._custom_command_list)
+			self._queue_task(self._send_capabilities)
 
 	##~~ AssetPlugin mixin
 
@@ -223,6 +637,13 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			self._logger.setLevel(logging.DEBUG)
 		self._logger.debug("on_after_startup")
 		self._get_keys()
+		self._file_cache = PolarFileCache(os.path.join(self.get_plugin_data_folder(), "cache", "files"),
+				self._settings.get_int(['file_cache_mb']) * 1024 * 1024, self._logger)
+		self._slice_cache = PolarSliceCache(os.path.join(self.get_plugin_data_folder(), "cache", "slices"),
+				self._settings.get_int(['slice_cache_mb']) * 1024 * 1024, self._logger)
+		self._upload_locations = PolarUploadLocations(self._request_upload_url, self._logger)
+		self._snapshot_pipeline = PolarSnapshotPipeline(self._logger)
+		self._snapshot_pipeline.start()
 		self._update_local_settings()
 		if self._serial:
 			self._start_polar_status()
@@ -235,6 +656,22 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		else:
 			return '0'
 
+	# setting _status_now (or queueing a task) wakes the heartbeat thread right
+	# away rather than on its next timeout
+	@property
+	def _status_now(self):
+		return self._status_requested
+
+	@_status_now.setter
+	def _status_now(self, value):
+		self._status_requested = value
+		if value:
+			self._wakeup.set()
+
+	def _queue_task(self, task):
+		self._task_queue.put(task)
+		self._wakeup.set()
+
 	def _valid_packet(self, data):
 		if not self._serial or self._serial != data.get("serialNumber", ""):
 			self._logger.debug("Serial number is '{}'".format(repr(self._serial)))
@@ -252,7 +689,10 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			self._challenge = None
 			self._connected = True
 			self._hello_sent = False
-			self._socket = SocketIO(self._settings.get(['service']), Namespace=LoggingNamespace, verify=True, wait_for_connection=False)
+			self._capabilities = None
+			self._status_baseline = None
+			self._socket = SocketIO(self._settings.get(['service']), Namespace=LoggingNamespace, verify=True, wait_for_connection=False,
+					hurry_interval_in_seconds=self.SOCKET_PING_INTERVAL)
 		except (TimeoutError, ConnectionError, StopIteration):
 			self._socket = None
 			self._logger.exception('Unable to open socket {}'.format(get_exception_string()))
@@ -268,11 +708,47 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		self._socket.on('command', self._on_command)
 		self._socket.on('pause', self._on_pause)
 		self._socket.on('print', self._on_print)
+		self._socket.on('nextPrint', self._on_next_print)
 		self._socket.on('resume', self._on_resume)
 		self._socket.on('temperature', self._on_temperature)
 		self._socket.on('update', self._on_update)
 		self._socket.on('connectPrinter', self._on_connect_printer)
 		self._socket.on('customCommand', self._on_custom_command)
+		self._start_socket_reader()
+
+	# the socket.io client only dispatches events while inside wait(), so give
+	# it a thread of its own and let the heartbeat sleep on _wakeup instead;
+	# inside wait() the websocket recv still times out every second (the
+	# client sets that itself), which costs one empty recv a second on this
+	# thread, the pings it would otherwise hurry along to unblock a long poll
+	# go out at SOCKET_PING_INTERVAL instead since nothing here needs wait()
+	# to return early
+	def _start_socket_reader(self):
+		socket = self._socket
+
+		def _read_socket():
+			try:
+				while self._socket is socket and socket.connected:
+					socket.wait(seconds=60)
+			except:
+				if self._connected and self._socket is socket:
+					self._logger.exception("socket reader exception")
+			if self._socket is socket:
+				self._connected = False
+			self._wakeup.set()
+
+		self._polar_socket_reader = threading.Thread(target=_read_socket, name="PolarCloudSocketReader")
+		self._polar_socket_reader.daemon = True
+		self._polar_socket_reader.start()
+
+	def _close_socket(self):
+		socket = self._socket
+		self._socket = None
+		if socket:
+			try:
+				socket.disconnect()
+			except:
+				self._logger.debug("Error closing socket: {}".format(get_exception_string()))
 
 	def _start_polar_status(self):
 		if self._polar_status_worker:
@@ -359,7 +835,7 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			if self._pstate_counter:
 				if self._next_pending and self._pstate == self.PSTATE_COMPLETE:
 					self._next_pending = False
-					self._task_queue.put(self._send_next_print)
+					self._queue_task(self._send_next_print)
 				# if we've got a counter, we're still repeating completion/cancel
 				# message, do that
 				self._pstate_counter -= 1
@@ -381,6 +857,9 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			# if we were ever printing, we owe a "job" completion message
 			self._job_pending = True
 		if self._cloud_print:
+			if self._preparing():
+				# downloading or slicing, octoprint doesn't know about it yet
+				return self.PSTATE_PREPARING
 			if state == self.PSTATE_IDLE and self._pstate == self.PSTATE_PREPARING:
 				# octoprint thinks were idle, but we must be slicing
 				return self._pstate
@@ -416,22 +895,15 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			"sliceDetails": "",  # Cura_SteamEngine output
 			"securityCode": ""   # three colors
 		}
-		target_set = False
 		if 'tool0' in temps:
 			status['tool0'] = temps['tool0']['actual']
 			status['targetTool0'] = temps['tool0']['target']
-			if status['targetTool0'] > 0 or status['tool0'] > self._set_temp_threshold:
-				target_set = True
 		if 'tool1' in temps and not (temps['tool1']['actual'] == -1 and temps['tool1']['target'] == 0):
 			status['tool1'] = temps['tool1']['actual']
 			status['targetTool1'] = temps['tool1']['target']
-			if status['targetTool1'] > 0 or status['tool1'] > self._set_temp_threshold:
-				target_set = True
 		if 'bed' in temps and not (temps['bed']['actual'] == -1 and temps['bed']['target'] == 0):
 			status['bed'] = temps['bed']['actual']
 			status['targetBed'] = temps['bed']['target']
-			if status['targetBed'] > 0 or status['bed'] > self._set_temp_threshold:
-				target_set = True
 
 		if self._printer.is_printing() or self._printer.is_paused():
 			data = self._printer.get_current_data()
@@ -448,33 +920,61 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			status["bytesRead"] = str_safe_get(data, "progress", "filepos")
 			status["fileSize"] = str_safe_get(data, "job", "file", "size")
 
-		return status, target_set
+			index = self._gcode_index if self._cloud_print else None
+			if index and index.complete:
+				filepos = int(float_safe_get(data, "progress", "filepos"))
+				seconds_done, filament_done = index.at(filepos)
+				remaining = index.total_seconds - seconds_done
+				elapsed = float_safe_get(data, "progress", "printTime")
+				if elapsed and seconds_done > 60:
+					# our estimate ignores acceleration, scale it by how
+					# it has done so far
+					remaining *= elapsed / seconds_done
+				status["estimatedTime"] = str(int(elapsed + remaining))
+				status["filamentUsed"] = filament_done
+				status["progressDetail"] += " Layer: {}/{}".format(index.layer_at(filepos), index.layer_count)
+		elif self._cloud_print and self._preparing():
+			status["progress"] = "Preparing"
+			status["progressDetail"] = self._preparation_detail()
+		elif self._cloud_print and self._timelapse_upload_progress:
+			sent, total = self._timelapse_upload_progress
+			status["progress"] = "Uploading"
+			status["progressDetail"] = "Uploading timelapse: {:0.1f}%".format(100.0 * sent / total if total else 0)
+
+		return status
 
 	# thread to update the polar cloud with current status periodically
 	def _polar_status_heartbeat(self):
 
+		# sleep until the timeout, a queued task, a status request or a
+		# disconnect, whichever comes first
 		def _wait_and_process(seconds, ignore_status_now=False):
+			deadline = time() + seconds
 			try:
-				for i in range(seconds):
-					if not self._task_queue.empty():
+				while True:
+					# clear before checking so a set() from here on isn't lost
+					self._wakeup.clear()
+					while True:
 						try:
 							task = self._task_queue.get_nowait()
-							task()
 						except Queue.Empty:
-							pass
+							break
+						task()
+					if not self._connected:
+						self._close_socket()
+						return False
 					if not ignore_status_now and self._status_now:
 						self._status_now = False
 						self._logger.debug("_status_now break")
 						return False
-					self._socket.wait(seconds=1)
-					if not self._connected:
-						self._socket = None
-						return False
-				return True
+					remaining = deadline - time()
+					if remaining <= 0:
+						return True
+					self._wakeup.wait(remaining)
 			except:
 				if not self._connected:
 					# likely throw from disconnect
-					self._socket = None
+					self._close_socket()
 				else:
 					self._logger.exception("polar_heartbeat exception")
 					sleep(5)
@@ -509,28 +1009,24 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 				self._status_now = False
 				_wait_and_process(5, True)
 				if self._socket:
-					self._ensure_upload_url('idle')
+					self._refresh_upload_urls()
 					self._custom_command_list()
 					self._send_capabilities()
 				skip_snapshot = False
 
 				while self._connected:
-					status, target_set = self._current_status()
-					self._status = status
-					self._logger.debug("emit status: {}".format(repr(status)))
-					self._socket.emit("status", status)
+					with self._state_lock:
+						status = self._current_status()
+					self._emit_status(status)
 					status_sent += 1
+					self._refresh_upload_urls()
 
 					if datetime.datetime.now() > next_check_versions:
 						self._check_versions()
 						next_check_versions = datetime.datetime.now() + datetime.timedelta(days=1)
 
-					# reset update interval to slow if we're not printing anymore
-					# we do it here so we get one quick update when it changes
-					if target_set:
-						self._update_interval = 10
-					elif not self._cloud_print and not self._printer.is_printing():
-						self._update_interval = 60
+					# pick the next interval from how fast things are changing
+					self._update_interval = self._status_scheduler.next_interval(status, time())
 
 					if _wait_and_process(self._update_interval):
 						if self._printer.is_closed_or_error() and not self._printer.is_error():
@@ -539,39 +1035,179 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 							skip_snapshot = True
 						else:
 							skip_snapshot = False
-						self._upload_snapshot()
+						# while printing, layer changes trigger the snapshots
+						if not self._layer_snapshots_active():
+							self._upload_snapshot()
 
 				self._logger.info("Socket disconnected, clear and restart")
 				if status_sent < 3 and not self._disconnect_on_register:
 					self._logger.warn("Unable to connect to Polar Cloud")
 					break
-				self._socket = None
+				self._close_socket()
 				self._logger.debug("bottom of forever")
 
 		except:
 			self._logger.exception("heartbeat failure")
 			return
 
+	def _emit_status(self, status):
+		self._status = status
+		if not self._capabilities or not 'statusDelta' in self._capabilities:
+			self._logger.debug("emit status: {}".format(repr(status)))
+			self._socket.emit("status", status)
+			return
+
+		with self._state_lock:
+			baseline = self._status_baseline
+			if (not baseline or not self._status_acked or
+					self._status_since_keyframe >= self._status_keyframe_interval or
+					any(key not in status for key in baseline)):
+				payload = dict(status)
+				payload["keyframe"] = True
+				self._status_since_keyframe = 0
+			else:
+				payload = dict((key, value) for key, value in status.items() if baseline.get(key) != value)
+				payload["serialNumber"] = self._serial
+				payload["keyframe"] = False
+				self._status_since_keyframe += 1
+
+			self._status_baseline = status
+			self._status_acked = False
+		self._logger.debug("emit status: {}".format(repr(payload)))
+		self._socket.emit("status", payload, lambda *args: self._on_status_ack(status))
+
+	def _on_status_ack(self, status):
+		# only the most recent emit counts, an ack for an older one doesn't
+		# tell us the server has what we're diffing against
+		with self._state_lock:
+			if status is self._status_baseline:
+				self._status_acked = True
+
 	def _on_disconnect(self):
 		self._logger.debug("[Disconnected]")
 		self._connected = False
+		self._wakeup.set()
 
 	#~~ time-lapse and snapshots to cloud
 
-	def _create_timelapse(self):
-		# TODO figure out how to timebox/sizebox the timelapse
-		'gst-launch-1.0 qtmux name=mux ! filesink location="$ARG2"  multifilesrc location="$ARG1" index=1 caps="image/jpeg,framerate=\(fraction\)12/1" ! jpegdec ! videoconvert ! videorate ! x264enc ! mux .'
+	# record the cloud print's own timelapse from the snapshots we send, so
+	# it's ready moments after the print is rather than after OctoPrint's
+	# movie has been rendered and then converted
+	def _start_timelapse_recorder(self):
+		# anything left over is from the last print, don't fall back on that
+		with self._timelapse_lock:
+			self._own_timelapse = False
+			self._held_movie_event = None
+		self._abort_timelapse_recorder()
+		if not self._cloud_print or not self._snapshot_url:
+			return
+		if not self._settings.get_boolean(['upload_timelapse']) or not self._settings.get_boolean(['timelapse_from_snapshots']):
+			return
+		folder = os.path.join(self.get_plugin_data_folder(), "timelapse")
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		# the last print's movie has been uploaded (or never will be) by now
+		for name in os.listdir(folder):
+			remove_quietly(os.path.join(folder, name))
+		self._timelapse_recorder = PolarTimelapseRecorder(
+				os.path.join(folder, "{}.mp4".format(self._job_id)), self._logger,
+				self._settings.get_int(['timelapse_framerate']))
+		self._own_timelapse = True
+
+	def _abort_timelapse_recorder(self):
+		if self._timelapse_recorder:
+			self._timelapse_recorder.abort()
+			self._timelapse_recorder = None
+			self._fall_back_to_octoprint_timelapse()
+
+	def _finish_timelapse_recorder(self):
+		recorder = self._timelapse_recorder
+		self._timelapse_recorder = None
+		if not recorder.recording:
+			self._logger.info("Nothing recorded for the timelapse, using OctoPrint's")
+			recorder.abort()
+			self._fall_back_to_octoprint_timelapse()
+			return
+		recorder.finish(self._on_timelapse_recorded)
+
+	# while we're recording our own timelapse, OctoPrint's movie events are
+	# held back in case ours fails to finish
+	def _hold_movie_event(self, event, payload):
+		with self._timelapse_lock:
+			if not self._own_timelapse:
+				return False
+			self._held_movie_event = (event, payload)
+			return True
+
+	# our own recording didn't work out, so OctoPrint's movie events count
+	# again, including one that came in while we were still finishing ours
+	def _fall_back_to_octoprint_timelapse(self):
+		with self._timelapse_lock:
+			if not self._own_timelapse:
+				return
+			self._own_timelapse = False
+			held = self._held_movie_event
+			self._held_movie_event = None
+		if held:
+			self.on_event(*held)
+		elif self._pstate == self.PSTATE_POSTPROCESSING:
+			# there may not be a movie coming, don't wait on it forever
+			self._pstate_counter = 3
+			self._status_now = True
+
+	def _on_timelapse_recorded(self, path):
+		if not path:
+			self._fall_back_to_octoprint_timelapse()
+			return
+		# the encoder didn't know how long the print would be, so if we went
+		# over the budget, convert it down to size
+		max_size = self._timelapse_max_size()
+		if max_size and os.path.getsize(path) > max_size:
+			PolarTimelapseTranscoder(path, self._upload_timelapse, self._logger,
+					self._timelapse_max_size).translate_timelapse()
+		else:
+			self._upload_timelapse(path)
 
-	def _ensure_upload_url(self, upload_type):
+	# the upload url for upload_type ('idle' urls aren't tied to a job,
+	# 'printing' and 'timelapse' ones are for the current cloud job), waiting
+	# up to timeout seconds for the cloud to send one if we don't have it,
+	# None if it doesn't arrive in time
+	def _wait_for_upload_url(self, upload_type, timeout=30):
 		if not self._snapshot_url:
-			return False
-		if upload_type != 'idle' and upload_type in self._upload_location and self._upload_location[upload_type]['jobID'] != self._job_id:
-			self._logger.debug("Discarding old upload url: {} for {}".format(upload_type, self._upload_location[upload_type]['jobID']))
-			del self._upload_location[upload_type]
-		if not upload_type in self._upload_location or datetime.datetime.now() > self._upload_location[upload_type]['expires']:
-			self._get_url(upload_type, self._get_job_id() if upload_type == 'idle' else self._job_id)
-			return False
-		return True
+			return None
+		job_id = None if upload_type == 'idle' else self._job_id
+		return self._upload_locations.wait(upload_type, job_id, timeout)
+
+	# ask ahead for the urls we're going to want so they're there (and
+	# current) by the time we want them
+	def _refresh_upload_urls(self):
+		if not self._snapshot_url or not self._socket:
+			return
+		wanted = [('idle', None)]
+		if self._cloud_print and self._job_id != '123':
+			wanted.append(('printing', self._job_id))
+			if self._settings.get_boolean(['upload_timelapse']):
+				wanted.append(('timelapse', self._job_id))
+		self._upload_locations.refresh(wanted)
+
+	def _request_upload_url(self, upload_type, job_id):
+		if self._socket:
+			self._get_url(upload_type, self._get_job_id() if job_id is None else job_id)
+
+	# optionally keep one connection open to the webcam stream and take
+	# snapshots from the latest frame rather than a new request each time
+	def _update_mjpeg_reader(self):
+		stream_url = None
+		if self._settings.get_boolean(['snapshot_from_stream']):
+			stream_url = stream_url_for_snapshot(self._snapshot_url, self._settings.global_get(["webcam", "stream"]))
+			if not stream_url:
+				self._logger.warn("Unable to determine the webcam stream url, taking snapshots one at a time")
+		if self._mjpeg_reader and self._mjpeg_reader.url != stream_url:
+			self._mjpeg_reader.stop()
+			self._mjpeg_reader = None
+		if stream_url and not self._mjpeg_reader:
+			self._mjpeg_reader = PolarMjpegReader(stream_url, self._logger)
+			self._mjpeg_reader.start()
 
 	def _upload_snapshot(self):
 		self._logger.debug("_upload_snapshot")
@@ -579,66 +1215,87 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		if self._cloud_print and self._job_id != '123' and (self._printer.is_printing() or self._printer.is_paused()):
 			upload_type = 'printing'
 		self._logger.debug("upload_type {}".format(upload_type))
-		if not self._ensure_upload_url(upload_type):
-			return
-		try:
-			loc = self._upload_location[upload_type]
-			r = requests.get(self._snapshot_url, timeout=5)
-			r.raise_for_status()
-		except Exception:
-			self._logger.exception("Could not capture image from {}".format(self._snapshot_url))
+		if not self._snapshot_url:
 			return
 
-		try:
-			image_bytes = r.content
-			image_size = len(image_bytes)
-			if self._image_transpose or image_size > self._max_image_size:
-				self._logger.debug("Recompressing snapshot to smaller size")
-				buf = StringIO()
-				buf.write(image_bytes)
-				image = Image.open(buf)
-				image.thumbnail((640, 480))
-				if self._settings.global_get(["webcam", "flipH"]):
-					image = image.transpose(Image.FLIP_LEFT_RIGHT)
-				if self._settings.global_get(["webcam", "flipV"]):
-					image = image.transpose(Image.FLIP_TOP_BOTTOM)
-				if self._settings.global_get(["webcam", "rotate90"]):
-					image = image.transpose(Image.ROTATE_90)
-				image_bytes = StringIO()
-				image.save(image_bytes, format="jpeg")
-				image_bytes.seek(0, 2)
-				new_image_size = image_bytes.tell()
-				image_bytes.seek(0)
-				self._logger.debug("Image transcoded from size {} to {}".format(image_size, new_image_size))
-				image_size = new_image_size
-			if image_size == 0:
-				self._logger.debug("Image content is length 0 from {}, not uploading to PolarCloud".format(self._snapshot_url))
-				return
-			p = requests.post(loc['url'], data=loc['fields'], files={'file': ('image.jpg', image_bytes)})
-			p.raise_for_status()
-			self._logger.debug("{}: {}".format(p.status_code, p.content))
-
-			self._logger.debug("Image captured from {}".format(self._snapshot_url))
-		except Exception:
-			self._logger.exception("Could not post snapshot to PolarCloud")
+		# capture, transcode and upload happen on the snapshot pipeline so
+		# that a slow camera or uplink (or waiting for an upload url) doesn't
+		# hold up the heartbeat
+		if not self._snapshot_pipeline:
+			return
+		job_id = None if upload_type == 'idle' else self._job_id
+		self._snapshot_pipeline.submit({
+			'snapshot_url': self._snapshot_url,
+			'stream_reader': self._mjpeg_reader,
+			'upload_type': upload_type,
+			'location': lambda: self._upload_locations.wait(upload_type, job_id, 30),
+			'hash_threshold': self._settings.get_int(['snapshot_hash_threshold']),
+			'refresh_interval': self._settings.get_int(['snapshot_refresh_interval']),
+			'max_image_size': self._max_image_size,
+			'transpose': self._image_transpose,
+			'flipH': self._settings.global_get(["webcam", "flipH"]),
+			'flipV': self._settings.global_get(["webcam", "flipV"]),
+			'rotate90': self._settings.global_get(["webcam", "rotate90"]),
+			'frame_callback': self._timelapse_recorder.add_frame if upload_type == 'printing' and self._timelapse_recorder else None
+		})
 
 	def _upload_timelapse(self, path):
 		self._logger.debug("_upload_timelapse")
-		self._pstate = self.PSTATE_COMPLETE
-		self._pstate_counter = 3
-		if not path:
-			return
-		if not self._ensure_upload_url('timelapse'):
-			self._logger.error("Unable to retrieve valid destination to upload timelapse {}".format(path))
-			return
 		try:
-			self._logger.debug("Uploading timelapse {}".format(path))
-			loc = self._upload_location['timelapse']
-			p = requests.post(loc['url'], data=loc['fields'], files={'file': ('timelapse.mp4', open(path, 'rb'))})
-			p.raise_for_status()
-			self._logger.debug("timelapse upload result {}: {}".format(p.status_code, p.content))
+			if path:
+				self._upload_timelapse_file(path)
 		except Exception:
 			self._logger.exception("Could not upload timelapse {} to PolarCloud".format(path))
+		finally:
+			self._timelapse_upload_progress = None
+			self._pstate = self.PSTATE_COMPLETE
+			self._pstate_counter = 3
+			self._status_now = True
+
+	# streams the file up, retrying with backoff when the connection fails and
+	# asking for a fresh url when the one we have is refused (expired)
+	def _upload_timelapse_file(self, path, retries=5):
+		attempt = 0
+		while True:
+			loc = self._wait_for_upload_url('timelapse')
+			if not loc:
+				self._logger.warn("No upload url for timelapse {} yet".format(path))
+			else:
+				try:
+					self._logger.debug("Uploading timelapse {}".format(path))
+					body = PolarMultipartFile(loc['fields'], 'file', 'timelapse.mp4', path,
+							progress_callback=self._on_timelapse_upload_progress)
+					try:
+						p = requests.post(loc['url'], data=body, headers={'Content-Type': body.content_type},
+								timeout=(10, 60))
+					finally:
+						body.close()
+					p.raise_for_status()
+					self._logger.debug("timelapse upload result {}: {}".format(p.status_code, p.content))
+					return True
+				except requests.HTTPError as e:
+					self._logger.warn("Timelapse upload refused: {}".format(e))
+					if e.response is not None and 400 <= e.response.status_code < 500:
+						self._upload_locations.discard('timelapse')
+				except (requests.ConnectionError, requests.Timeout) as e:
+					self._logger.warn("Timelapse upload interrupted: {}".format(e))
+
+			attempt += 1
+			if attempt > retries:
+				self._logger.error("Unable to upload timelapse {} after {} attempts".format(path, attempt))
+				return False
+			delay = min(2 ** attempt, 60)
+			self._logger.info("Retrying timelapse upload in {} seconds".format(delay))
+			sleep(delay)
+
+	def _on_timelapse_upload_progress(self, sent, total):
+		self._timelapse_upload_progress = (sent, total)
+
+	def _timelapse_max_size(self):
+		loc = self._wait_for_upload_url('timelapse')
+		if loc and loc.get('maxSize'):
+			return int(loc['maxSize'])
+		return None
 
 	#~~ getUrl -> polar: getUrlResponse
 
@@ -655,13 +1312,10 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			return
 		if not has_all(response, 'type', 'expires', 'url', 'maxSize', 'fields'):
 			self._logger.warn('getUrlResponse lacks a required property')
-		response["expires"] = (datetime.datetime.now() + datetime.timedelta(seconds=int(response.get("expires", 0))))
-		if not has_all(response, 'jobID'):
-			response["jobID"] = self._job_id
-		self._upload_location[response.get('type', 'idle')] = response
+		response["lifetime"] = int(response.get("expires", 0))
+		response["expires"] = (datetime.datetime.now() + datetime.timedelta(seconds=response["lifetime"]))
 		self._logger.debug('response_type = {}'.format(response.get('type', '')))
-		if response.get('type', '') == 'idle':
-			self._task_queue.put(self._upload_snapshot)
+		self._upload_locations.put(response)
 
 	# get upload url from the cloud
 	# url_type - 'idle' | 'printing' | 'timelapse'
@@ -681,14 +1335,21 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 	def _on_welcome(self, welcome, *args, **kwargs):
 		self._logger.debug('_on_welcome: {}'.format(repr(welcome)))
 		if 'challenge' in welcome:
-			self._challenge = welcome['challenge']
-			if isinstance(self._challenge, unicode):
-				self._challenge = self._challenge.encode('utf-8')
-			self._task_queue.put(self._hello)
+			challenge = welcome['challenge']
+			if isinstance(challenge, unicode):
+				challenge = challenge.encode('utf-8')
+			with self._state_lock:
+				self._challenge = challenge
+			self._queue_task(self._hello)
 
 	def _hello(self):
 		self._logger.debug('hello')
-		if self._serial and self._challenge:
+		# a welcome that comes in while we answer this one gets its own hello
+		with self._state_lock:
+			challenge = self._challenge if self._serial else None
+			if challenge:
+				self._challenge = None
+		if challenge:
 			self._hello_sent = True
 			self._status_now = True
 			self._logger.debug('emit hello')
@@ -709,7 +1370,7 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 				transformImg += 4
 			self._socket.emit('hello', {
 				'serialNumber': self._serial,
-				'signature': base64.b64encode(crypto.sign(self._key, self._challenge, b'sha256')),
+				'signature': base64.b64encode(crypto.sign(self._key, challenge, b'sha256')),
 				'MAC': get_mac(),
 				'localIP': get_ip(),
 				'protocol': '2',
@@ -717,7 +1378,6 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 				'transformImg': transformImg,
 				'printerType': self._printer_type
 			})
-			self._challenge = None
 		else:
 			self._logger.debug('skip emit hello, serial: {}'.format(self._serial))
 
@@ -729,8 +1389,12 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			self._capabilities = response['capabilities']
 
 	def _send_capabilities(self):
+		capabilities = ['statusDelta']
+		if self._settings.get_boolean(['prefetch_next_print']):
+			capabilities.append('prefetchNextPrint')
 		self._socket.emit('capabilities', {
 			'serialNumber': self._serial,
+			'capabilities': capabilities
 		})
 
 	def _send_next_print(self):
@@ -808,7 +1472,10 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 	def _on_cancel(self, data, *args, **kwargs):
 		if not self._valid_packet(data):
 			return
-		self._printer.cancel_print()
+		if self._preparing():
+			self._cancel_preparation()
+		else:
+			self._printer.cancel_print()
 		self._status_now = True
 
 	#~~ command
@@ -845,101 +1512,605 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		self._logger.debug("on_print {0}".format(repr(data)))
 		if not self._valid_packet(data):
 			return
-		if self._print_preparer and self._print_preparer.is_alive():
-			self._logger.warn("PolarCloud sent a print command, but the plugin thinks we're still slicing.")
+		if self._preparing():
+			self._logger.warn("PolarCloud sent a print command, but the plugin is still preparing the last one.")
 			return
 
 		if self._printer.is_printing() or self._printer.is_paused():
 			self._logger.warn("PolarCloud sent print command, but OctoPrint is already printing.")
 			return
 
-		self._job_id = "123"
-		gcode = False
-		print_file = ''
-		if 'gcodeFile' in data:
-			gcode = True
-			print_file = data['gcodeFile']
-		elif 'stlFile' in data:
-			print_file = data['stlFile']
-		else:
+		if not 'gcodeFile' in data and not 'stlFile' in data:
 			self._logger.warn("PolarCloud sent print command without a print file path.")
 			return
+		if not 'gcodeFile' in data and not 'configFile' in data:
+			self._logger.warn("PolarCloud sent print command without slicing profile.")
+			return
 
-		info = {}
-		pos = (0, 0)
-		slicer = 'cura'
+		job_id = data['jobId'] if 'jobId' in data else "123"
+		self._logger.debug("print jobId is {}".format(job_id))
+		# all at once, so a status in between doesn't mix the old job's state
+		# in with the new one (or count _cloud_print back off)
+		with self._state_lock:
+			self._cloud_print = True
+			self._job_pending = True
+			self._job_id = job_id
+			self._pstate_counter = 0
+			self._pstate = self.PSTATE_PREPARING
+			self._cloud_print_info = {}
+			self._gcode_index = None
+
+			# downloading and slicing block for a long time, so leave them to the
+			# job executor and get back to handling socket events
+			self._prep_cancel = threading.Event()
+			self._prep_cancelled = False
+			self._set_prep_stage(self.PREP_FETCHING)
+		self._job_queue.put((data, self._prep_cancel))
+		self._start_job_executor()
+
+	#~~ print preparation (fetching -> slicing -> selecting -> printing)
+
+	def _start_job_executor(self):
+		if not self._job_executor or not self._job_executor.is_alive():
+			self._job_executor = threading.Thread(target=self._job_executor_worker, name="PolarCloudJobExecutor")
+			self._job_executor.daemon = True
+			self._job_executor.start()
+
+	def _job_executor_worker(self):
+		while True:
+			data, cancel_event = self._job_queue.get()
+			try:
+				self._prepare_print(data, cancel_event)
+			except:
+				self._logger.exception("Unable to prepare print job {}".format(self._job_id))
+				self._preparation_failed(self.PSTATE_ERROR)
+
+	def _preparing(self):
+		return self._prep_stage in (self.PREP_FETCHING, self.PREP_SLICING, self.PREP_SELECTING)
+
+	def _set_prep_stage(self, stage):
+		self._logger.debug("print preparation stage: {}".format(stage))
+		self._prep_stage = stage
+		self._prep_progress = None
+		self._status_now = True
+
+	def _on_download_progress(self, received, total):
+		self._prep_progress = (received, total)
+
+	def _preparation_detail(self):
+		if self._prep_stage == self.PREP_FETCHING:
+			received, total = self._prep_progress or (0, None)
+			if total:
+				return "Downloading print file: {:0.1f}%".format(100.0 * received / total)
+			return "Downloading print file: {} bytes".format(received)
+		if self._prep_stage == self.PREP_SLICING:
+			return "Slicing"
+		return "Starting print"
+
+	def _cancel_preparation(self):
+		self._logger.info("Cancelling preparation of job {} while {}".format(self._job_id, self._prep_stage))
+		self._prep_cancelled = True
+		self._prep_cancel.set()
+		preparer = self._print_preparer
+		if preparer:
+			# the slicer runs to completion regardless, so the job is done as
+			# far as the cloud is concerned and its result is ignored
+			self._abandon_preparer(preparer)
+			self._preparation_failed(self.PSTATE_CANCELLING)
+
+	def _abandon_preparer(self, preparer):
+		preparer.cancel()
+		self._abandoned_preparers.append(preparer)
+
+	# a cancelled slice still writes its output when it finishes, so don't
+	# start on the next job's files until it has
+	def _wait_for_abandoned_slicing(self, cancel_event):
+		while self._abandoned_preparers:
+			preparer = self._abandoned_preparers[0]
+			if not preparer.wait(1):
+				if cancel_event.is_set():
+					return False
+				continue
+			try:
+				self._abandoned_preparers.remove(preparer)
+			except ValueError:
+				# the prefetch thread got there first
+				pass
+		return True
+
+	def _preparation_failed(self, pstate):
+		self._cool_down_preheat()
+		self._stop_gcode_streamer()
+		self._prep_stage = None
+		self._print_preparer = None
+		self._pstate = pstate
+		self._pstate_counter = 3
+		if self._job_pending and self._socket:
+			self._job(self._job_id, "canceled")
+		self._status_now = True
+
+	def _prepare_print(self, data, cancel_event):
+		gcode = 'gcodeFile' in data
+		info = {'file': data['gcodeFile'] if gcode else data['stlFile']}
 		if not gcode:
-			# need to slice then, so make sure we're set up to do that
-			if not 'configFile' in data:
-				self._logger.warn("PolarCloud sent print command without slicing profile.")
-				return
 			info['config'] = data['configFile']
-			try:
-				req_ini = requests.get(data['configFile'], timeout=5)
-				req_ini.raise_for_status()
-			except Exception:
-				self._logger.exception("Could not retrieve slicer config file from PolarCloud: {}".format(data['configFile']))
-				return
-			slicer = self._get_slicer_name()
-			(slicing_profile, pos) = self._create_slicing_profile(slicer, req_ini.content)
-			if not slicing_profile:
-				self._logger.warn("Unable to create slicing profile. Aborting slice and print.")
-				return
+		self._cloud_print_info = info
+		self._logger.debug("print data is {}".format(repr(data)))
 
-		# TODO: use tornado async I/O to get the print file?
-		try:
-			info['file'] = print_file
-			req_stl = requests.get(print_file, timeout=5)
-			req_stl.raise_for_status()
-		except Exception:
-			self._logger.exception("Could not retrieve print file from PolarCloud: {}".format(print_file))
+		if not self._wait_for_abandoned_slicing(cancel_event):
+			self._preparation_failed(self.PSTATE_CANCELLING)
 			return
 
-		path = self._file_manager.add_folder(FileDestinations.LOCAL, "polarcloud")
-		path = self._file_manager.join_path(FileDestinations.LOCAL, path, "current-print")
-		pathGcode = path + ".gcode"
-		path = path + (".gcode" if gcode else ".stl")
-		self._file_manager.add_file(FileDestinations.LOCAL, path, StreamWrapper(path, io.BytesIO(req_stl.content)), allow_overwrite=True)
-		job_id = data['jobId'] if 'jobId' in data else "123"
-		self._logger.debug("print jobId is {}".format(job_id))
-		self._logger.debug("print data is {}".format(repr(data)))
+		files = self._take_prefetched(data)
+		if not files and gcode and self._settings.get_boolean(['stream_gcode']):
+			files = self._stream_print_file(data['gcodeFile'], cancel_event)
+		elif not files:
+			files = self._fetch_print_files(data, "current-print", cancel_event,
+					progress_callback=self._on_download_progress,
+					temperatures_callback=self._preheat)
+		if not files:
+			if self._prep_cancelled:
+				self._preparation_failed(self.PSTATE_CANCELLING)
+			else:
+				self._logger.warn("Unable to retrieve print or slicing profile. Aborting slice and print.")
+				self._preparation_failed(self.PSTATE_ERROR)
+			return
 
 		if self._printer.is_closed_or_error():
 			self._printer.disconnect()
 			self._printer.connect()
 
-		self._cloud_print = True
-		self._job_pending = True
-		self._job_id = job_id
-		self._pstate_counter = 0
-		self._pstate = self.PSTATE_PREPARING
-		self._cloud_print_info = info
-		self._status_now = True
+		if cancel_event.is_set():
+			self._logger.info("Print preparation cancelled by PolarCloud")
+			self._preparation_failed(self.PSTATE_CANCELLING)
+			return
 
-		if not gcode:
+		if not files['gcode']:
 			# prepare the gcode file by slicing
-			self._print_preparer = PolarPrintPreparer(slicer,
-					self._file_manager, path, pathGcode, pos,
+			self._set_prep_stage(self.PREP_SLICING)
+			self._print_preparer = PolarPrintPreparer(files['slicer'], files['profile'],
+					self._file_manager, files['path'], files['pathGcode'], files['pos'],
 					self._on_slicing_complete, self._on_slicing_failed,
-					self._logger)
+					self._logger, self._slice_cache, files['slice_key'])
 			self._print_preparer.prepare()
 		else:
-			self._on_slicing_complete(self._file_manager.path_on_disk(FileDestinations.LOCAL, path))
+			self._on_slicing_complete(self._file_manager.path_on_disk(FileDestinations.LOCAL, files['path']))
+
+	# starts downloading a gcode file straight to polarcloud/current-print.gcode
+	# and returns as soon as there's enough of it to start printing, from there
+	# the PolarGcodeStreamer keeps the print from overtaking the download
+	def _stream_print_file(self, print_file, cancel_event):
+		folder = self._file_manager.add_folder(FileDestinations.LOCAL, "polarcloud")
+		folder_on_disk = self._file_manager.path_on_disk(FileDestinations.LOCAL, folder)
+		path = self._file_manager.join_path(FileDestinations.LOCAL, folder, "current-print.gcode")
+		fd, download_path = tempfile.mkstemp(prefix=".current-print-", suffix=".part", dir=folder_on_disk)
+		os.close(fd)
+
+		streamer = PolarGcodeStreamer(print_file, download_path, self._printer, self._logger,
+				self._settings.get_int(['stream_gcode_margin_kb']) * 1024,
+				cancel_event, self._on_download_progress)
+		streamer.start()
+		if not streamer.wait_for_prefix(self._settings.get_int(['stream_gcode_prefix_kb']) * 1024):
+			self._logger.warn("Could not retrieve print file from PolarCloud: {} ({})".format(print_file, streamer.error))
+			streamer.cancel()
+			remove_quietly(download_path)
+			return None
 
-	def _on_slicing_failed(self, e):
-		self._logger.exception("Unable to slice.")
-		self._pstate = self.PSTATE_ERROR
-		self._pstate_counter = 3
-		self._print_preparer = None
+		# the temporary file is in the same folder, so this is a rename and
+		# the download carries on writing into the file OctoPrint prints from
+		self._file_manager.add_file(FileDestinations.LOCAL, path,
+				DiskFileWrapper(os.path.basename(path), download_path, move=True),
+				allow_overwrite=True)
+		self._logger.info("Starting print with {} bytes of {} downloaded".format(
+			streamer.bytes_received, streamer.total_size))
+		self._gcode_streamer = streamer
+		return {'gcode': True, 'path': path}
+
+	def _stop_gcode_streamer(self):
+		streamer = self._gcode_streamer
+		self._gcode_streamer = None
+		if streamer and not streamer.complete:
+			self._logger.info("Stopping the print file download")
+			streamer.cancel()
+
+	# downloads the print file in data to polarcloud/<name>.gcode or .stl
+	# (fetching the slicing profile alongside for models, or taking the
+	# sliced gcode straight from the slice cache), returns what
+	# PolarPrintPreparer needs to finish the job, None if it was cancelled or
+	# failed; temperatures_callback gets the job's heat up targets as soon as
+	# we know them
+	def _fetch_print_files(self, data, name, cancel_event, progress_callback=None, rate_limit=None,
+			temperatures_callback=None):
+		gcode = 'gcodeFile' in data
+		print_file = data['gcodeFile'] if gcode else data['stlFile']
+
+		files = {'gcode': gcode, 'slicer': 'cura', 'profile': None, 'pos': (0, 0), 'slice_key': None}
+		profile_thread = None
+		profile_result = []
+		if not gcode:
+			# fetch and translate the profile while the print file downloads
+			files['slicer'] = self._get_slicer_name()
+			profile_thread = threading.Thread(target=self._fetch_slicing_profile,
+					args=(data['configFile'], files['slicer'], cancel_event, profile_result,
+						temperatures_callback),
+					name="PolarCloudSlicingProfile")
+			profile_thread.daemon = True
+			profile_thread.start()
+		elif temperatures_callback:
+			thread = threading.Thread(target=self._fetch_gcode_temperatures,
+					args=(print_file, cancel_event, temperatures_callback),
+					name="PolarCloudGcodeHead")
+			thread.daemon = True
+			thread.start()
+
+		path = self._file_manager.add_folder(FileDestinations.LOCAL, "polarcloud")
+		folder_on_disk = self._file_manager.path_on_disk(FileDestinations.LOCAL, path)
+		path = self._file_manager.join_path(FileDestinations.LOCAL, path, name)
+		files['pathGcode'] = path + ".gcode"
+		files['path'] = path + (".gcode" if gcode else ".stl")
+
+		# stream the print file to a temporary file next to its destination so
+		# that we can move it into place without holding it in memory
+		fd, download_path = tempfile.mkstemp(prefix="." + name + "-", suffix=".part", dir=folder_on_disk)
+		os.close(fd)
+		try:
+			print_file_sha256 = self._file_cache.fetch(print_file, download_path, cancel_event,
+					progress_callback, rate_limit)
+			self._logger.debug("Retrieved {} bytes from {}".format(os.path.getsize(download_path), print_file))
+		except PolarDownloadCancelled:
+			self._logger.info("Stopped downloading {}".format(print_file))
+			remove_quietly(download_path)
+			return None
+		except Exception:
+			self._logger.exception("Could not retrieve print file from PolarCloud: {}".format(print_file))
+			cancel_event.set()
+			remove_quietly(download_path)
+			return None
+
+		if profile_thread:
+			profile_thread.join()
+			if not profile_result or not profile_result[0][0]:
+				self._logger.warn("Unable to create slicing profile for {}".format(print_file))
+				remove_quietly(download_path)
+				return None
+			(files['profile'], slicing_profile, files['pos']) = profile_result[0]
+
+		self._file_manager.add_file(FileDestinations.LOCAL, files['path'],
+				DiskFileWrapper(os.path.basename(files['path']), download_path, move=True),
+				allow_overwrite=True)
+
+		if not gcode:
+			# if we've sliced this model with these settings before, skip it
+			files['slice_key'] = PolarSliceCache.key(print_file_sha256, slicing_profile, files['slicer'], files['pos'],
+					self._printer_profile_manager.get_current_or_default())
+			fd, sliced_path = tempfile.mkstemp(prefix="." + name + "-", suffix=".part", dir=folder_on_disk)
+			os.close(fd)
+			if self._slice_cache.get(files['slice_key'], sliced_path):
+				self._logger.info("Using previously sliced gcode for {}".format(print_file))
+				self._file_manager.add_file(FileDestinations.LOCAL, files['pathGcode'],
+						DiskFileWrapper(os.path.basename(files['pathGcode']), sliced_path, move=True),
+						allow_overwrite=True)
+				files['gcode'] = True
+				files['path'] = files['pathGcode']
+			else:
+				os.remove(sliced_path)
+		return files
+
+	# indexing takes seconds for a big file (more on a Pi), so it's left until
+	# the print has been started and done off to the side, status picks the
+	# index up once it's ready; a streamed file is indexed once it's all there
+	def _analyze_gcode_in_background(self, path, streamer=None):
+		info = self._cloud_print_info
+		thread = threading.Thread(target=self._analyze_gcode_worker, args=(path, info, streamer),
+				name="PolarCloudGcodeIndex")
+		thread.daemon = True
+		thread.start()
+
+	def _analyze_gcode_worker(self, path, info, streamer):
+		if streamer and not streamer.wait():
+			return
+		if self._cloud_print_info is not info:
+			return
+		index = self._analyze_gcode(path)
+		if index and self._cloud_print_info is info:
+			self._gcode_index = index
+			self._status_now = True
+
+	def _analyze_gcode(self, path):
+		try:
+			started = time()
+			index = PolarGcodeAnalyzer.analyze_file(path)
+			self._logger.debug("Indexed {} layers of {} in {:0.1f}s".format(index.layer_count, path, time() - started))
+			return index
+		except:
+			self._logger.exception("Unable to analyze {}".format(path))
+			return None
+
+	#~~ nextPrint -> prefetch the next queued job
+
+	def _on_next_print(self, data, *args, **kwargs):
+		self._logger.debug("on_next_print {0}".format(repr(data)))
+		if not self._valid_packet(data):
+			return
+		if not self._settings.get_boolean(['prefetch_next_print']):
+			return
+		key = self._prefetch_key(data)
+		if self._prefetch and self._prefetch['key'] == key:
+			return
+		self._discard_prefetched()
+		if not key:
+			# nothing queued (anymore)
+			return
+		if not 'gcodeFile' in data and not 'configFile' in data:
+			self._logger.warn("PolarCloud sent next print without slicing profile.")
+			return
+
+		self._logger.info("Prefetching next print job {}".format(data['jobId']))
+		prefetch = {'key': key, 'cancel_event': threading.Event(), 'files': None}
+		self._prefetch = prefetch
+		thread = threading.Thread(target=self._prefetch_worker, args=(data, prefetch),
+				name="PolarCloudPrefetch")
+		thread.daemon = True
+		thread.start()
+
+	# the job and the files it refers to, without the signatures that change
+	# each time the cloud hands out a url
+	def _prefetch_key(self, data):
+		if not 'jobId' in data or not ('gcodeFile' in data or 'stlFile' in data):
+			return None
+		print_file = data['gcodeFile'] if 'gcodeFile' in data else data['stlFile']
+		config_file = data.get('configFile')
+		return (data['jobId'], PolarFileCache.key_for_url(print_file),
+				PolarFileCache.key_for_url(config_file) if config_file else None)
+
+	# downloads (throttled, so as not to starve the serial connection) and
+	# slices the next job to polarcloud/next-print.gcode, where slicing would
+	# compete with the print it stops at the download and slicing happens
+	# once the print command comes
+	def _prefetch_worker(self, data, prefetch):
+		if not self._wait_for_abandoned_slicing(prefetch['cancel_event']):
+			return
+		files = self._fetch_print_files(data, "next-print", prefetch['cancel_event'],
+				rate_limit=self._settings.get_int(['prefetch_rate_limit_kb']) * 1024)
+		if not files or prefetch['cancel_event'].is_set():
+			self._logger.info("Prefetch of job {} didn't complete".format(data['jobId']))
+			return
+		if files['gcode']:
+			self._on_prefetch_ready(prefetch, files)
+			return
+		if not self._can_slice_while_printing(files['slicer']):
+			self._logger.info("Not slicing job {} while printing, it will be sliced when it starts".format(
+				data['jobId']))
+			self._on_prefetch_ready(prefetch, files)
+			return
+
+		def on_sliced(path, *args, **kwargs):
+			files['gcode'] = True
+			files['path'] = files['pathGcode']
+			self._on_prefetch_ready(prefetch, files)
+
+		def on_failed(*args):
+			self._logger.warn("Unable to slice prefetched job {}".format(data['jobId']))
+
+		prefetch['preparer'] = PolarPrintPreparer(files['slicer'], files['profile'],
+				self._file_manager, files['path'], files['pathGcode'], files['pos'],
+				on_sliced, on_failed, self._logger, self._slice_cache, files['slice_key'],
+				niceness=self.PREFETCH_NICENESS)
+		prefetch['preparer'].prepare()
+
+	# the same rule OctoPrint uses to refuse slicing during a print (one core
+	# shared with the printer), and beyond that only where the slicer can be
+	# made to yield to the print
+	def _can_slice_while_printing(self, slicer):
+		try:
+			same_device = self._slicing_manager.get_slicer(slicer).get_slicer_properties().get("same_device", True)
+		except (UnknownSlicer, SlicerNotConfigured):
+			same_device = True
+		if not same_device:
+			return True
+		if multiprocessing.cpu_count() < 2:
+			return False
+		# os.nice elsewhere would slow down all of OctoPrint, not just slicing
+		return sys.platform.startswith("linux") and hasattr(os, "nice")
+
+	def _on_prefetch_ready(self, prefetch, files):
+		if prefetch['cancel_event'].is_set():
+			return
+		self._logger.info("Next print job {} is staged at {}".format(prefetch['key'][0], files['path']))
+		prefetch['files'] = files
+
+	def _discard_prefetched(self):
+		prefetch = self._prefetch
+		self._prefetch = None
+		if not prefetch:
+			return
+		self._logger.debug("Discarding prefetch of job {}".format(prefetch['key'][0]))
+		prefetch['cancel_event'].set()
+		if prefetch.get('preparer') and not prefetch['files']:
+			self._abandon_preparer(prefetch['preparer'])
+
+	# if the job in data is the one we've staged, move it into place as
+	# current-print.gcode and return it, otherwise drop whatever we've staged
+	def _take_prefetched(self, data):
+		prefetch = self._prefetch
+		if not prefetch or prefetch['key'] != self._prefetch_key(data) or not prefetch['files']:
+			self._discard_prefetched()
+			return None
+		self._prefetch = None
+
+		files = prefetch['files']
+		staged = files['path']
+		folder = self._file_manager.add_folder(FileDestinations.LOCAL, "polarcloud")
+		folder_on_disk = self._file_manager.path_on_disk(FileDestinations.LOCAL, folder)
+		path = self._file_manager.join_path(FileDestinations.LOCAL, folder,
+				"current-print.gcode" if files['gcode'] else "current-print.stl")
+		fd, staged_path = tempfile.mkstemp(prefix=".current-print-", suffix=".part", dir=folder_on_disk)
+		os.close(fd)
+		try:
+			link_or_copy(self._file_manager.path_on_disk(FileDestinations.LOCAL, staged), staged_path)
+			self._file_manager.remove_file(FileDestinations.LOCAL, staged)
+			self._file_manager.add_file(FileDestinations.LOCAL, path,
+					DiskFileWrapper(os.path.basename(path), staged_path, move=True),
+					allow_overwrite=True)
+		except:
+			self._logger.exception("Unable to use prefetched {}".format(staged))
+			remove_quietly(staged_path)
+			return None
+
+		if not files['gcode']:
+			# downloaded but not sliced yet
+			self._logger.info("Using prefetched model for job {}".format(prefetch['key'][0]))
+			files = dict(files)
+			files['path'] = path
+			files['pathGcode'] = self._file_manager.join_path(FileDestinations.LOCAL, folder, "current-print.gcode")
+			return files
+		self._logger.info("Using prefetched gcode for job {}".format(prefetch['key'][0]))
+		return {'gcode': True, 'path': path}
+
+	# runs alongside the print file download in _prepare_print, appends the
+	# _create_slicing_profile result to result or cancels the download
+	def _fetch_slicing_profile(self, config_file, slicer, cancel_event, result, temperatures_callback=None):
+		try:
+			req_ini = requests.get(config_file, timeout=5)
+			req_ini.raise_for_status()
+		except Exception:
+			self._logger.exception("Could not retrieve slicer config file from PolarCloud: {}".format(config_file))
+			cancel_event.set()
+			return
+		if cancel_event.is_set():
+			return
+		profile = self._create_slicing_profile(slicer, req_ini.content)
+		if not profile[0]:
+			cancel_event.set()
+		result.append(profile)
+		if profile[0] and temperatures_callback:
+			temperatures_callback(target_temperatures_from_gcode(profile[1].get("start_gcode", [""])[0]))
+
+	# reads just the start of a gcode file (where the start code heats up)
+	# while the whole thing downloads
+	def _fetch_gcode_temperatures(self, url, cancel_event, temperatures_callback, head_size=16 * 1024):
+		head = b""
+		try:
+			r = requests.get(url, headers={'Range': 'bytes=0-{}'.format(head_size - 1), 'Accept-Encoding': 'identity'},
+					stream=True, timeout=5)
+			try:
+				r.raise_for_status()
+				for chunk in r.iter_content(chunk_size=4096):
+					head += chunk
+					if len(head) >= head_size or cancel_event.is_set():
+						break
+			finally:
+				r.close()
+		except Exception:
+			self._logger.exception("Could not read the start of {}".format(url))
+			return
+		if not cancel_event.is_set():
+			temperatures_callback(target_temperatures_from_gcode(head[:head_size].decode('utf-8', 'replace')))
+
+	#~~ preheat while we download and slice
+
+	def _preheat(self, targets):
+		if not targets or not self._settings.get_boolean(['preheat']):
+			return
+		if not self._preparing() or self._prep_cancel.is_set():
+			return
+		if not self._printer.is_operational() or self._printer.is_printing() or self._printer.is_paused():
+			self._logger.debug("Not preheating, printer isn't ready")
+			return
+		self._logger.info("Preheating to {} while the print is prepared".format(repr(targets)))
+		for key, target in targets.items():
+			self._printer.set_temperature(key, target)
+		self._preheat_targets = targets
+
+		# don't leave the printer hot if preparation stalls
+		if self._preheat_timer:
+			self._preheat_timer.cancel()
+		self._preheat_timer = threading.Timer(self._settings.get_int(['preheat_timeout']), self._on_preheat_timeout)
+		self._preheat_timer.daemon = True
+		self._preheat_timer.start()
+		self._status_now = True
+
+	def _on_preheat_timeout(self):
+		if self._preheat_targets and not (self._printer.is_printing() or self._printer.is_paused()):
+			self._logger.warn("Print preparation is taking too long, cooling down")
+			self._cool_down_preheat()
+
+	def _cool_down_preheat(self):
+		if self._preheat_timer:
+			self._preheat_timer.cancel()
+			self._preheat_timer = None
+		targets = self._preheat_targets
+		self._preheat_targets = None
+		if not targets:
+			return
+		self._logger.info("Cooling down from preheat")
+		for key in targets:
+			try:
+				self._printer.set_temperature(key, 0)
+			except:
+				self._logger.exception("Unable to cool down {}".format(key))
+		self._status_now = True
+
+	# the start code takes over from here
+	def _preheat_handed_off(self):
+		if self._preheat_timer:
+			self._preheat_timer.cancel()
+			self._preheat_timer = None
+		self._preheat_targets = None
+
+	def _on_slicing_failed(self, *args):
+		self._logger.error("Unable to slice.")
+		self._preparation_failed(self.PSTATE_ERROR)
+
+	# file_manager.slice only calls back when slicing worked, a slice that
+	# failed or was cancelled only shows up as an event naming its gcode path,
+	# returns True if it was one of ours
+	def _on_slicing_stopped(self, event, payload):
+		path = payload.get("gcode")
+		for preparer in list(self._abandoned_preparers):
+			if preparer.slices_to(path) and not preparer.wait(0):
+				preparer.stopped()
+				return True
+		prefetch = self._prefetch
+		if prefetch and prefetch.get('preparer') and prefetch['preparer'].slices_to(path):
+			# nothing to do with the job that's printing, and when the next
+			# one starts it's fetched the usual way
+			prefetch['preparer'].stopped()
+			self._logger.warn("Unable to slice prefetched job {}: {}".format(prefetch['key'][0],
+				payload.get("reason", "cancelled")))
+			prefetch['cancel_event'].set()
+			if self._prefetch is prefetch:
+				self._prefetch = None
+			return True
+		preparer = self._print_preparer
+		if preparer and preparer.slices_to(path):
+			# the print isn't coming, so this is also where the printer cools
+			# down from the preheat (_preparation_failed sees to that)
+			preparer.stopped()
+			if event == Events.SLICING_FAILED:
+				self._logger.error("Unable to slice {}: {}".format(path, payload.get("reason")))
+				self._preparation_failed(self.PSTATE_ERROR)
+			else:
+				self._logger.info("Slicing {} was cancelled".format(path))
+				self._preparation_failed(self.PSTATE_CANCELLING)
+			return True
+		return False
 
 	def _on_slicing_complete(self, path, *args, **kwargs):
 		# TODO store self._cloud_print_info[sliceDetails]
 		self._logger.debug("_on_slicing_complete")
+		self._print_preparer = None
+		if self._prep_cancel.is_set():
+			self._preparation_failed(self.PSTATE_CANCELLING)
+			return
+		self._set_prep_stage(self.PREP_SELECTING)
 		self._pstate = self.PSTATE_PRINTING
 		self._printer.select_file(path, False, printAfterSelect=True)
-		self._update_interval = 10
-		self._status_now = True
-		self._print_preparer = None
+		if self._gcode_streamer:
+			self._gcode_streamer.follow()
+		self._analyze_gcode_in_background(path, self._gcode_streamer)
+		self._set_prep_stage(self.PREP_PRINTING)
+		self._status_scheduler.burst()
 
 	#~~ resume
 
@@ -1099,27 +2270,47 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 	def on_event(self, event, payload):
 		self._logger.debug("on_event: {}".format(repr(event)))
 		if event == Events.PRINT_CANCELLED or event == Events.PRINT_FAILED:
+			self._track_layers = False
+			self._stop_gcode_streamer()
+			self._abort_timelapse_recorder()
 			self._pstate = self.PSTATE_CANCELLING
 			if self._cloud_print:
 				self._pstate_counter = 3
 		elif event == Events.PRINT_STARTED or event == Events.PRINT_RESUMED:
 			self._pstate = self.PSTATE_PRINTING
-			self._update_interval = 10
-			self._logger.debug("Update interval to {}".format(self._update_interval))
+			self._status_scheduler.burst()
+			if event == Events.PRINT_STARTED:
+				self._preheat_handed_off()
+				self._start_timelapse_recorder()
+				self._layer_tracker.reset()
+				self._layer_snapshot_count = 0
+				self._layer_snapshot_time = 0
+				self._track_layers = (self._cloud_print and self._settings.get_boolean(['layer_snapshots'])
+						and self._settings.get_int(['layer_snapshot_max_count']) > 0)
 		elif event == Events.ERROR:
 			self._pstate = self.PSTATE_ERROR
 		elif event == Events.PRINT_PAUSED:
 			self._pstate = self.PSTATE_PAUSED
 		elif event == Events.PRINT_DONE:
+			self._track_layers = False
+			if self._gcode_streamer and not self._gcode_streamer.complete:
+				self._logger.warn("Print finished before the print file finished downloading")
+			self._stop_gcode_streamer()
 			self._pstate = self.PSTATE_COMPLETE
 			if self._cloud_print:
 				self._pstate = self.PSTATE_POSTPROCESSING
 				self._pstate_counter = 3
 				self._next_pending = True
+				if self._timelapse_recorder:
+					# post processing lasts until the timelapse is uploaded
+					self._pstate_counter = 0
+					self._finish_timelapse_recorder()
 			if self._status and "time" in payload:
 				self._status["printSeconds"] = payload["time"]
 			self._job(self._job_id, "completed")
 		elif event == Events.SLICING_CANCELLED or event == Events.SLICING_FAILED:
+			if self._on_slicing_stopped(event, payload):
+				return
 			self._pstate = self.PSTATE_CANCELLING
 			self._pstate_counter = 3
 			if self._status and "time" in payload:
@@ -1127,9 +2318,13 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		elif event == Events.SETTINGS_UPDATED:
 			self._update_local_settings()
 			if (self._printer_type != self._settings.get(['printer_type'])):
-				self._task_queue.put(self._hello)
+				self._queue_task(self._hello)
 			self._status_now = True
 			return
+		elif event in (Events.MOVIE_RENDERING, Events.POSTROLL_START, Events.MOVIE_FAILED,
+				Events.MOVIE_DONE) and self._hold_movie_event(event, payload):
+			# we've already got our own timelapse of this print
+			return
 		elif event == Events.MOVIE_RENDERING or event == Events.POSTROLL_START:
 			if self._cloud_print:
 				self._pstate = self.PSTATE_POSTPROCESSING
@@ -1145,9 +2340,8 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 			return
 		elif event == Events.MOVIE_DONE:
 			if self._cloud_print and self._settings.get_boolean(['upload_timelapse']):
-				self._ensure_upload_url('timelapse')
 				translate = PolarTimelapseTranscoder(payload["movie"],
-						self._upload_timelapse, self._logger)
+						self._upload_timelapse, self._logger, self._timelapse_max_size)
 				self._pstate = self.PSTATE_POSTPROCESSING
 				translate.translate_timelapse()
 			else:
@@ -1191,209 +2385,750 @@ class PolarcloudPlugin(octoprint.plugin.SettingsPlugin,
 		return flask.jsonify({'status': status, 'message': message})
 
 	def on_api_get(self, request):
-		return flask.jsonify({'capabilities': self._capabilities})
+		snapshots = self._snapshot_pipeline.get_counters() if self._snapshot_pipeline else None
+		file_cache = self._file_cache.get_counters() if self._file_cache else None
+		slice_cache = self._slice_cache.get_counters() if self._slice_cache else None
+		profiles = self._profile_store.get_counters() if self._profile_store else None
+		return flask.jsonify({'capabilities': self._capabilities, 'snapshots': snapshots,
+				'fileCache': file_cache, 'sliceCache': slice_cache, 'slicingProfiles': profiles})
 
 	#~~ Slicing profile
-	def _create_slicing_profile(self, slicer, config_file_bytes):
 
-		class ConfigFileReader(StringIO, object):
-			def __init__(self, *args, **kwargs):
-				self._dummy_section = True
-				self._indent = False
-				return super(ConfigFileReader, self).__init__(*args, **kwargs)
-
-			def readline(self):
-				if self._dummy_section:
-					self._dummy_section = False
-					return "[x]"
-				line = super(ConfigFileReader, self).readline()
-				if self._indent:
-					line = "    " + line
-				if '"""' in line:
-					self._indent = not self._indent
-				return line
-
-
-		def config_file_generator(fp):
-			# prepend a dummy section header (x)
-			# indent multi-line strings (in triple quotes)
-			indent = False
-			line = "[x]"
-			while line:
-				if indent:
-					line = "    " + line
-				if '"""' in line:
-					indent = not not indent
-				yield line
-				line = fp.readline()
+	# returns (profile name, profile dict, (posx, posy)), name is None if
+	# the profile couldn't be read or saved
+	def _create_slicing_profile(self, slicer, config_file_bytes):
+		try:
+			config = parse_engine_config(config_file_bytes)
+		except ValueError:
+			self._logger.exception("Error while reading PolarCloud slicing configuration.")
+			return (None, None, (0, 0))
 
-		# create an in memory "file" of the profile and prepend a dummy section
-		# header so ConfigParser won't give up so easily
-		config_file = ConfigFileReader(config_file_bytes)
+		printer_profile = self._printer_profile_manager.get_current_or_default()
+		profile, pos = translate_engine_config(config, printer_profile["extruder"]["nozzleDiameter"], self._logger)
+		self._logger.debug("Profile looks like this: {}".format(repr(profile)))
 
-		import ConfigParser
-		config = ConfigParser.ConfigParser()
+		if not self._profile_store:
+			self._profile_store = PolarProfileStore(self._slicing_manager, self._logger)
 		try:
-			config.readfp(config_file)
+			profile_name = self._profile_store.ensure(slicer, profile)
 		except:
-			self._logger.exception("Error while reading PolarCloud slicing configuration.")
+			self._logger.exception("save_profile failed")
+			profile_name = None
+		return (profile_name, profile, pos)
+
+	# (@ignore ...) lines are blanked in the sliced file by PolarPrintPreparer,
+	# so this only has to watch for layer changes
+	# this runs for every line sent to the printer, so it has to be cheap
+	# when there's nothing to do
+	def gcode_queuing(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
+		if not self._track_layers:
+			return
+		if gcode == "G1" or gcode == "G0":
+			if self._layer_tracker.on_move(cmd):
+				self._on_layer_change()
+		elif gcode in PolarLayerTracker.MODE_COMMANDS:
+			self._layer_tracker.on_mode(gcode, cmd)
+
+	#~~ Layer snapshots
+
+	# once the per-print budget is used up the heartbeat goes back to timed
+	# snapshots for the rest of the print
+	def _layer_snapshots_active(self):
+		return (self._track_layers and self._printer.is_printing()
+				and self._layer_snapshot_count < self._settings.get_int(['layer_snapshot_max_count']))
+
+	# called on the comm thread, so just check the per-print budget and leave
+	# the snapshot itself to the heartbeat
+	def _on_layer_change(self):
+		if not self._layer_snapshots_active() or not self._socket:
+			return
+		now = time()
+		if now - self._layer_snapshot_time < self._settings.get_int(['layer_snapshot_min_interval']):
+			return
+		# if we know how many layers there are, spread the budget over all of them
+		index = self._gcode_index
+		max_count = self._settings.get_int(['layer_snapshot_max_count'])
+		if index and index.complete and index.layer_count > max_count > 0:
+			every = (index.layer_count + max_count - 1) // max_count
+			if self._layer_tracker.layer % every:
+				return
+		self._layer_snapshot_count += 1
+		if self._layer_snapshot_count >= max_count:
+			self._logger.debug("Layer snapshots used up, back to timed snapshots")
+			self._track_layers = False
+		self._layer_snapshot_time = now
+		self._logger.debug("Layer {} at Z={}, snapshot {}".format(self._layer_tracker.layer,
+				self._layer_tracker.z, self._layer_snapshot_count))
+		self._queue_task(self._upload_snapshot)
+
+	#~~ Snapshots
+
+# capture -> transcode -> upload, each stage on its own thread with a bounded
+# queue in front of it, when a stage falls behind the oldest frame waiting for
+# it is dropped so we only ever upload recent frames. The PIL work goes to a
+# single worker process so it doesn't compete with the heartbeat for the GIL.
+class PolarSnapshotPipeline(object):
+	def __init__(self, logger, queue_size=1, worker_timeout=30):
+		self._logger = logger
+		self._worker_timeout = worker_timeout
+		self._capture_queue = Queue.Queue(queue_size)
+		self._transcode_queue = Queue.Queue(queue_size)
+		self._upload_queue = Queue.Queue(queue_size)
+		self._pool = None
+		self._pool_lock = threading.Lock()
+		self._threads = []
+		self._last_hash = None
+		self._last_upload_type = None
+		self._last_upload_time = 0
+		self.dropped = 0
+		self.skipped = 0
+		self.uploaded = 0
+
+	def get_counters(self):
+		return dict(uploaded=self.uploaded, skipped=self.skipped, dropped=self.dropped)
+
+	# the worker process is forked here rather than from a stage thread,
+	# start() should be called early, before the serial port is open
+	def start(self):
+		self._start_pool()
+		stages = [
+			("Capture", self._capture_queue, self._capture, self._transcode_queue),
+			("Transcode", self._transcode_queue, self._transcode, self._upload_queue),
+			("Upload", self._upload_queue, self._upload, None)
+		]
+		for name, in_queue, stage, out_queue in stages:
+			thread = threading.Thread(target=self._run_stage, args=(in_queue, stage, out_queue),
+					name="PolarCloudSnapshot{}".format(name))
+			thread.daemon = True
+			thread.start()
+			self._threads.append(thread)
+
+	def submit(self, job):
+		self._put(self._capture_queue, job)
+
+	def _put(self, queue, job):
+		while True:
+			try:
+				queue.put_nowait(job)
+				return
+			except Queue.Full:
+				try:
+					queue.get_nowait()
+					self.dropped += 1
+					self._logger.debug("Snapshot pipeline behind, dropped oldest frame ({} dropped)".format(self.dropped))
+				except Queue.Empty:
+					pass
+
+	def _run_stage(self, in_queue, stage, out_queue):
+		while True:
+			job = in_queue.get()
+			try:
+				job = stage(job)
+			except Exception:
+				self._logger.exception("Snapshot pipeline stage failed")
+				continue
+			if job and out_queue:
+				self._put(out_queue, job)
+
+	def _capture(self, job):
+		# wait for the upload url here rather than drop the snapshot
+		job['location'] = job['location']()
+		if not job['location']:
+			self._logger.warn("No {} upload url from PolarCloud, dropping snapshot".format(job['upload_type']))
+			return None
+		if job['location'].get('maxSize'):
+			job['max_image_size'] = min(job['max_image_size'], int(job['location']['maxSize']))
+
+		reader = job.get('stream_reader')
+		if reader:
+			frame = reader.get_frame()
+			if frame:
+				job['image'] = frame
+				return job
+			self._logger.debug("No recent frame from {}, requesting a snapshot".format(reader.url))
+		try:
+			r = requests.get(job['snapshot_url'], timeout=5)
+			r.raise_for_status()
+		except Exception:
+			self._logger.exception("Could not capture image from {}".format(job['snapshot_url']))
 			return None
+		job['image'] = r.content
+		if len(job['image']) == 0:
+			self._logger.debug("Image content is length 0 from {}, not uploading to PolarCloud".format(job['snapshot_url']))
+			return None
+		return job
 
-		printer_profile = self._printer_profile_manager.get_current_or_default()
-		extrusion_width = printer_profile["extruder"]["nozzleDiameter"]
-		if "extrusionWidth" in config.options("x"):
-			extrusion_width = config.get("x", "extrusionWidth")
-		layer_height = 0.2
-		if "layerThickness" in config.options("x"):
-			layer_height = config.get("x", "layerThickness")
-		init_layer_height = layer_height
-		if "initialLayerThickness" in config.options("x"):
-			init_layer_height = config.get("x", "initialLayerThickness")
-
-		posx = 0
-		posy = 0
-		mm_from_um = lambda x: x / 1000.0
-		no_translation = lambda x: x
-		width_from_line_count = lambda x: x * extrusion_width
-		height_from_layer_count = lambda x: x * layer_height
-		bool_from_int = lambda x: not not x
-
-		profile_from_engine_config = {
-			"layerthickness":       ("layer_height",       mm_from_um),
-			"printspeed":           ("print_speed",        no_translation),
-			"supporttype":          ("support_type",       lambda x: "lines" if x == 0 else "grid"),
-			"infillspeed":          ("infill_speed",       no_translation),
-			"infilloverlap":        ("fill_overlap",       no_translation),
-			"filamentdiameter":     ("filament_diameter",  lambda x: [mm_from_um(x) for i in range(4)]),
-			"filamentflow":         ("filament_flow",      no_translation),
-			"retractionamountextruderswitch": ("retraction_dual_amount", mm_from_um),
-			"retractionamount":     ("retraction_amount",  mm_from_um),
-			"retractionspeed":      ("retraction_speed",   no_translation),
-			"initiallayerthickness":("bottom_thickness",   mm_from_um),
-			"extrusionwidth":       ("edge_width",         mm_from_um),
-			"insetcount":           ("wall_thickness",     width_from_line_count),
-			"downskincount":        ("solid_layer_thickness", height_from_layer_count),
-			"upskincount":          ("solid_layer_thickness", height_from_layer_count),
-			"initialspeeduplayers": (None, None),          # octoprint always uses 4
-			"initiallayerspeed":    ("bottom_layer_speed", no_translation),
-			"inset0speed":          ("outer_shell_speed",  no_translation),
-			"insetxspeed":          ("inner_shell_speed",  no_translation),
-			"movespeed":            ("travel_speed",       no_translation),
-			"minimallayertime":     ("cool_min_layer_time",no_translation),
-			"infillpattern":        (None, None),          # octoprint doesn't set
-			"layer0extrusionwidth": ("first_layer_width_factor", lambda x: mm_from_um(x) * 100.0 / extrusion_width),
-			"spiralizemode":        ("spiralize",          bool_from_int),
-			"sparseinfilllinedistance": ("fill_density",   lambda x: 100.0 * extrusion_width / mm_from_um(x)),
-			"multivolumeoverlap":   ("overlap_dual",       mm_from_um),
-			"enableoozeshield":     ("ooze_shield",        bool_from_int),
-			"fanfullonlayernr":     ("fan_full_height",    lambda x: (x - 1) * layer_height + init_layer_height),
-			"gcodeflavor":          ("gcode_flavor",       lambda x: "reprap"), # TODO: GPX -> RepRap
-			"autocenter":           (None, None),          # octoprint doesn't set
-			"objectsink":           ("object_sink",        mm_from_um),
-			"extruderoffset[0].x":  (None, None),          # octoprint always overrides with printer profile
-			"extruderoffset[0].y":  (None, None),          # octoprint always overrides with printer profile
-			"retractionminimaldistance": ("retraction_min_travel", mm_from_um),
-			"retractionzhop":       ("retraction_hop",     mm_from_um),
-			"minimalextrusionbeforeretraction": ("retraction_minimal_extrusion", mm_from_um),
-			"enablecombing":        ("retraction_combing", lambda x: "all" if x == 1 else ("no skin" if x == 2 else "off")),
-			"minimalfeedrate":      ("cool_min_feedrate",  no_translation),
-			"coolheadlift":         ("cool_head_lift",     bool_from_int),
-			"fanspeedmin":          ("fan_speed",          no_translation),
-			"fanspeedmax":          ("fan_speed_max",      no_translation),
-			"skirtdistance":        ("skirt_gap",          mm_from_um),
-			"skirtminlength":       ("skirt_minimal_length", mm_from_um),
-			"skirtlinecount":       ("skirt_line_count",   no_translation),
-			"supportangle":         ("support_angle",      no_translation),
-			"supportxydistance":    ("support_xy_distance", mm_from_um),
-			"supportzdistance":     ("support_z_distance", mm_from_um),
-			"supportlinedistance":  ("support_fill_rate",  lambda x: 100.0 * extrusion_width / mm_from_um(x)),
-			"startcode":            ("start_gcode",        lambda x: ["(@ignore {print_temperature})\n(@ignore {print_bed_temperature})\n" + x[3:-3]]),
-			"endcode":              ("end_gcode",          lambda x: [x[3:-3]]),
-			"raftmargin":           ("raft_margin",        mm_from_um),
-			"raftlinespacing":      ("raft_line_spacing",  mm_from_um),
-			"raftbasethickness":    ("raft_base_thickness",mm_from_um),
-			"raftbaselinewidth":    ("raft_base_linewidth",mm_from_um),
-			"raftinterfacethickness": ("raft_thickness",   mm_from_um),
-			"raftinterfacelinewidth": ("raft_margin",      mm_from_um),
-			"raftinterfacelinespacing": (None, None),      # octoprint computes from linewidth
-			"raftbasespeed":        (None, None),          # octoprint always uses bottom_layer_speed
-			"raftfanspeed":         (None, None),          # octoprint forces this to 0
-			"raftsurfacethickness": ("raft_surface_thickness", mm_from_um),
-			"raftsurfacelinewidth": ("raft_surface_linewidth", mm_from_um),
-			"raftsurfacelinespacing": (None, None),        # octoprint computes from linewidth
-			"raftsurfacelayers":    ("raft_surface_layers",no_translation),
-			"raftsurfacespeed":     (None, None),          # octoprint always uses bottom_layer_speed
-			"raftairgap":           ("raft_airgap_all",    mm_from_um),
-			"raftairgaplayer0":     (None, None)           # octoprint doesn't support a different airgap for layer0)
-		}
+	def _transcode(self, job):
+		if self._unchanged(job):
+			self.skipped += 1
+			self._logger.debug("Snapshot unchanged since last upload, skipping ({} skipped)".format(self.skipped))
+			return None
+
+		image_size = len(job['image'])
+		if not job['transpose'] and image_size <= job['max_image_size']:
+			return job
+		self._logger.debug("Recompressing snapshot to smaller size")
+		args = (job['image'], job['max_image_size'], job['flipH'], job['flipV'], job['rotate90'])
+		try:
+			job['image'] = self._apply(transcode_snapshot, args)
+		except multiprocessing.TimeoutError:
+			return None
+		self._logger.debug("Image transcoded from size {} to {}".format(image_size, len(job['image'])))
+		return job
 
-		profile = dict()
-		profile["support"] = "none"
-		posx = 0
-		posy = 0
-		for option in config.options("x"):
-			# try to fetch the value in the correct type
+	# true if the frame looks the same as the last one we uploaded and we've
+	# uploaded one recently enough
+	def _unchanged(self, job):
+		try:
+			job['hash'] = self._apply(snapshot_hash, (job['image'],))
+		except Exception:
+			self._logger.exception("Unable to compute snapshot hash")
+			job['hash'] = None
+			return False
+		if self._last_hash is None or job['hash'] is None or job['upload_type'] != self._last_upload_type:
+			return False
+		if time() - self._last_upload_time >= job['refresh_interval']:
+			return False
+		return hash_distance(job['hash'], self._last_hash) <= job['hash_threshold']
+
+	def _start_pool(self):
+		try:
+			self._pool = multiprocessing.Pool(processes=1)
+		except Exception:
+			self._logger.exception("Unable to start snapshot worker process, transcoding in process")
+			self._pool = None
+
+	# runs func in the worker process, a worker that hangs (e.g. on a corrupt
+	# frame) is replaced rather than leaving the stage stuck behind it
+	def _apply(self, func, args):
+		pool = self._pool
+		if not pool:
+			return func(*args)
+		try:
+			return pool.apply_async(func, args).get(self._worker_timeout)
+		except multiprocessing.TimeoutError:
+			self._logger.warn("Snapshot worker process didn't answer in {} seconds, restarting it".format(
+				self._worker_timeout))
+			self.dropped += 1
+			with self._pool_lock:
+				if self._pool is pool:
+					pool.terminate()
+					self._start_pool()
+			raise
+
+	def _upload(self, job):
+		if job.get('frame_callback'):
 			try:
-				value = config.getint("x", option)
-			except:
-				# no int, try float
+				job['frame_callback'](job['image'])
+			except Exception:
+				self._logger.exception("Unable to pass snapshot along")
+		try:
+			loc = job['location']
+			p = requests.post(loc['url'], data=loc['fields'], files={'file': ('image.jpg', job['image'])})
+			p.raise_for_status()
+			self._logger.debug("{}: {}".format(p.status_code, p.content))
+			self._logger.debug("Image captured from {}".format(job['snapshot_url']))
+			self._last_hash = job.get('hash')
+			self._last_upload_type = job['upload_type']
+			self._last_upload_time = time()
+			self.uploaded += 1
+		except Exception:
+			self._logger.exception("Could not post snapshot to PolarCloud")
+		return None
+
+	#~~ MJPEG stream
+
+# holds a connection open to an mjpeg (multipart/x-mixed-replace) stream and
+# keeps the most recent jpeg from it, reconnecting when the stream drops
+class PolarMjpegReader(object):
+	def __init__(self, url, logger, max_age=10, max_buffer=8 * 1024 * 1024):
+		self.url = url
+		self._logger = logger
+		self._max_age = max_age
+		self._max_buffer = max_buffer
+		self._frame = None
+		self._frame_time = 0
+		self._stopped = False
+		self._thread = None
+
+	def start(self):
+		self._thread = threading.Thread(target=self._reader_worker, name="PolarCloudMjpegReader")
+		self._thread.daemon = True
+		self._thread.start()
+
+	def stop(self):
+		self._stopped = True
+
+	# the latest frame, or None if we haven't seen one in max_age seconds
+	def get_frame(self):
+		if self._frame and time() - self._frame_time <= self._max_age:
+			return self._frame
+		return None
+
+	def _reader_worker(self):
+		delay = 1
+		while not self._stopped:
+			try:
+				r = requests.get(self.url, stream=True, timeout=10)
 				try:
-					value = config.getfloat("x", option)
-				except:
-					# no float, use str
-					value = config.get("x", option)
-
-			if option in profile_from_engine_config:
-				key, translate = profile_from_engine_config[option]
-				if key:
-					profile[key] = translate(value)
-					if "raft" in key:
-						profile["platform_adhesion"] = "raft"
-					elif "support" in key:
-						if profile["support"] != "everywhere":
-							profile["support"] = "buildplate"
-				else:
-					self._logger.debug("Eating PolarCloud setting {}={}".format(option, value))
-			elif option == "supporteverywhere":
-				if value:
-					profile["support"] = "everywhere"
-			elif option == "fixhorrible":
-				profile["fix_horrible_union_all_type_a"] = not not (value & 0x01)
-				profile["fix_horrible_union_all_type_b"] = not not (value & 0x02)
-				profile["fix_horrible_extensive_stitching"] = not not (value & 0x04)
-				profile["fix_horrible_use_open_bits"] = not not (value & 0x10)
-			elif option == "posx":
-				posx = mm_from_um(value)
-			elif option == "posy":
-				posy = mm_from_um(value)
-			else:
-				self._logger.warn("PolarCloud slicing profile contains unrecognized setting {}={}".format(option, value))
+					r.raise_for_status()
+					delimiter = self._delimiter(r.headers.get('Content-Type', ''))
+					if not delimiter:
+						self._logger.warn("{} is not a multipart mjpeg stream".format(self.url))
+					else:
+						delay = 1
+						self._read_frames(r, delimiter)
+				finally:
+					r.close()
+			except Exception:
+				self._logger.debug("mjpeg stream {} failed: {}".format(self.url, get_exception_string()))
+			if not self._stopped:
+				sleep(delay)
+				delay = min(delay * 2, 60)
+
+	def _delimiter(self, content_type):
+		match = re.search(r'boundary="?([^";]+)"?', content_type)
+		if not match:
+			return None
+		boundary = match.group(1)
+		return boundary if boundary.startswith("--") else "--" + boundary
 
-		self._logger.debug("Profile looks like this: {}".format(repr(profile)))
-		profile["fan_enabled"] = "fan_speed_max" in profile and profile["fan_speed_max"] > 0
+	def _read_frames(self, r, delimiter):
+		buf = b''
+		for chunk in r.iter_content(chunk_size=16 * 1024):
+			if self._stopped:
+				return
+			buf += chunk
+			while True:
+				frame, buf = self.next_frame(buf, delimiter)
+				if frame is None:
+					break
+				self._frame = frame
+				self._frame_time = time()
+			if len(buf) > self._max_buffer:
+				self._logger.warn("No frame boundary in {} bytes from {}, discarding".format(len(buf), self.url))
+				buf = b''
+
+	# split the first complete part off buf, returns (frame, rest of buf) or
+	# (None, buf) if we don't have a whole part yet
+	@staticmethod
+	def next_frame(buf, delimiter):
+		start = buf.find(delimiter)
+		if start < 0:
+			# keep enough to find a delimiter split across chunks
+			return None, buf[-len(delimiter):]
+		header_end = buf.find(b'\r\n\r\n', start)
+		if header_end < 0:
+			return None, buf[start:]
+		headers = buf[start + len(delimiter):header_end]
+		body_start = header_end + 4
+
+		match = re.search(br'(?i)content-length:\s*(\d+)', headers)
+		if match:
+			body_end = body_start + int(match.group(1))
+			if len(buf) < body_end:
+				return None, buf[start:]
+			return buf[body_start:body_end], buf[body_end:]
+
+		body_end = buf.find(delimiter, body_start)
+		if body_end < 0:
+			return None, buf[start:]
+		return buf[body_start:body_end].rstrip(b'\r\n'), buf[body_end:]
+
+	#~~ Layer tracking
+
+# where a layer starts, for PolarLayerTracker as lines go to the printer and
+# PolarGcodeAnalyzer reading the file, so that their layer numbers agree: the
+# first move that extrudes (E goes up, an unretract counts) at a height other
+# than the last layer's, a Z move alone isn't enough since z-hop travel moves
+# go up and come back down
+def starts_layer(z, extruded, layer_z):
+	return extruded > 0 and z != layer_z
+
+# follows Z and E through G0/G1 moves, the positioning modes and G92 (the
+# commands in MODE_COMMANDS) to spot layer changes
+class PolarLayerTracker(object):
+	Z_PATTERN = re.compile(r'[Zz]\s*(-?\d*\.?\d+)')
+	E_PATTERN = re.compile(r'[Ee]\s*(-?\d*\.?\d+)')
+	MODE_COMMANDS = frozenset(("G28", "G90", "G91", "G92", "M82", "M83"))
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.z = None # the current layer's height
+		self.layer = 0
+		self._z = 0.0
+		# with absolute extrusion the E position is whatever the last move
+		# with an E said, so rather than parse every one, keep the move
+		# (_e_cmd) and only read it when there's a layer change to check
+		self._e = 0.0
+		self._e_cmd = None
+		self._relative = False
+		self._relative_e = False
+
+	# returns true if this move starts a new layer
+	def on_move(self, cmd):
+		if 'Z' in cmd or 'z' in cmd:
+			match = self.Z_PATTERN.search(cmd)
+			if match:
+				z = float(match.group(1))
+				self._z = self._z + z if self._relative else z
+		if not ('E' in cmd or 'e' in cmd):
+			return False
+		if self._relative_e:
+			e = self._e_value(cmd)
+			if e is None:
+				return False
+			self._e += e
+			extruded = e
+		else:
+			previous = self._e_cmd
+			self._e_cmd = cmd
+			# the cheap half of starts_layer first
+			if self._z == self.z:
+				return False
+			e = self._e_value(cmd)
+			if e is None:
+				self._e_cmd = previous
+				return False
+			extruded = e - self._e_position(previous)
+		if not starts_layer(self._z, extruded, self.z):
+			return False
+		self.z = self._z
+		self.layer += 1
+		return True
+
+	def on_mode(self, gcode, cmd):
+		self._e = self._e_position(self._e_cmd)
+		self._e_cmd = None
+		if gcode == "G90":
+			self._relative = self._relative_e = False
+		elif gcode == "G91":
+			self._relative = self._relative_e = True
+		elif gcode == "M82":
+			self._relative_e = False
+		elif gcode == "M83":
+			self._relative_e = True
+		elif gcode == "G28":
+			self._z = 0.0
+		elif gcode == "G92":
+			match = self.Z_PATTERN.search(cmd)
+			if match:
+				self._z = float(match.group(1))
+			e = self._e_value(cmd)
+			if e is not None:
+				self._e = e
+
+	def _e_value(self, cmd):
+		match = self.E_PATTERN.search(cmd)
+		return float(match.group(1)) if match else None
+
+	def _e_position(self, cmd):
+		e = self._e_value(cmd) if cmd else None
+		return self._e if e is None else e
+
+	#~~ G-code analysis
+
+# one pass over a gcode file, read off disk in chunks once the print has
+# started, noting the file offset where each
+# layer starts along with how much filament and time (from distance and
+# feedrate, no acceleration) has gone by at that point; the index is kept in
+# flat arrays so that a file position turns into time and filament with a
+# binary search on every status report
+class PolarGcodeAnalyzer(object):
+	COMMAND_PATTERN = re.compile(r'\s*([GM])\s*(\d+)')
+	PARAM_PATTERN = re.compile(r'([A-Z])\s*([-+]?\d*\.?\d+)')
+
+	def __init__(self):
+		self.offsets = array('d')   # where each layer starts
+		self.seconds = array('d')   # time spent before that
+		self.filament = array('d')  # mm of filament extruded before that
+		self.size = 0
+		self.total_seconds = 0.0
+		self.total_filament = 0.0
+		self.complete = False
+		self._partial = b""
+		self._fed = 0
+		self._pos = {'X': 0.0, 'Y': 0.0, 'Z': 0.0, 'E': 0.0}
+		self._feedrate = 3000.0 # mm/min
+		self._relative = False
+		self._relative_e = False
+		self._layer_z = None
+
+	@classmethod
+	def analyze_file(cls, path, chunk_size=64 * 1024):
+		analyzer = cls()
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(chunk_size), b''):
+				analyzer.feed(chunk)
+		analyzer.finish()
+		return analyzer
+
+	@property
+	def layer_count(self):
+		return len(self.offsets)
+
+	def feed(self, data):
+		offset = self._fed - len(self._partial)
+		self._fed += len(data)
+		data = self._partial + data
+		start = 0
+		while True:
+			end = data.find(b"\n", start)
+			if end < 0:
+				break
+			self.on_line(data[start:end + 1], offset + start)
+			start = end + 1
+		self._partial = data[start:]
+
+	def finish(self):
+		if self._partial:
+			self.on_line(self._partial, self._fed - len(self._partial))
+			self._partial = b""
+		self.complete = True
+
+	def on_line(self, line, offset):
+		self.size = max(self.size, offset + len(line))
+		line = line.split(b";", 1)[0].decode('ascii', 'ignore').upper()
+		match = self.COMMAND_PATTERN.match(line)
+		if not match:
+			return
+		command = match.group(1) + str(int(match.group(2)))
+		params = dict((k, float(v)) for k, v in self.PARAM_PATTERN.findall(line, match.end()))
+
+		if command in ("G0", "G1"):
+			self._move(params, offset)
+		elif command == "G4":
+			self.total_seconds += params.get('P', 0.0) / 1000.0 + params.get('S', 0.0)
+		elif command == "G28":
+			for axis in "XYZ":
+				self._pos[axis] = 0.0
+		elif command == "G90":
+			self._relative = self._relative_e = False
+		elif command == "G91":
+			self._relative = self._relative_e = True
+		elif command == "M82":
+			self._relative_e = False
+		elif command == "M83":
+			self._relative_e = True
+		elif command == "G92":
+			for axis in self._pos:
+				if axis in params:
+					self._pos[axis] = params[axis]
+
+	def _move(self, params, offset):
+		pos = dict(self._pos)
+		for axis in pos:
+			if axis in params:
+				relative = self._relative_e if axis == 'E' else self._relative
+				pos[axis] = self._pos[axis] + params[axis] if relative else params[axis]
+		if params.get('F', 0) > 0:
+			self._feedrate = params['F']
+
+		distance = sum((pos[axis] - self._pos[axis]) ** 2 for axis in "XYZ") ** 0.5
+		extruded = pos['E'] - self._pos['E']
+		if starts_layer(pos['Z'], extruded, self._layer_z):
+			self._layer_z = pos['Z']
+			self.offsets.append(offset)
+			self.seconds.append(self.total_seconds)
+			self.filament.append(self.total_filament)
+		self.total_seconds += (distance or abs(extruded)) * 60.0 / self._feedrate
+		self.total_filament += extruded
+		self._pos = pos
+
+	# layer number (1 based, 0 before the first) at a file position
+	def layer_at(self, filepos):
+		return bisect_right(self.offsets, filepos)
 
+	# (seconds, filament) spent up to a file position, interpolated within
+	# the layer it's in
+	def at(self, filepos):
+		i = bisect_right(self.offsets, filepos)
+		if i:
+			lo = (self.offsets[i - 1], self.seconds[i - 1], self.filament[i - 1])
+		else:
+			lo = (0, 0.0, 0.0)
+		if i < len(self.offsets):
+			hi = (self.offsets[i], self.seconds[i], self.filament[i])
+		else:
+			hi = (self.size, self.total_seconds, self.total_filament)
+		span = hi[0] - lo[0]
+		fraction = min(max(float(filepos - lo[0]) / span, 0.0), 1.0) if span > 0 else 1.0
+		return (lo[1] + fraction * (hi[1] - lo[1]), lo[2] + fraction * (hi[2] - lo[2]))
+
+	#~~ Status scheduling
+
+# picks how long to wait before the next status report: about as long as it
+# takes for a temperature to move temp_step degrees or the print to advance
+# progress_step of the file, bounded by min_interval and max_interval, with a
+# burst of min_interval reports after a state change
+class PolarStatusScheduler(object):
+	TEMPERATURE_KEYS = ("tool0", "tool1", "bed")
+	TARGET_KEYS = ("targetTool0", "targetTool1", "targetBed")
+
+	def __init__(self, min_interval, max_interval, temp_step=2.0, progress_step=0.01, burst_count=3):
+		self._min_interval = min_interval
+		self._max_interval = max_interval
+		self._temp_step = temp_step
+		self._progress_step = progress_step
+		self._burst_count = burst_count
+		self._burst = burst_count
+		self._last_status = None
+		self._last_time = None
+
+	def set_limits(self, min_interval, max_interval):
+		if min_interval and min_interval > 0:
+			self._min_interval = min_interval
+		if max_interval and max_interval >= self._min_interval:
+			self._max_interval = max_interval
+
+	def burst(self):
+		self._burst = self._burst_count
+
+	def next_interval(self, status, now):
+		last = self._last_status
+		interval = self._max_interval
+		if last and now > self._last_time:
+			elapsed = now - self._last_time
+			if (status.get("status") != last.get("status") or status.get("jobId") != last.get("jobId") or
+					any(status.get(key) != last.get(key) for key in self.TARGET_KEYS)):
+				self.burst()
+			for key in self.TEMPERATURE_KEYS:
+				if key in status and key in last:
+					slope = abs(status[key] - last[key]) / elapsed
+					if slope > 0:
+						interval = min(interval, self._temp_step / slope)
+			progress, last_progress = self._progress(status), self._progress(last)
+			if progress is not None and last_progress is not None and progress > last_progress:
+				interval = min(interval, self._progress_step * elapsed / (progress - last_progress))
+		self._last_status = status
+		self._last_time = now
+
+		if self._burst:
+			self._burst -= 1
+			return self._min_interval
+		return int(max(self._min_interval, min(self._max_interval, interval)))
+
+	def _progress(self, status):
 		try:
-			profile = self._slicing_manager.save_profile(slicer, "polarcloud", profile,
-					allow_overwrite=True, display_name="PolarCloud",
-					description="Polar Cloud sends this slicing profile down with each cloud print (overwritten each time)")
+			return float(status["bytesRead"]) / float(status["fileSize"])
+		except (KeyError, ValueError, TypeError, ZeroDivisionError):
+			return None
+
+	#~~ Slicing profiles
+
+# saves translated slicing profiles under a name derived from their content so
+# an unchanged profile is never rewritten (and reloaded), keeps the most
+# recently used max_profiles per slicer so alternating between a couple of
+# configs doesn't rewrite them each time
+class PolarProfileStore(object):
+	PREFIX = "polarcloud_"
+
+	def __init__(self, slicing_manager, logger, max_profiles=4):
+		self._slicing_manager = slicing_manager
+		self._logger = logger
+		self._max_profiles = max_profiles
+		self._recent = {}
+		self.writes = 0
+		self.skipped = 0
+
+	def get_counters(self):
+		return dict(writes=self.writes, skipped=self.skipped)
+
+	@classmethod
+	def name_for(cls, profile):
+		return cls.PREFIX + hashlib.sha256(json.dumps(profile, sort_keys=True)).hexdigest()[:16]
+
+	# returns the name of a saved profile matching profile
+	def ensure(self, slicer, profile):
+		name = self.name_for(profile)
+		recent = self._recent_for(slicer)
+		if name in recent and self._profile_exists(slicer, name):
+			self.skipped += 1
+			self._logger.debug("Slicing profile {} unchanged, not saving".format(name))
+		else:
+			self._slicing_manager.save_profile(slicer, name, profile,
+					allow_overwrite=True, display_name="PolarCloud " + name[len(self.PREFIX):len(self.PREFIX) + 6],
+					description="Polar Cloud sends this slicing profile down with cloud prints")
+			self.writes += 1
+		if name in recent:
+			recent.remove(name)
+		recent.append(name)
+		self._evict(slicer, recent)
+		return name
+
+	# recent only says we saved it, the file may have been deleted since;
+	# checked on the file itself, all_profiles() would load every profile
+	def _profile_exists(self, slicer, name):
+		try:
+			return os.path.exists(self._slicing_manager.get_profile_path(slicer, name))
 		except:
-			self._logger.exception("save_profile failed")
-			profile = None
-		return (profile, (posx, posy))
+			self._logger.exception("Unable to find slicing profile {} for {}".format(name, slicer))
+			return False
 
-	def strip_ignore(self, comm_instance, phase, cmd, cmd_type, gcode, *args, **kwargs):
-		if cmd and cmd.startswith("(@ignore"):
-			return None,
+	# profiles saved by an earlier run come first so they're evicted first
+	def _recent_for(self, slicer):
+		if not slicer in self._recent:
+			try:
+				names = [name for name in self._slicing_manager.all_profiles(slicer, require_configured=False)
+						if name.startswith(self.PREFIX)]
+			except:
+				self._logger.exception("Unable to list slicing profiles for {}".format(slicer))
+				names = []
+			self._recent[slicer] = sorted(names)
+		return self._recent[slicer]
+
+	def _evict(self, slicer, recent):
+		while len(recent) > self._max_profiles:
+			name = recent.pop(0)
+			self._logger.debug("Deleting slicing profile {}".format(name))
+			try:
+				self._slicing_manager.delete_profile(slicer, name)
+			except:
+				self._logger.exception("Unable to delete slicing profile {}".format(name))
 
 	#~~ Timelapse
 
 class PolarTimelapseTranscoder(object):
-	def __init__(self, octoprint_movie, callback, logger):
+	# container caps media type -> the demuxer that gets the stream back out
+	CONTAINER_DEMUXERS = {
+		"video/quicktime": "qtdemux",
+		"video/x-matroska": "matroskademux",
+		"video/webm": "matroskademux",
+		"video/x-msvideo": "avidemux",
+		"video/x-flv": "flvdemux",
+		"video/mpegts": "tsdemux"
+	}
+	# with -v the topology lines are caps rather than descriptions, e.g.
+	# "video: video/x-h264, stream-format=(string)avc, width=(int)1280, ..."
+	PROBE_PATTERN = re.compile(r'^\s*(container|video)(?: #\d+)?:\s*(.+?)\s*$', re.MULTILINE)
+	CAPS_FIELD_PATTERN = re.compile(r',\s*([\w-]+)=\(\w+\)([^,]*)')
+	DURATION_PATTERN = re.compile(r'Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)')
+	SIZE_PATTERN = re.compile(r'^\s*(Width|Height):\s*(\d+)\s*$', re.MULTILINE)
+	FRAMERATE_PATTERN = re.compile(r'Frame rate:\s*(\d+/\d+)')
+
+	# below this many bits per pixel per frame x264 output turns to mush, so
+	# we'd rather drop frames, and then resolution, than go under it
+	MIN_BITS_PER_PIXEL = 0.05
+	MIN_FRAMERATE = 5
+	MIN_WIDTH = 320
+	# share of the size budget we aim the video stream at, the rest is
+	# container overhead and rate control slop
+	BUDGET_FILL = 0.95
+
+	# max_size_callback returns the upload slot's maxSize in bytes (or None),
+	# it's asked once we get to encoding since the slot may still be on its way
+	def __init__(self, octoprint_movie, callback, logger, max_size_callback=None, max_passes=2):
 		self._octoprint_movie = octoprint_movie
 		movie_basename, ext = os.path.splitext(octoprint_movie)
 		self._polar_movie = movie_basename + ".mp4"
+		if self._polar_movie == octoprint_movie:
+			self._polar_movie = movie_basename + ".polar.mp4"
 		self._callback = callback
 		self._logger = logger
+		self._max_size_callback = max_size_callback
+		self._max_passes = max_passes
 
 	def translate_timelapse(self):
 		self._thread = threading.Thread(target=self._translate_timelapse_worker,
@@ -1401,29 +3136,372 @@ class PolarTimelapseTranscoder(object):
 		self._thread.daemon = True
 		self._thread.start()
 
-	# working thread for converting from OctoPrint's timelapse format to PolarCloud's
-	def _translate_timelapse_worker(self):
-		command = 'gst-launch-1.0 -e filesrc location="{infile}" ! decodebin name=decode ! x264enc ! queue ! qtmux name=mux ! filesink location={outfile} decode. ! mux.'.format(
-				infile=self._octoprint_movie, outfile=self._polar_movie)
+	# returns what gst-discoverer can tell us: container and video (caps media
+	# types), duration (seconds) and if it says, width, height and framerate
+	def _probe(self):
+		try:
+			p = sarge.run('gst-discoverer-1.0 -v "{infile}"'.format(infile=self._octoprint_movie),
+					stdout=sarge.Capture(), stderr=sarge.Capture())
+			if p.returncode != 0:
+				self._logger.debug("gst-discoverer failed: {}".format(p.stderr.text))
+				return {}
+			text = p.stdout.text
+		except:
+			self._logger.exception("Could not probe {}".format(self._octoprint_movie))
+			return {}
+
+		probe = self.parse_probe(text)
+		self._logger.debug("timelapse probe: {}".format(repr(probe)))
+		return probe
+
+	@classmethod
+	def parse_probe(cls, text):
+		probe = {}
+		caps = {}
+		for stream_type, description in cls.PROBE_PATTERN.findall(text):
+			if stream_type in probe:
+				continue
+			probe[stream_type] = description.split(",", 1)[0].strip()
+			caps[stream_type] = dict(cls.CAPS_FIELD_PATTERN.findall(description))
+		match = cls.DURATION_PATTERN.search(text)
+		if match:
+			probe["duration"] = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+
+		# the video caps first, the Width/Height/Frame rate lines that follow
+		# them if they're missing anything
+		video = caps.get("video", {})
+		for key in ("width", "height"):
+			if video.get(key, "").isdigit():
+				probe[key] = int(video[key])
+		for key, value in cls.SIZE_PATTERN.findall(text):
+			probe.setdefault(key.lower(), int(value))
+		match = cls.FRAMERATE_PATTERN.search(text)
+		for framerate in (video.get("framerate"), match and match.group(1)):
+			num, _, den = (framerate or "").strip().partition("/")
+			# 0/1 is a variable framerate
+			if num.isdigit() and den.isdigit() and int(num) and int(den):
+				probe["framerate"] = float(num) / int(den)
+				break
+		return probe
+
+	# x264 bitrate (kbit/s) that fills max_size over the movie's duration, and
+	# a lower framerate and/or resolution if that bitrate is too thin to
+	# spread over every pixel of every frame, None if there's no budget
+	def _encode_plan(self, probe, max_size):
+		duration = probe.get("duration")
+		if not max_size or not duration:
+			return None
+		bitrate = max_size * 8 * self.BUDGET_FILL / duration
+		plan = {"bitrate": max(int(bitrate / 1000), 1)}
+
+		width = probe.get("width")
+		height = probe.get("height")
+		framerate = probe.get("framerate")
+		if not (width and height and framerate):
+			return plan
+		if bitrate >= self.MIN_BITS_PER_PIXEL * width * height * framerate:
+			return plan
+
+		# decimate first, a timelapse reads fine at a few frames a second
+		wanted = max(int(bitrate / (self.MIN_BITS_PER_PIXEL * width * height)), self.MIN_FRAMERATE)
+		if wanted < framerate:
+			plan["framerate"] = wanted
+			framerate = wanted
+		# then scale down
+		scale = (bitrate / (self.MIN_BITS_PER_PIXEL * width * height * framerate)) ** 0.5
+		if scale < 1 and width > self.MIN_WIDTH:
+			scaled_width = max(int(width * scale), self.MIN_WIDTH) // 2 * 2
+			plan["width"] = scaled_width
+			plan["height"] = int(height * scaled_width / width) // 2 * 2
+		return plan
+
+	def _run(self, command):
 		self._logger.debug("timelapse command: {}".format(command))
+		p = sarge.run(command, stdout=sarge.Capture(), stderr=sarge.Capture())
+		if p.returncode != 0:
+			self._logger.warn("Could not render movie, got return code {returncode}: {stderr_text}".format(returncode=p.returncode, stderr_text=p.stderr.text))
+			return False
+		self._logger.debug("gstreamer succeded: {}".format(p.stdout.text))
+		return True
+
+	def _fits(self, max_size):
+		return not max_size or os.path.getsize(self._polar_movie) <= max_size
 
+	def _remux(self, demuxer):
+		return self._run('gst-launch-1.0 -e filesrc location="{infile}" ! {demuxer} ! h264parse ! mp4mux ! filesink location="{outfile}"'.format(
+				infile=self._octoprint_movie, demuxer=demuxer, outfile=self._polar_movie))
+
+	def _encode(self):
+		return self._run('gst-launch-1.0 -e filesrc location="{infile}" ! decodebin name=decode ! x264enc ! queue ! qtmux name=mux ! filesink location="{outfile}" decode. ! mux.'.format(
+				infile=self._octoprint_movie, outfile=self._polar_movie))
+
+	def _encode_to_plan(self, plan):
+		filters = ""
+		if "framerate" in plan:
+			filters += " ! videorate ! video/x-raw,framerate={}/1".format(plan["framerate"])
+		if "width" in plan:
+			filters += " ! videoscale ! video/x-raw,width={},height={}".format(plan["width"], plan["height"])
+		return self._run('gst-launch-1.0 -e filesrc location="{infile}" ! decodebin ! videoconvert{filters} ! x264enc bitrate={bitrate} ! queue ! qtmux ! filesink location="{outfile}"'.format(
+				infile=self._octoprint_movie, filters=filters, bitrate=plan["bitrate"], outfile=self._polar_movie))
+
+	# working thread for converting from OctoPrint's timelapse format to PolarCloud's
+	def _translate_timelapse_worker(self):
+		started = time()
 		try:
-			p = sarge.run(command, stdout=sarge.Capture(), stderr=sarge.Capture())
-			if p.returncode != 0:
-				self._logger.warn("Could not render movie, got return code {returncode}: {stderr_text}".format(returncode=p.returncode, stderr_text=p.stderr.text))
-			else:
-				self._logger.debug("gstreamer succeded: {}".format(p.stdout.text))
+			probe = self._probe()
+			max_size = self._max_size_callback() if self._max_size_callback else None
+			method = None
+
+			# if it's H.264 already, all it needs is a new container
+			demuxer = self.CONTAINER_DEMUXERS.get(probe.get("container"))
+			if demuxer and probe.get("video") == "video/x-h264":
+				if self._remux(demuxer) and self._fits(max_size):
+					method = "remux"
+
+			plan = None if method else self._encode_plan(probe, max_size)
+			if not method and not plan:
+				if self._encode():
+					method = "encode"
+			elif not method:
+				# one pass aimed at the budget, and if rate control overshoots
+				# anyway, another one scaled down by how much it missed by
+				for attempt in range(self._max_passes):
+					if not self._encode_to_plan(plan):
+						break
+					size = os.path.getsize(self._polar_movie)
+					if size <= max_size:
+						method = "encode to {}".format(repr(plan))
+						break
+					self._logger.info("Timelapse came out at {} bytes, {} allowed".format(size, max_size))
+					plan["bitrate"] = max(int(plan["bitrate"] * self.BUDGET_FILL * max_size / size), 1)
+
+			if method:
+				self._logger.info("Converted timelapse {} ({}) by {} in {:0.1f}s".format(
+					self._octoprint_movie, probe.get("video", "unknown codec"), method, time() - started))
 				self._callback(self._polar_movie)
+			else:
+				self._logger.warn("Unable to convert timelapse {} to fit {} bytes".format(self._octoprint_movie, max_size))
+				self._callback(None)
 
 		except:
 			self._logger.exception("Could not render movie due to unknown error")
 			self._callback(None)
 
+	#~~ Uploads
+
+# presigned upload urls by type ('idle', 'printing', 'timelapse'): asks the
+# cloud for a new one when the one we have is missing, for another job or
+# close to expiring, so that uploads rarely have to wait, and lets those that
+# do wait for one to arrive
+class PolarUploadLocations(object):
+	def __init__(self, request, logger, refresh_ahead=60, retry_interval=10):
+		self._request = request # request(upload_type, job_id)
+		self._logger = logger
+		self._refresh_ahead = refresh_ahead
+		self._retry_interval = retry_interval
+		self._locations = {}
+		self._requested = {}    # upload_type -> (job_id, time asked)
+		self._condition = threading.Condition()
+
+	# job_id None means any job will do
+	def get(self, upload_type, job_id=None):
+		with self._condition:
+			loc = self._locations.get(upload_type)
+			margin = self._refresh_ahead
+			if loc:
+				margin = min(margin, loc.get('lifetime', 0) / 2)
+			if not self._usable(loc, job_id, margin):
+				self._request_locked(upload_type, job_id)
+			return loc if self._usable(loc, job_id) else None
+
+	def wait(self, upload_type, job_id=None, timeout=30):
+		deadline = time() + timeout
+		with self._condition:
+			while True:
+				loc = self.get(upload_type, job_id)
+				remaining = deadline - time()
+				if loc or remaining <= 0:
+					return loc
+				# wake up now and then to ask again in case the answer got lost
+				self._condition.wait(min(remaining, self._retry_interval))
+
+	def refresh(self, wanted):
+		for upload_type, job_id in wanted:
+			self.get(upload_type, job_id)
+
+	def put(self, response):
+		with self._condition:
+			upload_type = response.get('type', 'idle')
+			requested = self._requested.pop(upload_type, None)
+			if not has_all(response, 'jobID'):
+				response['jobID'] = requested[0] if requested else None
+			self._locations[upload_type] = response
+			self._condition.notify_all()
+
+	def discard(self, upload_type):
+		with self._condition:
+			self._locations.pop(upload_type, None)
+
+	def _usable(self, loc, job_id, margin=0):
+		if not loc or (job_id is not None and loc['jobID'] != job_id):
+			return False
+		return datetime.datetime.now() + datetime.timedelta(seconds=margin) < loc['expires']
+
+	def _request_locked(self, upload_type, job_id):
+		requested = self._requested.get(upload_type)
+		if requested and requested[0] == job_id and time() - requested[1] < self._retry_interval:
+			return
+		self._requested[upload_type] = (job_id, time())
+		try:
+			self._request(upload_type, job_id)
+		except Exception:
+			self._logger.exception("Unable to ask for a {} upload url".format(upload_type))
+
+# a multipart/form-data body (the form fields, then one file) that requests
+# streams out with read() as it sends, rather than building the whole thing
+# in memory; its length is known up front so we don't need chunked encoding
+class PolarMultipartFile(object):
+	def __init__(self, fields, name, filename, path, content_type=None, progress_callback=None):
+		boundary = uuid.uuid4().hex
+		self.content_type = "multipart/form-data; boundary={}".format(boundary)
+		head = b""
+		for key, value in fields.items():
+			head += "--{}\r\nContent-Disposition: form-data; name=\"{}\"\r\n\r\n".format(boundary, key).encode('utf-8')
+			head += (value if isinstance(value, bytes) else unicode(value).encode('utf-8')) + b"\r\n"
+		head += "--{}\r\nContent-Disposition: form-data; name=\"{}\"; filename=\"{}\"\r\n".format(
+				boundary, name, filename).encode('utf-8')
+		if content_type:
+			head += "Content-Type: {}\r\n".format(content_type).encode('utf-8')
+		head += b"\r\n"
+		tail = "\r\n--{}--\r\n".format(boundary).encode('utf-8')
+
+		self._file = open(path, 'rb')
+		self._parts = [StringIO(head), self._file, StringIO(tail)]
+		self._length = len(head) + os.path.getsize(path) + len(tail)
+		self._progress_callback = progress_callback
+		self.bytes_read = 0
+
+	def __len__(self):
+		return self._length
+
+	def read(self, size=-1):
+		if size is None or size < 0:
+			size = self._length
+		data = b""
+		while self._parts and len(data) < size:
+			chunk = self._parts[0].read(size - len(data))
+			if not chunk:
+				self._parts.pop(0)
+				continue
+			data += chunk
+		self.bytes_read += len(data)
+		if self._progress_callback and data:
+			self._progress_callback(self.bytes_read, self._length)
+		return data
+
+	def close(self):
+		self._file.close()
+
+	#~~ Timelapse recording
+
+# encodes a timelapse as the print goes: each snapshot is piped into a long
+# running gst-launch as the next frame, so once the print is done all that's
+# left is to close its input and let it write out the mp4
+class PolarTimelapseRecorder(object):
+	def __init__(self, path, logger, framerate=12):
+		self._path = path
+		self._logger = logger
+		self._framerate = framerate
+		self._lock = threading.Lock()
+		self._process = None
+		self._stderr = None
+		self._failed = False
+		self._started = None
+		self.frames = 0
+
+	# false if no frame ever reached the encoder or it stopped taking them
+	@property
+	def recording(self):
+		with self._lock:
+			return self._process is not None and not self._failed
+
+	def add_frame(self, image):
+		with self._lock:
+			if self._failed:
+				return
+			try:
+				if not self._process:
+					self._start(image)
+				self._process.stdin.write(image)
+				self._process.stdin.flush()
+				self.frames += 1
+			except Exception:
+				self._logger.exception("Timelapse encoder stopped taking frames")
+				self._failed = True
+
+	# the first frame decides the movie's size, later ones are scaled to fit
+	def _start(self, image):
+		width, height = Image.open(StringIO(image)).size
+		command = 'gst-launch-1.0 -e fdsrc fd=0 ! image/jpeg,framerate={framerate}/1 ! jpegparse ! jpegdec ! videoconvert ! videoscale ! video/x-raw,width={width},height={height} ! x264enc ! queue ! qtmux ! filesink location="{outfile}"'.format(
+				framerate=self._framerate, width=width // 2 * 2, height=height // 2 * 2, outfile=self._path)
+		self._logger.debug("timelapse recorder command: {}".format(command))
+		self._stderr = tempfile.TemporaryFile()
+		self._process = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE,
+				stdout=self._stderr, stderr=self._stderr)
+		self._started = time()
+
+	# closes the encoder's input and calls callback with the finished movie
+	# (None if there isn't one) once it's done writing
+	def finish(self, callback):
+		thread = threading.Thread(target=self._finish_worker, args=(callback,),
+				name="PolarCloudTimelapseRecorder")
+		thread.daemon = True
+		thread.start()
+
+	def _finish_worker(self, callback):
+		with self._lock:
+			process = self._process
+			self._failed = True
+		if not process:
+			self._logger.info("No frames recorded for the timelapse")
+			callback(None)
+			return
+		finishing = time()
+		try:
+			process.stdin.close()
+		except Exception:
+			pass
+		returncode = process.wait()
+		if returncode != 0:
+			self._stderr.seek(0)
+			self._logger.warn("Could not record timelapse, got return code {}: {}".format(returncode, self._stderr.read()))
+			remove_quietly(self._path)
+			callback(None)
+			return
+		self._logger.info("Recorded timelapse {} from {} frames over {:0.0f}s, finished in {:0.1f}s".format(
+			self._path, self.frames, time() - self._started, time() - finishing))
+		callback(self._path)
+
+	def abort(self):
+		with self._lock:
+			self._failed = True
+			process = self._process
+		if process:
+			try:
+				process.kill()
+				process.wait()
+			except Exception:
+				pass
+		remove_quietly(self._path)
+
 	#~~ Slicing
 
 class PolarPrintPreparer(object):
-	def __init__(self, slicer, file_manager, path, pathGcode, pos, callback, callback_failed, logger):
+	def __init__(self, slicer, profile, file_manager, path, pathGcode, pos, callback, callback_failed, logger,
+			slice_cache=None, slice_key=None, niceness=0):
 		self._slicer = slicer
+		self._niceness = niceness
+		self._profile = profile
 		self._file_manager = file_manager
 		self._path = path
 		self._pathGcode = pathGcode
@@ -1431,7 +3509,12 @@ class PolarPrintPreparer(object):
 		self._callback = callback
 		self._callback_failed = callback_failed
 		self._logger = logger
+		self._slice_cache = slice_cache
+		self._slice_key = slice_key
 		self._thread = None
+		self._lock = threading.Lock()
+		self._cancelled = False
+		self._done = threading.Event()
 
 	def prepare(self):
 		self._thread = threading.Thread(target=self._preparation_worker)
@@ -1441,18 +3524,450 @@ class PolarPrintPreparer(object):
 	def is_alive(self):
 		return not self._thread or self._thread.is_alive()
 
+	# file_manager.slice slices to a temporary file we never get to see, so
+	# there's no way to stop the slicer, this just drops the result
+	def cancel(self):
+		with self._lock:
+			self._cancelled = True
+
+	# until the slicer is done with it, the output file isn't ours to reuse
+	def wait(self, timeout=None):
+		return self._done.wait(timeout)
+
+	def slices_to(self, path):
+		return path == self._pathGcode
+
+	# the slicer failed or was cancelled (there's no callback for that)
+	def stopped(self):
+		self._done.set()
+
 	# working thread for slicing
 	def _preparation_worker(self):
+		if self._niceness:
+			# on linux this only lowers this thread, which the slicing
+			# manager's worker thread and the slicer process inherit
+			try:
+				os.nice(self._niceness)
+			except OSError:
+				self._logger.exception("Unable to lower slicing priority")
 		try:
 			self._file_manager.slice(self._slicer,
 					FileDestinations.LOCAL, self._path,
 					FileDestinations.LOCAL, self._pathGcode,
-					position=self._pos, profile="polarcloud",
-					callback=self._callback,
+					position=self._pos, profile=self._profile,
+					callback=self._on_sliced,
 					callback_args=(self._file_manager.path_on_disk(FileDestinations.LOCAL, self._pathGcode),))
 		except:
 			self._logger.exception("_file_manager.slice failed")
-			self._callback_failed()
+			self._done.set()
+			with self._lock:
+				if not self._cancelled:
+					self._callback_failed()
+
+	def _on_sliced(self, path, *args, **kwargs):
+		try:
+			count = blank_ignore_lines(path)
+			self._logger.debug("Blanked {} @ignore lines in {}".format(count, path))
+		except:
+			self._logger.exception("Unable to remove @ignore lines from {}".format(path))
+		if self._slice_cache and self._slice_key:
+			try:
+				self._slice_cache.put(self._slice_key, path)
+			except:
+				self._logger.exception("Unable to cache sliced gcode {}".format(path))
+		self._done.set()
+		with self._lock:
+			if self._cancelled:
+				self._logger.debug("Ignoring slicing result for cancelled job: {}".format(path))
+				return
+			self._callback(path, *args, **kwargs)
+
+	#~~ Downloads
+
+class PolarDownloadIncomplete(IOError):
+	pass
+
+class PolarDownloadCancelled(Exception):
+	pass
+
+# streams a url to a file on disk in chunks so that memory use doesn't depend
+# on the size of the file, if the connection drops partway through, picks up
+# where it left off with an HTTP Range request (or starts over if the server
+# won't honor ranges)
+class PolarDownloader(object):
+	def __init__(self, url, path, logger, chunk_size=64 * 1024, retries=5, timeout=5, headers=None,
+			cancel_event=None, progress_callback=None, rate_limit=None, append_only=False):
+		self._url = url
+		self._append_only = append_only
+		self._progress_callback = progress_callback
+		self.rate_limit = rate_limit # bytes per second, None for as fast as we can
+		self._cancel_event = cancel_event or threading.Event()
+		self._path = path
+		self._logger = logger
+		self._chunk_size = chunk_size
+		self._retries = retries
+		self._timeout = timeout
+		self._headers = headers or {}
+		self.bytes_received = 0
+		self.total_size = None
+		self.not_modified = False
+		self.etag = None
+		self.last_modified = None
+		self.sha256 = hashlib.sha256()
+
+	def download(self):
+		self.bytes_received = 0
+		self.total_size = None
+		self.not_modified = False
+		self.sha256 = hashlib.sha256()
+		attempt = 0
+		with open(self._path, 'wb') as f:
+			while True:
+				try:
+					self._download_range(f)
+					return self.bytes_received
+				except (requests.ConnectionError, requests.Timeout,
+						requests.exceptions.ChunkedEncodingError, PolarDownloadIncomplete):
+					attempt += 1
+					if attempt > self._retries:
+						raise
+					delay = min(2 ** attempt, 30)
+					self._logger.warn("Download of {} interrupted at {} of {} bytes, resuming in {} seconds".format(
+						self._url, self.bytes_received, self.total_size, delay))
+					if self._cancel_event.wait(delay):
+						raise PolarDownloadCancelled(self._url)
+
+	def cancel(self):
+		self._cancel_event.set()
+
+	def _download_range(self, f):
+		# ask for identity encoding so byte offsets for Range match what's on disk
+		headers = {'Accept-Encoding': 'identity'}
+		if self.bytes_received:
+			if self.total_size is not None and self.bytes_received >= self.total_size:
+				return
+			headers['Range'] = 'bytes={}-'.format(self.bytes_received)
+		else:
+			# extra (e.g. conditional) headers only make sense on a fresh request
+			headers.update(self._headers)
+		r = requests.get(self._url, headers=headers, stream=True, timeout=self._timeout)
+		try:
+			r.raise_for_status()
+			if r.status_code == 304:
+				self.not_modified = True
+				return
+			skip = 0
+			if self.bytes_received and r.status_code != 206:
+				if self._append_only:
+					# somebody may already be reading what we wrote, so don't
+					# touch it, just throw away the part we already have
+					self._logger.debug("Server ignored range request for {}, skipping {} bytes".format(
+						self._url, self.bytes_received))
+					skip = self.bytes_received
+				else:
+					self._logger.debug("Server ignored range request for {}, starting over".format(self._url))
+					f.seek(0)
+					f.truncate()
+					self.bytes_received = 0
+					self.sha256 = hashlib.sha256()
+			if not self.bytes_received:
+				self.etag = r.headers.get('ETag')
+				self.last_modified = r.headers.get('Last-Modified')
+			if self.total_size is None:
+				self.total_size = self._total_size_from_response(r)
+
+			started = time()
+			started_bytes = self.bytes_received
+			for chunk in r.iter_content(chunk_size=self._chunk_size):
+				if self._cancel_event.is_set():
+					raise PolarDownloadCancelled(self._url)
+				if skip:
+					skipped = min(skip, len(chunk))
+					chunk = chunk[skipped:]
+					skip -= skipped
+				if chunk:
+					f.write(chunk)
+					self.sha256.update(chunk)
+					self.bytes_received += len(chunk)
+					if self._progress_callback:
+						self._progress_callback(self.bytes_received, self.total_size)
+					if self.rate_limit:
+						ahead = float(self.bytes_received - started_bytes) / self.rate_limit - (time() - started)
+						if ahead > 0 and self._cancel_event.wait(ahead):
+							raise PolarDownloadCancelled(self._url)
+			f.flush()
+		finally:
+			r.close()
+
+		if self.total_size is not None and self.bytes_received < self.total_size:
+			raise PolarDownloadIncomplete("Received {} of {} bytes".format(self.bytes_received, self.total_size))
+
+	def _total_size_from_response(self, r):
+		# Content-Range: bytes 100-199/200
+		content_range = r.headers.get('Content-Range', '')
+		if '/' in content_range:
+			total = content_range.rsplit('/', 1)[1]
+			return int(total) if total.isdigit() else None
+		content_length = r.headers.get('Content-Length', '')
+		if content_length.isdigit():
+			return self.bytes_received + int(content_length)
+		return None
+
+# follows a gcode download that OctoPrint is already printing from: pauses
+# the print when it gets within margin_bytes of the end of what we have and
+# resumes it once we're well ahead again (or done), if the download fails
+# the print is left paused rather than running off the end of the file
+class PolarGcodeStreamer(object):
+	def __init__(self, url, path, printer, logger, margin_bytes, cancel_event=None, progress_callback=None,
+			poll_interval=0.25):
+		self._url = url
+		self._printer = printer
+		self._logger = logger
+		self._margin = margin_bytes
+		self._poll_interval = poll_interval
+		self._cancel_event = cancel_event or threading.Event()
+		self._done = threading.Event()
+		self._downloader = PolarDownloader(url, path, logger, cancel_event=self._cancel_event,
+				progress_callback=progress_callback, append_only=True)
+		self.complete = False
+		self.error = None
+
+	@property
+	def bytes_received(self):
+		return self._downloader.bytes_received
+
+	@property
+	def total_size(self):
+		return self._downloader.total_size
+
+	def start(self):
+		thread = threading.Thread(target=self._download_worker, name="PolarCloudGcodeStream")
+		thread.daemon = True
+		thread.start()
+
+	# True once prefix_bytes (or the whole file) is on disk, False if the
+	# download failed or was cancelled first
+	def wait_for_prefix(self, prefix_bytes):
+		while not self._done.wait(0.1):
+			if self._downloader.bytes_received >= prefix_bytes:
+				return True
+		return self.complete
+
+	# True once the whole file is on disk, False if the download failed
+	def wait(self, timeout=None):
+		self._done.wait(timeout)
+		return self.complete
+
+	def follow(self):
+		thread = threading.Thread(target=self._follow_worker, name="PolarCloudGcodeFollow")
+		thread.daemon = True
+		thread.start()
+
+	def cancel(self):
+		self._cancel_event.set()
+
+	def _download_worker(self):
+		try:
+			self._downloader.download()
+			self.complete = True
+			self._logger.debug("Finished streaming {}".format(self._url))
+		except PolarDownloadCancelled:
+			self.error = "cancelled"
+		except Exception as e:
+			self._logger.exception("Could not finish downloading {}".format(self._url))
+			self.error = str(e) or repr(e)
+		finally:
+			self._done.set()
+
+	def _follow_worker(self):
+		started = False
+		paused = False
+		while not self._cancel_event.is_set():
+			printing = self._printer.is_printing()
+			is_paused = self._printer.is_paused()
+			if printing or is_paused:
+				started = True
+			elif started or self._done.is_set():
+				# the print is over (or never got going)
+				return
+
+			if started:
+				if self.error:
+					if printing:
+						self._logger.error("Download of the print file failed, pausing the print")
+						self._printer.pause_print()
+					return
+				if self.complete and not paused:
+					return
+
+				progress = self._printer.get_current_data().get("progress") or {}
+				ahead = self._downloader.bytes_received - (progress.get("filepos") or 0)
+				if not self.complete and printing and ahead < self._margin:
+					self._logger.warn("Print is catching up with the download ({} bytes ahead), pausing".format(ahead))
+					self._printer.pause_print()
+					paused = True
+				elif paused and is_paused and (self.complete or ahead >= 2 * self._margin):
+					self._logger.info("Download is ahead again, resuming the print")
+					self._printer.resume_print()
+					paused = False
+			self._cancel_event.wait(self._poll_interval)
+
+# files kept on disk under a byte budget, least recently used go first, the
+# index maps a key to the blob holding its content (several keys can share a
+# blob) and is saved as json next to the blobs
+class PolarDiskCache(object):
+	def __init__(self, folder, max_bytes, logger):
+		self._folder = folder
+		self._index_path = os.path.join(folder, "index.json")
+		self._max_bytes = max_bytes
+		self._logger = logger
+		self._lock = threading.RLock()
+		self.hits = 0
+		self.misses = 0
+		if not os.path.isdir(folder):
+			os.makedirs(folder)
+		self._index = self._load_index()
+
+	def set_max_bytes(self, max_bytes):
+		with self._lock:
+			self._max_bytes = max_bytes
+			self._evict()
+			self._save_index()
+
+	def get_counters(self):
+		return dict(hits=self.hits, misses=self.misses)
+
+	# copy the blob for key to dest, false if we don't have it
+	def _use(self, key, dest):
+		with self._lock:
+			entry = self._index.get(key)
+			if not entry or not os.path.isfile(self._blob_path(entry['blob'])):
+				return False
+			self._place(self._blob_path(entry['blob']), dest)
+			entry['last_used'] = time()
+			self._save_index()
+			return True
+
+	def _add(self, key, blob, path, **info):
+		with self._lock:
+			blob_path = self._blob_path(blob)
+			if not os.path.isfile(blob_path):
+				self._place(path, blob_path)
+			entry = dict(blob=blob, size=os.path.getsize(blob_path), last_used=time())
+			entry.update(info)
+			self._index[key] = entry
+			self._evict()
+			self._save_index()
+
+	def _blob_path(self, blob):
+		return os.path.join(self._folder, blob)
+
+	# hard link if we can, the blobs are never modified in place
+	def _place(self, source, dest):
+		link_or_copy(source, dest)
+
+	# drop least recently used blobs (and the keys that point at them) until
+	# we're under budget
+	def _evict(self):
+		blobs = {}
+		for entry in self._index.values():
+			size, last_used = blobs.get(entry['blob'], (entry['size'], 0))
+			blobs[entry['blob']] = (size, max(last_used, entry['last_used']))
+		total = sum(size for size, last_used in blobs.values())
+		for blob, (size, last_used) in sorted(blobs.items(), key=lambda item: item[1][1]):
+			if total <= self._max_bytes:
+				break
+			self._logger.debug("Evicting {} ({} bytes) from {}".format(blob, size, self._folder))
+			try:
+				os.remove(self._blob_path(blob))
+			except OSError:
+				pass
+			for key in [key for key, entry in self._index.items() if entry['blob'] == blob]:
+				del self._index[key]
+			total -= size
+
+	def _load_index(self):
+		try:
+			with open(self._index_path) as f:
+				return json.load(f)
+		except (IOError, ValueError):
+			return {}
+
+	def _save_index(self):
+		try:
+			with open(self._index_path, 'w') as f:
+				json.dump(self._index, f)
+		except IOError:
+			self._logger.exception("Unable to save cache index {}".format(self._index_path))
+
+# downloaded print files by content hash, keyed by url (less the query string,
+# since presigned urls differ every time) along with the validators needed to
+# ask the server whether our copy is still current
+class PolarFileCache(PolarDiskCache):
+	@staticmethod
+	def key_for_url(url):
+		urlp = urlparse(url)
+		return urlunparse((urlp.scheme, urlp.netloc, urlp.path, '', '', ''))
+
+	# download url to path, or if our cached copy is still current, put that
+	# at path instead, returns the sha256 of the content
+	def fetch(self, url, path, cancel_event=None, progress_callback=None, rate_limit=None):
+		if self._max_bytes <= 0:
+			downloader = PolarDownloader(url, path, self._logger, cancel_event=cancel_event,
+					progress_callback=progress_callback, rate_limit=rate_limit)
+			downloader.download()
+			return downloader.sha256.hexdigest()
+
+		key = self.key_for_url(url)
+		headers = {}
+		with self._lock:
+			entry = self._index.get(key)
+			if entry and os.path.isfile(self._blob_path(entry['blob'])):
+				if entry.get('etag'):
+					headers['If-None-Match'] = entry['etag']
+				if entry.get('last_modified'):
+					headers['If-Modified-Since'] = entry['last_modified']
+
+		downloader = PolarDownloader(url, path, self._logger, headers=headers, cancel_event=cancel_event,
+				progress_callback=progress_callback, rate_limit=rate_limit)
+		downloader.download()
+		with self._lock:
+			if downloader.not_modified and key in self._index:
+				blob = self._index[key]['blob']
+				if self._use(key, path):
+					self._logger.info("{} not modified, using cached copy {}".format(url, blob))
+					self.hits += 1
+					return blob
+
+			self.misses += 1
+			if downloader.not_modified:
+				# lost our copy between asking and using it, ask again
+				downloader = PolarDownloader(url, path, self._logger, cancel_event=cancel_event,
+						progress_callback=progress_callback, rate_limit=rate_limit)
+				downloader.download()
+			sha256 = downloader.sha256.hexdigest()
+			self._add(key, sha256, path, etag=downloader.etag, last_modified=downloader.last_modified)
+			return sha256
+
+# sliced gcode keyed on everything that goes into the slice: the model's
+# content hash, the translated profile, the slicer, the position and the
+# printer profile (bed size, origin, extruder offsets all change the gcode)
+class PolarSliceCache(PolarDiskCache):
+	@staticmethod
+	def key(model_sha256, profile, slicer, pos, printer_profile):
+		description = json.dumps([model_sha256, profile, slicer, list(pos), printer_profile], sort_keys=True)
+		return hashlib.sha256(description).hexdigest()
+
+	def get(self, key, path):
+		if self._max_bytes > 0 and self._use(key, path):
+			self.hits += 1
+			return True
+		self.misses += 1
+		return False
+
+	def put(self, key, path):
+		if self._max_bytes > 0:
+			self._add(key, key, path)
 
 __plugin_name__ = "PolarCloud"
 
@@ -1463,5 +3978,5 @@ def __plugin_load__():
 	global __plugin_hooks__
 	__plugin_hooks__ = {
 		"octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
-		"octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.strip_ignore
+		"octoprint.comm.protocol.gcode.queuing": __plugin_implementation__.gcode_queuing
 	}
@@ -0,0 +1,18 @@
+# coding=utf-8
+# times parse_engine_config against the ConfigParser wrapper it replaced:
+#
+#    python -m tests.benchmark_engine_config
+from __future__ import absolute_import, print_function
+
+import timeit
+
+from octoprint_polarcloud import parse_engine_config
+from .test_engine_config import SAMPLE_CONFIG, parse_with_configparser
+
+def main(number=2000):
+	for name, parse in (("ConfigParser", parse_with_configparser), ("parse_engine_config", parse_engine_config)):
+		seconds = min(timeit.repeat(lambda: parse(SAMPLE_CONFIG), number=number, repeat=5))
+		print("{:>20}: {:0.1f} us per config".format(name, seconds * 1e6 / number))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,46 @@
+# coding=utf-8
+# times the octoprint.comm.protocol.gcode.queuing hook per line of gcode,
+# with and without layer tracking:
+#
+#    python -m tests.benchmark_gcode_queuing
+from __future__ import absolute_import, print_function
+
+import timeit
+
+from octoprint_polarcloud import PolarcloudPlugin
+
+# a slice of a typical print: mostly extruding XY moves, a retract and z-hop
+# travel now and then, and a layer change
+LINES = [
+	("G1 X{:.3f} Y{:.3f} E{:.5f}".format(100 + i * 0.1, 100 - i * 0.1, i * 0.02), "G1") for i in range(90)
+] + [
+	("G1 F2700 E-4.5", "G1"),
+	("G0 F7200 X120.5 Y80.2 Z0.5", "G0"),
+	("G0 X121.5 Y81.2 Z0.3", "G0"),
+	("G1 F2700 E0", "G1"),
+	("M106 S255", "M106"),
+	("G0 X122.5 Y82.2 Z0.45", "G0"),
+	("G1 X123.5 Y83.2 E0.1", "G1"),
+	("M117 Layer 2", "M117"),
+	("G1 X124.5 Y84.2 E0.2", "G1"),
+	("G1 X125.5 Y85.2 E0.3", "G1")
+]
+
+def main(number=200):
+	plugin = PolarcloudPlugin()
+	# the layer changes themselves aren't what's being timed
+	plugin._on_layer_change = lambda: None
+	hook = plugin.gcode_queuing
+
+	def run():
+		for cmd, gcode in LINES:
+			hook(None, "queuing", cmd, None, gcode)
+
+	for name, track_layers in (("not tracking", False), ("tracking layers", True)):
+		plugin._track_layers = track_layers
+		plugin._layer_tracker.reset()
+		seconds = min(timeit.repeat(run, number=number, repeat=5))
+		print("{:>16}: {:0.2f} us per line".format(name, seconds * 1e6 / (number * len(LINES))))
+
+if __name__ == "__main__":
+	main()
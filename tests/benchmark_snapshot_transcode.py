@@ -0,0 +1,64 @@
+# coding=utf-8
+# times the two halves of transcode_snapshot on 720p and 1080p webcam sized
+# frames: a draft mode decode against a full one, and encode_jpeg fitting a
+# size budget against a single encode at the default quality:
+#
+#    python -m tests.benchmark_snapshot_transcode
+from __future__ import absolute_import, print_function
+
+import timeit
+from StringIO import StringIO
+
+from PIL import Image
+
+from octoprint_polarcloud import encode_jpeg, transcode_snapshot
+
+MAX_SIZE = 48 * 1024
+
+# a gradient with sensor noise on top, close enough to a webcam frame for
+# the decoder and the encoder
+def make_frame(size):
+	gradient = Image.linear_gradient('L').resize(size)
+	noise = Image.effect_noise(size, 24)
+	image = Image.merge('RGB', (gradient, noise, Image.blend(gradient, noise, 0.5)))
+	buf = StringIO()
+	image.save(buf, format="jpeg", quality=90)
+	return buf.getvalue()
+
+# the whole frame decoded, then scaled down
+def decode_full(image_bytes):
+	image = Image.open(StringIO(image_bytes))
+	image.load()
+	image.thumbnail((640, 480))
+	return image
+
+# what transcode_snapshot does, thumbnail() has the decoder scale it down
+def decode_draft(image_bytes):
+	image = Image.open(StringIO(image_bytes))
+	image.thumbnail((640, 480))
+	image.load()
+	return image
+
+# a single encode at PIL's default quality, whatever size it comes out
+def encode_once(image):
+	buf = StringIO()
+	image.save(buf, format="jpeg")
+	return buf.getvalue()
+
+def timed(function, arg, number):
+	return min(timeit.repeat(lambda: function(arg), number=number, repeat=5)) * 1e3 / number
+
+def main(number=20):
+	for label, size in (("720p", (1280, 720)), ("1080p", (1920, 1080))):
+		frame = make_frame(size)
+		for name, decode in (("full decode", decode_full), ("draft decode", decode_draft)):
+			print("{:>6} {:>20}: {:0.1f} ms per frame".format(label, name, timed(decode, frame, number)))
+		image = decode_draft(frame)
+		for name, encode in (("single encode", encode_once), ("encode_jpeg", lambda i: encode_jpeg(i, MAX_SIZE))):
+			print("{:>6} {:>20}: {:0.1f} ms per frame, {} bytes".format(label, name, timed(encode, image, number),
+				len(encode(image))))
+		print("{:>6} {:>20}: {:0.1f} ms per frame".format(label, "transcode_snapshot",
+			timed(lambda data: transcode_snapshot(data, MAX_SIZE), frame, number)))
+
+if __name__ == "__main__":
+	main()
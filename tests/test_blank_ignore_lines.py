@@ -0,0 +1,64 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from octoprint_polarcloud import blank_ignore_lines
+
+# how CuraEngine writes out the start code translate_engine_config hands it
+SLICED = b""";Generated with Cura_SteamEngine 15.04.6
+(@ignore {print_temperature})
+  (@ignore {print_bed_temperature})
+M109 S210
+G28
+;LAYER_COUNT:2
+;LAYER:0
+G1 Z0.3 F6000
+G1 X10 Y10 E1.5
+(@ignore not start code)
+;LAYER:1
+G1 Z0.45
+G1 X20 Y10 E3.0
+"""
+
+class BlankIgnoreLinesTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.path = os.path.join(self.folder, "sliced.gcode")
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def blank(self, data, **kwargs):
+		with open(self.path, 'wb') as f:
+			f.write(data)
+		count = blank_ignore_lines(self.path, **kwargs)
+		with open(self.path, 'rb') as f:
+			return count, f.read()
+
+	def test_start_code(self):
+		count, data = self.blank(SLICED)
+		self.assertEqual(count, 2)
+		self.assertEqual(len(data), len(SLICED))
+		lines, original = data.splitlines(), SLICED.splitlines()
+		for blanked in (1, 2):
+			self.assertEqual(lines[blanked], b";" + b" " * (len(original[blanked]) - 1))
+		self.assertEqual(lines[3:], original[3:])
+
+	# nothing after the start code is touched, or read
+	def test_stops_at_first_layer(self):
+		count, data = self.blank(SLICED + b"(@ignore x)\n" * 100000)
+		self.assertEqual(count, 2)
+		self.assertEqual(data[len(SLICED):], b"(@ignore x)\n" * 100000)
+
+	def test_stops_at_max_bytes(self):
+		unmarked = SLICED.replace(b";LAYER:", b";layer ")
+		count, data = self.blank(unmarked, max_bytes=unmarked.index(b"(@ignore not"))
+		self.assertEqual(count, 2)
+		self.assertIn(b"(@ignore not start code)", data)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,166 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import unittest
+import ConfigParser
+from StringIO import StringIO
+from collections import OrderedDict
+
+from octoprint_polarcloud import parse_engine_config, translate_engine_config
+
+# a Cura engine config the way Polar Cloud sends it down with a print
+SAMPLE_CONFIG = b'''layerThickness = 150
+initialLayerThickness = 300
+filamentDiameter = 1750
+filamentFlow = 100
+extrusionWidth = 500
+layer0extrusionWidth = 600
+insetCount = 3
+downSkinCount = 4
+upSkinCount = 4
+printSpeed = 50
+infillSpeed = 60
+inset0Speed = 30
+insetXSpeed = 40
+moveSpeed = 150
+initialLayerSpeed = 20
+fanFullOnLayerNr = 3
+fanSpeedMin = 100
+fanSpeedMax = 100
+sparseInfillLineDistance = 2500
+retractionAmount = 4500
+retractionSpeed = 40.5 ; mm/s
+retractionZHop = 0
+enableCombing = 1
+supportAngle = -1
+supportType = 0
+supportLineDistance = 2666
+objectSink = 0
+gcodeFlavor = 0
+posx = 100000
+posy = 100000
+fixHorrible = 1
+startCode = """M109 S210
+G28
+
+G1 Z15.0 F6000
+"""
+endCode = """M104 S0
+M140 S0
+"""
+'''
+
+# what the plugin did before parse_engine_config: ConfigParser, with a dummy
+# section header and the lines inside triple quotes indented so they read as
+# continuations
+class _ConfigFileReader(StringIO, object):
+	def __init__(self, *args, **kwargs):
+		self._dummy_section = True
+		self._indent = False
+		super(_ConfigFileReader, self).__init__(*args, **kwargs)
+
+	def readline(self):
+		if self._dummy_section:
+			self._dummy_section = False
+			return "[x]"
+		line = super(_ConfigFileReader, self).readline()
+		if self._indent:
+			line = "    " + line
+		if '"""' in line:
+			self._indent = not self._indent
+		return line
+
+def parse_with_configparser(config_file_bytes):
+	config = ConfigParser.ConfigParser()
+	config.readfp(_ConfigFileReader(config_file_bytes))
+	options = OrderedDict()
+	for option in config.options("x"):
+		try:
+			value = config.getint("x", option)
+		except:
+			try:
+				value = config.getfloat("x", option)
+			except:
+				value = config.get("x", option)
+		options[option] = value
+	return options
+
+class EngineConfigParserTest(unittest.TestCase):
+	def assertSameAsConfigParser(self, config_file_bytes):
+		expected = parse_with_configparser(config_file_bytes)
+		actual = parse_engine_config(config_file_bytes)
+		self.assertEqual(list(expected.items()), list(actual.items()))
+		for option in expected:
+			self.assertEqual(type(expected[option]), type(actual[option]), option)
+
+	def test_sample_config(self):
+		self.assertSameAsConfigParser(SAMPLE_CONFIG)
+
+	def test_values(self):
+		config = parse_engine_config(SAMPLE_CONFIG)
+		self.assertEqual(config["layerthickness"], 150)
+		self.assertEqual(config["retractionspeed"], 40.5)
+		self.assertEqual(config["supportangle"], -1)
+		self.assertEqual(config["startcode"], '"""M109 S210\nG28\nG1 Z15.0 F6000\n"""')
+
+	def test_comments_and_separators(self):
+		self.assertSameAsConfigParser(b'# comment\n; comment\nA = 1\nb: 2.5\nc=x ; trailing\nd = x;kept\ne = ""\n')
+
+	# the ConfigParser wrapper never got past a value opening and closing
+	# its quotes on the same line
+	def test_single_line_triple_quotes(self):
+		config = parse_engine_config(b'endCode = """M84"""\nprintSpeed = 50\n')
+		self.assertEqual(list(config.items()), [("endcode", '"""M84"""'), ("printspeed", 50)])
+
+	def test_continuation_without_option(self):
+		self.assertRaises(ValueError, parse_engine_config, b'  indented = 1\n')
+
+	def test_not_an_option(self):
+		self.assertRaises(ValueError, parse_engine_config, b'printSpeed 50\n')
+
+class EngineConfigTranslationTest(unittest.TestCase):
+	def setUp(self):
+		self.logger = logging.getLogger("octoprint.plugins.polarcloud.tests")
+		self.profile, self.pos = translate_engine_config(parse_engine_config(SAMPLE_CONFIG), 0.4, self.logger)
+
+	def test_position(self):
+		self.assertEqual(self.pos, (100.0, 100.0))
+
+	def test_units(self):
+		self.assertEqual(self.profile["layer_height"], 0.15)
+		self.assertEqual(self.profile["bottom_thickness"], 0.3)
+		self.assertEqual(self.profile["edge_width"], 0.5)
+		self.assertEqual(self.profile["filament_diameter"], [1.75] * 4)
+		self.assertEqual(self.profile["retraction_amount"], 4.5)
+
+	def test_line_and_layer_counts(self):
+		# counted in the config's own extrusion width and layer heights
+		self.assertAlmostEqual(self.profile["wall_thickness"], 3 * 0.5)
+		self.assertAlmostEqual(self.profile["solid_layer_thickness"], 4 * 0.15)
+		self.assertAlmostEqual(self.profile["fan_full_height"], 2 * 0.15 + 0.3)
+		self.assertAlmostEqual(self.profile["fill_density"], 100.0 * 0.5 / 2.5)
+		self.assertAlmostEqual(self.profile["first_layer_width_factor"], 0.6 * 100.0 / 0.5)
+
+	def test_line_and_layer_counts_default(self):
+		# without them, nozzle widths and 0.2mm layers
+		config = parse_engine_config(b"insetCount = 3\nupSkinCount = 4\nfanFullOnLayerNr = 3\n")
+		profile, pos = translate_engine_config(config, 0.4, self.logger)
+		self.assertAlmostEqual(profile["wall_thickness"], 3 * 0.4)
+		self.assertAlmostEqual(profile["solid_layer_thickness"], 4 * 0.2)
+		self.assertAlmostEqual(profile["fan_full_height"], 2 * 0.2 + 0.2)
+
+	def test_gcode(self):
+		self.assertEqual(self.profile["start_gcode"],
+				["(@ignore {print_temperature})\n(@ignore {print_bed_temperature})\nM109 S210\nG28\nG1 Z15.0 F6000\n"])
+		self.assertEqual(self.profile["end_gcode"], ["M104 S0\nM140 S0\n"])
+
+	def test_support_and_fixes(self):
+		self.assertEqual(self.profile["support"], "buildplate")
+		self.assertEqual(self.profile["support_type"], "lines")
+		self.assertTrue(self.profile["fix_horrible_union_all_type_a"])
+		self.assertFalse(self.profile["fix_horrible_union_all_type_b"])
+		self.assertTrue(self.profile["fan_enabled"])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,182 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+from octoprint_polarcloud import PolarGcodeStreamer
+
+GCODE = b"".join(b"G1 X%.3f Y%.3f E%.5f ; line %d\n" % (i * 0.01, i * 0.02, i * 0.001, i) for i in range(20000))
+
+# serves GCODE a piece at a time; the first response can stop at gate_at until
+# gate is set, or hang up at drop_at, later ones pick up from a Range header
+# unless honor_range is off
+class _GcodeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		server = self.server
+		server.requests.append(self.headers.get('Range'))
+		first = len(server.requests) == 1
+		start = 0
+		match = re.match(r'bytes=(\d+)-', self.headers.get('Range') or '')
+		if match and server.honor_range:
+			start = int(match.group(1))
+			self.send_response(206)
+			self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(GCODE) - 1, len(GCODE)))
+		else:
+			self.send_response(200)
+		self.send_header("Content-Length", str(len(GCODE) - start))
+		self.end_headers()
+
+		end = len(GCODE)
+		if first and server.drop_at:
+			end = server.drop_at
+		for offset in range(start, end, 8 * 1024):
+			if first and server.gate_at and offset >= server.gate_at:
+				server.gate.wait()
+			self.wfile.write(GCODE[offset:min(offset + 8 * 1024, end)])
+			time.sleep(0.002)
+
+	def log_message(self, *args):
+		pass
+
+class _GcodeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _GcodeHandler)
+		self.requests = []
+		self.gate = threading.Event()
+		self.gate_at = None
+		self.drop_at = None
+		self.honor_range = True
+		self.url = "http://127.0.0.1:{}/print.gcode".format(self.server_address[1])
+
+# prints from the file the way OctoPrint does, a line at a time from
+# wherever it got to, with no idea the file is still being written; reading
+# a line that isn't all there yet is running off the end of the download
+class _Printer(object):
+	def __init__(self, path):
+		self._path = path
+		self._state = "operational"
+		self._lock = threading.Lock()
+		self.filepos = 0
+		self.lines = []
+		self.pauses = 0
+		self.resumes = 0
+		self.ran_off = False
+		self.finished = threading.Event()
+
+	def start(self):
+		self._state = "printing"
+		thread = threading.Thread(target=self._print_worker)
+		thread.daemon = True
+		thread.start()
+
+	def is_printing(self):
+		return self._state == "printing"
+
+	def is_paused(self):
+		return self._state == "paused"
+
+	def pause_print(self):
+		with self._lock:
+			self._state = "paused"
+			self.pauses += 1
+
+	def resume_print(self):
+		with self._lock:
+			self._state = "printing"
+			self.resumes += 1
+
+	def get_current_data(self):
+		return {"progress": {"filepos": self.filepos}}
+
+	def _print_worker(self):
+		with open(self._path, 'rb') as f:
+			while self.filepos < len(GCODE):
+				with self._lock:
+					if self._state == "printing":
+						f.seek(self.filepos)
+						line = f.readline()
+						if not line.endswith(b"\n"):
+							self.ran_off = True
+							self._state = "operational"
+							break
+						self.lines.append(line)
+						self.filepos += len(line)
+				if len(self.lines) % 10 == 0:
+					time.sleep(0.001)
+		self._state = "operational"
+		self.finished.set()
+
+class PolarGcodeStreamerTest(unittest.TestCase):
+	def setUp(self):
+		self.server = _GcodeServer()
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		self.folder = tempfile.mkdtemp()
+		self.path = os.path.join(self.folder, "current-print.gcode")
+		self.logger = logging.getLogger("octoprint.plugins.polarcloud.tests")
+		self.printer = _Printer(self.path)
+		self.streamer = PolarGcodeStreamer(self.server.url, self.path, self.printer, self.logger, 32 * 1024,
+				poll_interval=0.01)
+
+	def tearDown(self):
+		self.streamer.cancel()
+		self.server.gate.set()
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.folder)
+
+	def print_it(self):
+		self.streamer.start()
+		self.assertTrue(self.streamer.wait_for_prefix(64 * 1024))
+		self.printer.start()
+		self.streamer.follow()
+
+	def assertPrintedEverything(self):
+		self.assertTrue(self.printer.finished.wait(30))
+		self.assertFalse(self.printer.ran_off)
+		self.assertTrue(self.streamer.wait(0))
+		self.assertEqual(self.printer.lines, GCODE.splitlines(True))
+		self.assertTrue(self.printer.pauses >= 1)
+		self.assertEqual(self.printer.resumes, self.printer.pauses)
+
+	def test_pause_until_more_arrives(self):
+		self.server.gate_at = 256 * 1024
+		self.print_it()
+		deadline = time.time() + 10
+		while not self.printer.is_paused() and time.time() < deadline:
+			time.sleep(0.01)
+		self.assertTrue(self.printer.is_paused())
+		self.assertTrue(self.printer.filepos < self.server.gate_at)
+		self.server.gate.set()
+		self.assertPrintedEverything()
+
+	# the connection drops mid-line and the rest comes from a Range request
+	def test_resume_after_dropped_connection(self):
+		self.server.drop_at = 200 * 1024 + 17
+		self.print_it()
+		self.assertPrintedEverything()
+		self.assertEqual(self.server.requests, [None, "bytes={}-".format(self.server.drop_at)])
+
+	# the server ignores the Range and sends it all again, what we already
+	# have (and the printer may have read) is skipped rather than rewritten
+	def test_restart_without_range(self):
+		self.server.drop_at = 200 * 1024 + 17
+		self.server.honor_range = False
+		self.print_it()
+		self.assertPrintedEverything()
+		self.assertEqual(len(self.server.requests), 2)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,126 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import unittest
+
+from octoprint_polarcloud import PolarGcodeAnalyzer, PolarLayerTracker
+
+# start code, then layers with retracts, z-hop travel, and a G92 E0 reset now
+# and then, the way Cura writes them
+ABSOLUTE_E = b"""G28
+G90
+M82
+G92 E0
+G1 Z15.0 F6000
+G1 F200 E3
+G92 E0
+G1 Z0.3 F6000
+G1 X10 Y10 E1.5
+G1 X20 Y10 E3.0
+G1 E-1.5 F2700
+G0 Z0.8
+G0 X30 Y30
+G0 Z0.3
+G1 E3.0
+G1 X40 Y30 E4.5
+G1 E0 F2700
+G0 X50 Y50 Z0.5
+G1 E4.5
+G1 X60 Y50 E6.0
+G92 E0
+G1 Z0.7
+G1 X70 Y50 E1.5
+G1 E-3 F2700
+G0 Z1.2
+G0 X10 Y10
+G0 Z0.9
+G1 E0
+G1 X20 Y10 E1.5
+"""
+
+# the same print with relative extrusion and relative Z for the hops (G90
+# puts E back to absolute too, hence the M83 after it)
+RELATIVE_E = b"""G28
+G90
+M83
+G1 Z15.0 F6000
+G1 F200 E3
+G1 Z0.3 F6000
+G1 X10 Y10 E1.5
+G1 X20 Y10 E1.5
+G1 E-4.5 F2700
+G91
+G0 Z0.5
+G90
+M83
+G0 X30 Y30
+G0 Z0.3
+G1 E4.5
+G1 X40 Y30 E1.5
+G1 E-4.5 F2700
+G0 X50 Y50 Z0.5
+G1 E4.5
+G1 X60 Y50 E1.5
+G1 Z0.7
+G1 X70 Y50 E1.5
+G1 E-3 F2700
+G91
+G0 Z0.5
+G90
+M83
+G0 X10 Y10
+G0 Z0.9
+G1 E3
+G1 X20 Y10 E1.5
+"""
+
+def tracked_layers(gcode):
+	tracker = PolarLayerTracker()
+	layers = []
+	offset = 0
+	for line in gcode.splitlines(True):
+		cmd = line.strip()
+		command = cmd.split()[0]
+		if command in ("G0", "G1"):
+			if tracker.on_move(cmd):
+				layers.append((offset, tracker.z))
+		elif command in PolarLayerTracker.MODE_COMMANDS:
+			tracker.on_mode(command, cmd)
+		offset += len(line)
+	return layers
+
+def analyzed_layers(gcode):
+	analyzer = PolarGcodeAnalyzer()
+	analyzer.feed(gcode)
+	analyzer.finish()
+	return list(analyzer.offsets)
+
+def line_offsets(gcode, *lines):
+	offsets = []
+	for line in lines:
+		offsets.append(gcode.index(b"\n" + line + b"\n") + 1)
+	return offsets
+
+class LayerTrackingTest(unittest.TestCase):
+	def test_absolute_extrusion(self):
+		layers = tracked_layers(ABSOLUTE_E)
+		# the purge at Z15, then the first extrusion on each layer, which
+		# after a hop is the unretract
+		self.assertEqual([z for offset, z in layers], [15.0, 0.3, 0.5, 0.7, 0.9])
+		self.assertEqual([offset for offset, z in layers][1:4],
+				line_offsets(ABSOLUTE_E, b"G1 X10 Y10 E1.5", b"G1 E4.5", b"G1 X70 Y50 E1.5"))
+		self.assertEqual(layers[4][0], line_offsets(ABSOLUTE_E, b"G0 Z0.9\nG1 E0")[0] + len(b"G0 Z0.9\n"))
+		self.assertEqual([offset for offset, z in layers], analyzed_layers(ABSOLUTE_E))
+
+	def test_relative_extrusion(self):
+		layers = tracked_layers(RELATIVE_E)
+		self.assertEqual([z for offset, z in layers], [15.0, 0.3, 0.5, 0.7, 0.9])
+		self.assertEqual([offset for offset, z in layers], analyzed_layers(RELATIVE_E))
+
+	def test_no_layer_without_extrusion(self):
+		gcode = b"G28\nG1 Z0.3\nG1 X10 Y10\nG1 Z0.6\nG1 X20 Y20 E0\n"
+		self.assertEqual(tracked_layers(gcode), [])
+		self.assertEqual(analyzed_layers(gcode), [])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,151 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+import octoprint_polarcloud
+from octoprint_polarcloud import PolarMjpegReader
+
+BOUNDARY = "boundarydonotcross"
+
+def frame_data(n):
+	return b"\xff\xd8" + (b"frame %d " % n) * 200 + b"\xff\xd9"
+
+def part(data, content_length=True):
+	headers = b"--" + BOUNDARY + b"\r\nContent-Type: image/jpeg\r\n"
+	if content_length:
+		headers += b"Content-Length: %d\r\n" % len(data)
+	return headers + b"\r\n" + data + b"\r\n"
+
+# a stand in for mjpg-streamer's ?action=stream, each connection gets the
+# next of streams (the body to send, after which it hangs up), once they run
+# out it answers 503
+class _StreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		server = self.server
+		server.connections += 1
+		if not server.streams:
+			self.send_response(503)
+			self.end_headers()
+			return
+		body = server.streams.pop(0)
+		self.send_response(200)
+		self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=\"{}\"".format(BOUNDARY))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, *args):
+		pass
+
+class _StreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _StreamHandler)
+		self.streams = []
+		self.connections = 0
+		self.url = "http://127.0.0.1:{}/?action=stream".format(self.server_address[1])
+
+class NextFrameTest(unittest.TestCase):
+	delimiter = b"--" + BOUNDARY
+
+	def test_content_length(self):
+		# a frame that happens to contain the delimiter is still read whole
+		data = b"\xff\xd8" + self.delimiter + b"\xff\xd9"
+		frame, rest = PolarMjpegReader.next_frame(part(data) + part(frame_data(2)), self.delimiter)
+		self.assertEqual(frame, data)
+		frame, rest = PolarMjpegReader.next_frame(rest, self.delimiter)
+		self.assertEqual(frame, frame_data(2))
+
+	def test_no_content_length(self):
+		buf = part(frame_data(1), False) + part(frame_data(2), False)
+		frame, rest = PolarMjpegReader.next_frame(buf, self.delimiter)
+		self.assertEqual(frame, frame_data(1))
+		# the last part isn't finished until the next delimiter shows up
+		frame, rest = PolarMjpegReader.next_frame(rest, self.delimiter)
+		self.assertIsNone(frame)
+		frame, rest = PolarMjpegReader.next_frame(rest + self.delimiter, self.delimiter)
+		self.assertEqual(frame, frame_data(2))
+
+	def test_partial_frame(self):
+		buf = part(frame_data(1))
+		for end in (len(self.delimiter) - 3, buf.find(b"\r\n\r\n") + 2, len(buf) - 100):
+			frame, rest = PolarMjpegReader.next_frame(buf[:end], self.delimiter)
+			self.assertIsNone(frame, end)
+			frame, rest = PolarMjpegReader.next_frame(rest + buf[end:], self.delimiter)
+			self.assertEqual(frame, frame_data(1), end)
+
+	def test_junk_before_delimiter(self):
+		frame, rest = PolarMjpegReader.next_frame(b"junk" * 100, self.delimiter)
+		self.assertIsNone(frame)
+		self.assertEqual(len(rest), len(self.delimiter))
+
+	def test_boundary(self):
+		reader = PolarMjpegReader("http://127.0.0.1/", None)
+		self.assertEqual(reader._delimiter('multipart/x-mixed-replace; boundary="frame"'), "--frame")
+		self.assertEqual(reader._delimiter('multipart/x-mixed-replace;boundary=--frame'), "--frame")
+		self.assertIsNone(reader._delimiter('image/jpeg'))
+
+class PolarMjpegReaderTest(unittest.TestCase):
+	def setUp(self):
+		self.server = _StreamServer()
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		self.logger = logging.getLogger("octoprint.plugins.polarcloud.tests")
+		self.reader = PolarMjpegReader(self.server.url, self.logger)
+
+		# note the reconnect delays, but don't wait them out
+		self.delays = []
+		self._sleep = octoprint_polarcloud.sleep
+		def sleep(seconds):
+			self.delays.append(seconds)
+			time.sleep(0.01)
+		octoprint_polarcloud.sleep = sleep
+
+	def tearDown(self):
+		self.reader.stop()
+		octoprint_polarcloud.sleep = self._sleep
+		self.server.shutdown()
+		self.server.server_close()
+
+	def wait_for(self, condition, timeout=5):
+		deadline = time.time() + timeout
+		while not condition():
+			if time.time() > deadline:
+				self.fail("timed out")
+			time.sleep(0.01)
+
+	def test_latest_frame(self):
+		self.server.streams = [part(frame_data(1)) + part(frame_data(2), False) + part(frame_data(3))]
+		self.reader.start()
+		self.wait_for(lambda: self.server.connections > 1)
+		self.assertEqual(self.reader.get_frame(), frame_data(3))
+
+	def test_partial_frame_and_reconnect(self):
+		# the first connection drops halfway through the second frame
+		first = part(frame_data(1)) + part(frame_data(2))
+		self.server.streams = [first[:-1000]]
+		self.reader.start()
+		self.wait_for(lambda: self.server.connections > 1)
+		self.assertEqual(self.reader.get_frame(), frame_data(1))
+
+		self.server.streams = [part(frame_data(3))]
+		self.wait_for(lambda: self.reader.get_frame() == frame_data(3))
+		# backing off while the stream was down
+		self.assertEqual(self.delays[:2], [1, 2])
+
+	def test_stale_frame(self):
+		self.reader._max_age = 0.2
+		self.server.streams = [part(frame_data(1))]
+		self.reader.start()
+		self.wait_for(lambda: self.reader.get_frame() is not None)
+		self.wait_for(lambda: self.reader.get_frame() is None)
+
+if __name__ == "__main__":
+	unittest.main()
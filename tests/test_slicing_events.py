@@ -0,0 +1,101 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import threading
+import unittest
+
+from octoprint.events import Events
+
+from octoprint_polarcloud import PolarcloudPlugin, PolarPrintPreparer
+
+GCODE_PATH = "polarcloud/current-print.gcode"
+
+class _Printer(object):
+	def __init__(self):
+		self.temperatures = []
+
+	def set_temperature(self, heater, value):
+		self.temperatures.append((heater, value))
+
+# FileManager.slice never calls back for a slice that fails or is cancelled,
+# all we get is the SLICING_FAILED or SLICING_CANCELLED event
+class SlicingEventsTest(unittest.TestCase):
+	def setUp(self):
+		self.logger = logging.getLogger("octoprint.plugins.polarcloud.tests")
+		self.plugin = PolarcloudPlugin()
+		self.plugin._logger = self.logger
+		self.plugin._printer = _Printer()
+		self.plugin._job_id = "job-1"
+		self.completed = []
+
+	def _preparer(self, path=GCODE_PATH):
+		return PolarPrintPreparer("cura", "polarcloud_0123456789abcdef", None,
+				"polarcloud/current-print.stl", path, (0, 0),
+				lambda *args, **kwargs: self.completed.append(args), lambda *args: None, self.logger)
+
+	def _start_slicing(self):
+		self.plugin._prep_cancel = threading.Event()
+		self.plugin._set_prep_stage(PolarcloudPlugin.PREP_SLICING)
+		self.plugin._print_preparer = self._preparer()
+		return self.plugin._print_preparer
+
+	def test_failed_slice_ends_preparation(self):
+		preparer = self._start_slicing()
+		self.plugin.on_event(Events.SLICING_FAILED, {"stl": "polarcloud/current-print.stl", "gcode": GCODE_PATH,
+				"reason": "CuraEngine exited with 1"})
+		self.assertFalse(self.plugin._preparing())
+		self.assertEqual(self.plugin._pstate, PolarcloudPlugin.PSTATE_ERROR)
+		self.assertIsNone(self.plugin._print_preparer)
+		self.assertTrue(preparer.wait(0))
+
+	def test_failed_slice_cools_down(self):
+		self._start_slicing()
+		self.plugin._preheat_targets = {'tool0': 210, 'bed': 60}
+		self.plugin.on_event(Events.SLICING_FAILED, {"stl": "polarcloud/current-print.stl", "gcode": GCODE_PATH,
+				"reason": "CuraEngine exited with 1"})
+		self.assertIsNone(self.plugin._preheat_targets)
+		self.assertEqual(sorted(self.plugin._printer.temperatures), [('bed', 0), ('tool0', 0)])
+
+	def test_cancelled_slice_ends_preparation(self):
+		self._start_slicing()
+		self.plugin.on_event(Events.SLICING_CANCELLED, {"stl": "polarcloud/current-print.stl", "gcode": GCODE_PATH})
+		self.assertFalse(self.plugin._preparing())
+		self.assertEqual(self.plugin._pstate, PolarcloudPlugin.PSTATE_CANCELLING)
+
+	def test_abandoned_slice_stops_blocking(self):
+		preparer = self._start_slicing()
+		self.plugin._cancel_preparation()
+		self.assertFalse(self.plugin._preparing())
+		self.assertFalse(preparer.wait(0))
+
+		self.plugin.on_event(Events.SLICING_FAILED, {"stl": "polarcloud/current-print.stl", "gcode": GCODE_PATH,
+				"reason": "killed"})
+		self.assertTrue(self.plugin._wait_for_abandoned_slicing(threading.Event()))
+		self.assertEqual(self.plugin._abandoned_preparers, [])
+		self.assertEqual(self.completed, [])
+
+	def test_failed_prefetch_leaves_the_print_alone(self):
+		self.plugin._cloud_print = True
+		self.plugin._pstate = PolarcloudPlugin.PSTATE_PRINTING
+		preparer = self._preparer("polarcloud/next-print.gcode")
+		self.plugin._prefetch = {'key': ("job-2", "https://example.com/job-2.stl", None),
+				'cancel_event': threading.Event(), 'files': None, 'preparer': preparer}
+
+		self.plugin.on_event(Events.SLICING_FAILED, {"stl": "polarcloud/next-print.stl",
+				"gcode": "polarcloud/next-print.gcode", "reason": "CuraEngine exited with 1"})
+		self.assertEqual(self.plugin._pstate, PolarcloudPlugin.PSTATE_PRINTING)
+		self.assertTrue(self.plugin._cloud_print)
+		self.assertIsNone(self.plugin._prefetch)
+		self.assertTrue(preparer.wait(0))
+		self.assertIsNone(self.plugin._take_prefetched({'jobId': "job-2", 'stlFile': "https://example.com/job-2.stl"}))
+
+	def test_other_slices_left_alone(self):
+		preparer = self._start_slicing()
+		self.plugin.on_event(Events.SLICING_FAILED, {"stl": "model.stl", "gcode": "model.gcode", "reason": "x"})
+		self.assertTrue(self.plugin._preparing())
+		self.assertIs(self.plugin._print_preparer, preparer)
+		self.assertFalse(preparer.wait(0))
+
+if __name__ == "__main__":
+	unittest.main()
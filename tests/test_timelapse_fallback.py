@@ -0,0 +1,111 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from octoprint.events import Events
+
+import octoprint_polarcloud
+from octoprint_polarcloud import PolarcloudPlugin, PolarTimelapseRecorder
+
+class _Settings(object):
+	def get_boolean(self, path):
+		return True
+
+class _Printer(object):
+	def is_printing(self):
+		return False
+
+	def is_paused(self):
+		return False
+
+# OctoPrint's movie events are ignored while we record our own timelapse of a
+# cloud print, but if ours comes to nothing they're what gets uploaded
+class TimelapseFallbackTest(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.logger = logging.getLogger("octoprint.plugins.polarcloud.tests")
+		self.plugin = PolarcloudPlugin()
+		self.plugin._logger = self.logger
+		self.plugin._settings = _Settings()
+		self.plugin._printer = _Printer()
+		self.plugin._cloud_print = True
+		self.plugin._job_id = "job-1"
+		self.plugin._timelapse_recorder = PolarTimelapseRecorder(os.path.join(self.folder, "job-1.mp4"), self.logger)
+		self.plugin._own_timelapse = True
+
+		# note what gets converted for upload
+		self.converted = []
+		test = self
+		class _Transcoder(object):
+			def __init__(self, octoprint_movie, callback, logger, max_size_callback=None):
+				test.converted.append(octoprint_movie)
+
+			def translate_timelapse(self):
+				pass
+		self._transcoder = octoprint_polarcloud.PolarTimelapseTranscoder
+		octoprint_polarcloud.PolarTimelapseTranscoder = _Transcoder
+
+	def tearDown(self):
+		octoprint_polarcloud.PolarTimelapseTranscoder = self._transcoder
+		shutil.rmtree(self.folder)
+
+	def test_own_timelapse(self):
+		self.plugin._timelapse_recorder._process = object()
+		self.plugin._timelapse_recorder.finish = lambda callback: None
+		self.plugin.on_event(Events.PRINT_DONE, {})
+		self.plugin.on_event(Events.MOVIE_DONE, {"movie": "/timelapse/job-1.mpg"})
+		self.assertEqual(self.converted, [])
+		self.assertEqual(self.plugin._pstate, PolarcloudPlugin.PSTATE_POSTPROCESSING)
+		self.assertEqual(self.plugin._pstate_counter, 0)
+
+	def test_no_frames(self):
+		self.plugin.on_event(Events.PRINT_DONE, {})
+		self.assertFalse(self.plugin._own_timelapse)
+		self.assertIsNone(self.plugin._timelapse_recorder)
+		# if OctoPrint isn't making a movie either, it's over soon enough
+		self.assertEqual(self.plugin._pstate_counter, 3)
+
+		self.plugin.on_event(Events.MOVIE_DONE, {"movie": "/timelapse/job-1.mpg"})
+		self.assertEqual(self.converted, ["/timelapse/job-1.mpg"])
+		self.assertEqual(self.plugin._pstate, PolarcloudPlugin.PSTATE_POSTPROCESSING)
+
+	def test_encoder_stopped_taking_frames(self):
+		recorder = self.plugin._timelapse_recorder
+		recorder._process = object()
+		self.assertTrue(recorder.recording)
+		recorder._failed = True
+		self.assertFalse(recorder.recording)
+		self.plugin.on_event(Events.PRINT_DONE, {})
+		self.assertFalse(self.plugin._own_timelapse)
+
+	# OctoPrint's movie was done before ours failed to finish
+	def test_encoder_failed_at_the_end(self):
+		self.plugin._timelapse_recorder = None
+		self.plugin.on_event(Events.MOVIE_DONE, {"movie": "/timelapse/job-1.mpg"})
+		self.assertEqual(self.converted, [])
+		self.plugin._on_timelapse_recorded(None)
+		self.assertFalse(self.plugin._own_timelapse)
+		self.assertEqual(self.converted, ["/timelapse/job-1.mpg"])
+
+	def test_cancelled_print(self):
+		self.plugin.on_event(Events.PRINT_CANCELLED, {})
+		self.assertFalse(self.plugin._own_timelapse)
+		self.plugin.on_event(Events.MOVIE_DONE, {"movie": "/timelapse/job-1.mpg"})
+		self.assertEqual(self.converted, ["/timelapse/job-1.mpg"])
+
+	# a held event belongs to its own print
+	def test_next_print_starts_clean(self):
+		self.plugin._timelapse_recorder = None
+		self.plugin.on_event(Events.MOVIE_DONE, {"movie": "/timelapse/job-1.mpg"})
+		self.plugin._snapshot_url = None
+		self.plugin._start_timelapse_recorder()
+		self.plugin._on_timelapse_recorded(None)
+		self.assertEqual(self.converted, [])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,132 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import logging
+import unittest
+
+from octoprint_polarcloud import PolarTimelapseTranscoder
+
+# gst-discoverer-1.0 -v (GStreamer 1.14, as on Raspbian) on the two kinds of
+# timelapse OctoPrint renders: H.264 in mp4 with the libx264 codec, MPEG-2 in
+# .mpg with the older mpeg2video default
+MP4_OUTPUT = '''Analyzing file:///home/pi/.octoprint/timelapse/benchy_20190301120000.mp4
+Done discovering file:///home/pi/.octoprint/timelapse/benchy_20190301120000.mp4
+
+Topology:
+  container: video/quicktime, variant=(string)iso
+    video: video/x-h264, stream-format=(string)avc, alignment=(string)au, level=(string)4, profile=(string)high, codec_data=(buffer)0164002affe1001b6764002aacd940780227e5c04400000fa40003a9823c60c65801000668ebe3cb22c0, width=(int)1920, height=(int)1080, framerate=(fraction)25/1, pixel-aspect-ratio=(fraction)1/1, interlace-mode=(string)progressive, chroma-format=(string)4:2:0, bit-depth-luma=(uint)8, bit-depth-chroma=(uint)8, parsed=(boolean)true
+      Tags:
+        video codec: H.264 / AVC
+        maximum bitrate: 7045808
+        bitrate: 1838632
+        encoder: Lavf57.83.100
+        container format: ISO MP4/M4A
+
+      Codec:
+        video/x-h264, stream-format=(string)avc, alignment=(string)au, level=(string)4, profile=(string)high, codec_data=(buffer)0164002affe1001b6764002aacd940780227e5c04400000fa40003a9823c60c65801000668ebe3cb22c0, width=(int)1920, height=(int)1080, framerate=(fraction)25/1, pixel-aspect-ratio=(fraction)1/1, interlace-mode=(string)progressive, chroma-format=(string)4:2:0, bit-depth-luma=(uint)8, bit-depth-chroma=(uint)8, parsed=(boolean)true
+      Additional info:
+        None
+      Stream ID: 5f8c2d6e1b0a4e7f9d3c8b2a1e0f4d6c7b9a8e2d1c0b3a4f5e6d7c8b9a0e1f2d/001
+      Width: 1920
+      Height: 1080
+      Depth: 24
+      Frame rate: 25/1
+      Pixel aspect ratio: 1/1
+      Interlaced: false
+      Bitrate: 1838632
+      Max bitrate: 7045808
+
+Properties:
+  Duration: 0:01:00.000000000
+  Seekable: yes
+  Live: no
+  Tags:
+      video codec: H.264 / AVC
+      maximum bitrate: 7045808
+      bitrate: 1838632
+      encoder: Lavf57.83.100
+      container format: ISO MP4/M4A
+
+'''
+
+MPG_OUTPUT = '''Analyzing file:///home/pi/.octoprint/timelapse/benchy_20170301120000.mpg
+Done discovering file:///home/pi/.octoprint/timelapse/benchy_20170301120000.mpg
+
+Topology:
+  container: video/mpeg, mpegversion=(int)2, systemstream=(boolean)true
+    video: video/mpeg, mpegversion=(int)2, systemstream=(boolean)false, profile=(string)main, width=(int)640, height=(int)480, framerate=(fraction)25/1, pixel-aspect-ratio=(fraction)1/1, codec_data=(buffer)000001b32801e01ffffe0a000000001b5148200010000, interlace-mode=(string)progressive, parsed=(boolean)true
+      Tags:
+        video codec: MPEG-2 Video
+        bitrate: 10000000
+        minimum bitrate: 10000000
+        maximum bitrate: 10000000
+
+      Codec:
+        video/mpeg, mpegversion=(int)2, systemstream=(boolean)false, profile=(string)main, width=(int)640, height=(int)480, framerate=(fraction)25/1, pixel-aspect-ratio=(fraction)1/1, codec_data=(buffer)000001b32801e01ffffe0a000000001b5148200010000, interlace-mode=(string)progressive, parsed=(boolean)true
+      Additional info:
+        None
+      Stream ID: 9e1d2c3b4a5f6e7d8c9b0a1f2e3d4c5b6a7f8e9d0c1b2a3f4e5d6c7b8a9f0e1d/src_e0
+      Width: 640
+      Height: 480
+      Depth: 24
+      Frame rate: 25/1
+      Pixel aspect ratio: 1/1
+      Interlaced: false
+      Bitrate: 10000000
+      Max bitrate: 10000000
+
+Properties:
+  Duration: 0:00:12.480000000
+  Seekable: yes
+  Live: no
+  Tags:
+      video codec: MPEG-2 Video
+      bitrate: 10000000
+      minimum bitrate: 10000000
+      maximum bitrate: 10000000
+
+'''
+
+class TimelapseProbeTest(unittest.TestCase):
+	def setUp(self):
+		self.transcoder = PolarTimelapseTranscoder("/tmp/timelapse.mp4", lambda path: None,
+				logging.getLogger("octoprint.plugins.polarcloud.tests"))
+
+	def test_mp4(self):
+		probe = PolarTimelapseTranscoder.parse_probe(MP4_OUTPUT)
+		self.assertEqual(probe, {"container": "video/quicktime", "video": "video/x-h264", "duration": 60.0,
+				"width": 1920, "height": 1080, "framerate": 25.0})
+		self.assertEqual(PolarTimelapseTranscoder.CONTAINER_DEMUXERS.get(probe["container"]), "qtdemux")
+
+	def test_mpg(self):
+		probe = PolarTimelapseTranscoder.parse_probe(MPG_OUTPUT)
+		self.assertEqual(probe, {"container": "video/mpeg", "video": "video/mpeg", "duration": 12.48,
+				"width": 640, "height": 480, "framerate": 25.0})
+		self.assertIsNone(PolarTimelapseTranscoder.CONTAINER_DEMUXERS.get(probe["container"]))
+
+	# without the caps fields, the lines after them still give it away
+	def test_stream_info_lines(self):
+		text = MP4_OUTPUT.replace(", width=(int)1920, height=(int)1080, framerate=(fraction)25/1", "")
+		probe = PolarTimelapseTranscoder.parse_probe(text)
+		self.assertEqual((probe["width"], probe["height"], probe["framerate"]), (1920, 1080, 25.0))
+
+	def test_variable_framerate(self):
+		probe = PolarTimelapseTranscoder.parse_probe(MP4_OUTPUT.replace("25/1", "0/1"))
+		self.assertNotIn("framerate", probe)
+
+	# a minute of 1080p25 into 10MB is too thin, so it's decimated
+	def test_plan_decimates(self):
+		probe = PolarTimelapseTranscoder.parse_probe(MP4_OUTPUT)
+		plan = self.transcoder._encode_plan(probe, 10 * 1024 * 1024)
+		self.assertEqual(plan, {"bitrate": 1328, "framerate": 12})
+
+	# and into 1MB it has to be scaled down as well
+	def test_plan_scales_down(self):
+		probe = PolarTimelapseTranscoder.parse_probe(MP4_OUTPUT)
+		plan = self.transcoder._encode_plan(probe, 1024 * 1024)
+		self.assertEqual(plan["framerate"], PolarTimelapseTranscoder.MIN_FRAMERATE)
+		self.assertTrue(plan["width"] < 1920)
+		self.assertEqual(plan["width"] * 1080 // 1920 // 2 * 2, plan["height"])
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,167 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import cgi
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+
+import requests
+
+import octoprint_polarcloud
+from octoprint_polarcloud import PolarcloudPlugin, PolarMultipartFile, PolarUploadLocations
+
+# a stand in for the storage endpoint Polar Cloud hands out upload urls for,
+# each POST takes the next of responses: "ok" stores the form, "refuse"
+# answers 403 and "drop" hangs up without answering
+class _UploadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_POST(self):
+		server = self.server
+		action = server.responses.pop(0) if server.responses else "ok"
+		if action == "drop":
+			self.close_connection = 1
+			return
+		form = cgi.FieldStorage(fp=self.rfile, headers=self.headers,
+				environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': self.headers['Content-Type']})
+		if action == "refuse":
+			self.send_response(403)
+			self.end_headers()
+			return
+		server.uploads.append(dict(
+			content_length=int(self.headers['Content-Length']),
+			fields=dict((key, form[key].value) for key in form.keys() if key != 'file'),
+			filename=form['file'].filename,
+			data=form['file'].value))
+		self.send_response(204)
+		self.end_headers()
+
+	def log_message(self, *args):
+		pass
+
+class _UploadServer(BaseHTTPServer.HTTPServer):
+	def __init__(self):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _UploadHandler)
+		self.responses = []
+		self.uploads = []
+		self.url = "http://127.0.0.1:{}/upload".format(self.server_address[1])
+
+class UploadTestCase(unittest.TestCase):
+	def setUp(self):
+		self.server = _UploadServer()
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+		self.folder = tempfile.mkdtemp()
+		self.path = os.path.join(self.folder, "timelapse.mp4")
+		self.data = os.urandom(300 * 1024)
+		with open(self.path, 'wb') as f:
+			f.write(self.data)
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.folder)
+
+class PolarMultipartFileTest(UploadTestCase):
+	def test_upload(self):
+		progress = []
+		body = PolarMultipartFile({'key': 'timelapses/123.mp4', 'policy': u'p\xf6licy'}, 'file', 'timelapse.mp4',
+				self.path, progress_callback=lambda sent, total: progress.append((sent, total)))
+		try:
+			r = requests.post(self.server.url, data=body, headers={'Content-Type': body.content_type})
+		finally:
+			body.close()
+		r.raise_for_status()
+
+		self.assertEqual(len(self.server.uploads), 1)
+		upload = self.server.uploads[0]
+		self.assertEqual(upload['content_length'], len(body))
+		self.assertEqual(upload['fields'], {'key': 'timelapses/123.mp4', 'policy': u'p\xf6licy'.encode('utf-8')})
+		self.assertEqual(upload['filename'], 'timelapse.mp4')
+		self.assertEqual(upload['data'], self.data)
+		self.assertEqual(progress[-1], (len(body), len(body)))
+
+	def test_read_in_pieces(self):
+		body = PolarMultipartFile({'key': 'k'}, 'file', 'timelapse.mp4', self.path)
+		try:
+			whole = b""
+			for chunk in iter(lambda: body.read(1000), b""):
+				self.assertTrue(len(chunk) <= 1000)
+				whole += chunk
+		finally:
+			body.close()
+		self.assertEqual(len(whole), len(body))
+		self.assertTrue(self.data in whole)
+
+class UploadTimelapseFileTest(UploadTestCase):
+	def setUp(self):
+		UploadTestCase.setUp(self)
+		self.logger = logging.getLogger("octoprint.plugins.polarcloud.tests")
+		self.url_requests = []
+		self.plugin = PolarcloudPlugin()
+		self.plugin._logger = self.logger
+		self.plugin._snapshot_url = "http://127.0.0.1/webcam/?action=snapshot"
+		self.plugin._job_id = "job-1"
+		self.plugin._upload_locations = PolarUploadLocations(self._request_upload_url, self.logger)
+
+		# don't actually wait between attempts
+		self.delays = []
+		self._sleep = octoprint_polarcloud.sleep
+		octoprint_polarcloud.sleep = self.delays.append
+
+	def tearDown(self):
+		octoprint_polarcloud.sleep = self._sleep
+		UploadTestCase.tearDown(self)
+
+	# the getUrlResponse comes back on the socket thread
+	def _request_upload_url(self, upload_type, job_id):
+		self.url_requests.append((upload_type, job_id))
+		thread = threading.Thread(target=self._get_url_response, args=(upload_type, job_id))
+		thread.daemon = True
+		thread.start()
+
+	def _get_url_response(self, upload_type, job_id):
+		self.plugin._upload_locations.put({
+			'type': upload_type,
+			'jobID': job_id,
+			'url': self.server.url,
+			'fields': {'key': 'timelapses/{}-{}.mp4'.format(job_id, len(self.url_requests))},
+			'lifetime': 3600,
+			'expires': datetime.datetime.now() + datetime.timedelta(seconds=3600)
+		})
+
+	def test_upload(self):
+		self.assertTrue(self.plugin._upload_timelapse_file(self.path))
+		self.assertEqual(len(self.server.uploads), 1)
+		self.assertEqual(self.server.uploads[0]['data'], self.data)
+		self.assertEqual(self.url_requests, [('timelapse', 'job-1')])
+		self.assertEqual(self.delays, [])
+		self.assertEqual(self.plugin._timelapse_upload_progress[0], self.plugin._timelapse_upload_progress[1])
+
+	def test_refused_upload_gets_a_new_url(self):
+		self.server.responses = ["refuse", "ok"]
+		self.assertTrue(self.plugin._upload_timelapse_file(self.path))
+		self.assertEqual(len(self.url_requests), 2)
+		self.assertEqual(self.server.uploads[0]['fields'], {'key': 'timelapses/job-1-2.mp4'})
+		self.assertEqual(len(self.delays), 1)
+
+	def test_dropped_connection_keeps_the_url(self):
+		self.server.responses = ["drop", "ok"]
+		self.assertTrue(self.plugin._upload_timelapse_file(self.path))
+		self.assertEqual(len(self.url_requests), 1)
+		self.assertEqual(self.server.uploads[0]['fields'], {'key': 'timelapses/job-1-1.mp4'})
+		self.assertEqual(len(self.delays), 1)
+
+	def test_gives_up(self):
+		self.server.responses = ["refuse", "drop", "refuse"]
+		self.assertFalse(self.plugin._upload_timelapse_file(self.path, retries=2))
+		self.assertEqual(self.server.uploads, [])
+		self.assertEqual(self.delays, [2, 4])
+
+if __name__ == "__main__":
+	unittest.main()